@@ -1,4 +1,5 @@
 from utils.behavior_data import BehaviorData
+from models.ModelUtils import CategoryCodes
 import torch
 import numpy as np
 import importlib
@@ -204,6 +205,8 @@ class Experiment:
         RvsNR = None
         if not self.modelSplit:
             pred, RvsNR = self.model.forward(datas)
+        elif getattr(self.model, "fusedHeads", False) and hasattr(self.model, "forward_grouped") and self.hierarchical != "Separate":
+            pred, RvsNR = self.getPredictionGrouped(datas, reporting)
         elif not self.bd.split_weekly_questions:
             pred = torch.zeros([datas.shape[0] * 2, self.model.output_size])
             if (self.hierarchical == "Shared"):
@@ -391,6 +394,22 @@ class Experiment:
         return pred, RvsNR
 
 
+    # same as the split model part of getPrediction, but the three category
+    # models run together as grouped matmuls instead of one call per category
+    def getPredictionGrouped(self, datas, reporting=True):
+        models = [self.consumptionModel, self.knowledgeModel, self.physicalModel]
+        categories = CategoryCodes(datas[:, -1], datas[:, -2])
+        if not self.bd.split_weekly_questions:
+            # rows for weekly question 1 first, then weekly question 2
+            categories = torch.cat([CategoryCodes(datas[:, -3], datas[:, -4]), categories], 0)
+            datas = torch.cat([datas, datas], 0)
+        if not reporting:
+            # leave out categories that are not being trained right now
+            for code, training in enumerate([self.trainConsumption, self.trainKnowledge, self.trainPhysical]):
+                if not training:
+                    categories[categories == code] = len(models)
+        return self.model.forward_grouped(models, datas, categories)
+
     def train_epoch_val(self, opt, trainSet):
         # feed through training data one time
         loss = []
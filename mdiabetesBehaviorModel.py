@@ -1,5 +1,6 @@
 # script to run experiments making a predictive model of participant weekly behavior
 from experiment import Experiment
+from utils.model_export import export_model
 import torch
 import numpy as np
 import argparse
@@ -35,7 +36,10 @@ parser.add_argument('-sepHierLoss', type=toBool, default=False)
 parser.add_argument('-seeds', type=int, default=5)
 parser.add_argument('-only_rnr', type=toBool, default=False)
 parser.add_argument('-transformer', type=toBool, default=False)
+parser.add_argument('-fusedHeads', type=toBool, default=False, help="Run all output layers (and the per category models) as fused matmuls")
 parser.add_argument('-save', type=toBool, default=True)
+parser.add_argument('-export', type=toBool, default=False, help="Also save the trained model as TorchScript with a feature schema (see utils/model_export.py)")
+parser.add_argument('-exportOnnx', type=toBool, default=False)
 parser.add_argument('-cluster_by', type=str, default=None, help="Cluster stuff all probably doesn't work?")
 parser.add_argument('-num_clusters', type=int, default=3)
 parser.add_argument('-cluster_method', type=str, default="Kmeans")
@@ -144,7 +148,8 @@ for seed in range(args.seeds):
             "no_response_class": args.nrclass,
             "separateHierLoss": args.sepHierLoss,
             "only_rnr": args.only_rnr,
-            "transformer": args.transformer
+            "transformer": args.transformer,
+            "fusedHeads": args.fusedHeads
         },
         train_kw={
             "epochs": epochs,
@@ -197,6 +202,8 @@ for seed in range(args.seeds):
 
 
     torch.save(e.model, f"{dire}TRAINEDMODEL-{fileprefix}S{seed}.pt")
+    if args.export:
+        export_model(e.model, f"{dire}TRAINEDMODEL-{fileprefix}S{seed}", feature_names=e.bd.featureList, onnx=args.exportOnnx)
 
     writer = open(f"{dire}FINALTRAINMETRICS-{fileprefix}.csv", "a")
     writer.write(",".join([str(loss) for loss in report["train_metrics"][-1, :]]))
@@ -1,6 +1,8 @@
 import torch
 import numpy as np
 import json
+from utils.model_export import load_exported, exported_exists
+from utils.behavior_inference import BehaviorInference
 
 def _padded_binary(a, b):
     # helper function to binary encode a and 
@@ -27,58 +29,150 @@ def _onehot_response(a, l):
     return vec
 
 
+def _binary_table(b, n=None):
+    # row a is _padded_binary(a, b), for a in 0..n (default 0..b)
+    if n is None:
+        n = b
+    return np.stack([_padded_binary(a, b) for a in range(n + 1)]).astype(float)
+# row a + 1 is _onehot_response(a, 3), for a in -1..3
+_RESPONSE_TABLE = np.stack([_onehot_response(a, 3) for a in range(-1, 4)])
+
+def _env_rng(seed, *envId):
+    # independent np.random.Generator for each (seed, env id...), np.random itself if seed is None
+    # (only .random and .choice are used, which both have)
+    if seed is None:
+        return np.random
+    return np.random.default_rng([seed] + list(envId))
+
+def _load_behavior_model(cuda=False):
+    if exported_exists("trainedDiabetesPred"):
+        # TorchScript export (python -m utils.model_export trainedDiabetesPred.pt)
+        #    loads much faster and does not need the model classes
+        model = load_exported("trainedDiabetesPred")
+    else:
+        model = torch.load("trainedDiabetesPred.pt")
+    if cuda:
+        model = model.cuda()
+    model.eval()
+    return model
+
+def _load_category_maps():
+    # question id -> state element (category), message id -> state element
+    with open("detailed_question_state_element_map.json", 'r') as fp:
+        qmap = json.loads(fp.read())
+        qCatDict = {}
+        for key in qmap.keys():
+            for elem in qmap[key]:
+                qCatDict[elem] = int(key)
+    qCatDict[0] = 0
+    mmap = np.loadtxt("detailed_message_map.csv", delimiter=',', dtype=int)
+    mmap = dict(mmap)
+    mmap[0] = 0
+    return qCatDict, mmap
+
+class StartStateSampler():
+    # start states for simulated participants: half the time a real participant's state,
+    #    otherwise a recombined state where each element comes from a random participant
+    #    (a column wise gather, no mask over the whole data set)
+    # every call returns new arrays, never views into startingStates
+    def __init__(self, startingStates, poolSize=0, rng=np.random):
+        # poolSize: > 0 to pre-generate that many start states with rng and serve
+        #    next_states from it (regenerated when used up)
+        self.startingStates = np.stack(startingStates, axis=0)
+        self.cols = np.arange(self.startingStates.shape[1])
+        self.poolSize = poolSize
+        self.rng = rng
+        self.pool = None
+        self.poolPos = 0
+
+    def sample_one(self, rng):
+        # one start state, draws in the same order as the original DiabetesEnv.reset
+        if rng.random() > .5:
+            # start with random real data
+            return self.startingStates[rng.choice(self.startingStates.shape[0])].copy()
+        # randomly select values for each state element
+        # choose from existing values in dataset
+        return self.startingStates[rng.choice(self.startingStates.shape[0], self.cols.shape[0]), self.cols]
+
+    def sample(self, num, rng=None):
+        # num start states [num, state size] drawn together
+        if rng is None:
+            rng = self.rng
+        real = rng.random(num) > .5
+        idx = rng.choice(self.startingStates.shape[0], num)
+        rows = rng.choice(self.startingStates.shape[0], [num, self.cols.shape[0]])
+        return np.where(real[:, None], self.startingStates[idx], self.startingStates[rows, self.cols])
+
+    def next_states(self, num):
+        # num start states, from the pre-generated pool if there is one
+        if self.poolSize <= 0:
+            return self.sample(num)
+        toReturn = []
+        while num > 0:
+            if self.pool is None or self.poolPos >= self.pool.shape[0]:
+                self.pool = self.sample(max(self.poolSize, num))
+                self.poolPos = 0
+            take = min(num, self.pool.shape[0] - self.poolPos)
+            toReturn.append(self.pool[self.poolPos:self.poolPos + take])
+            self.poolPos += take
+            num -= take
+        return np.concatenate(toReturn, 0)
 
 class DiabetesEnv():
-    def __init__(self, startingStates, eqmodel, rewardStateDecay, endQPred, cuda = False, numHist = 3):
+    def __init__(self, startingStates, eqmodel, rewardStateDecay, endQPred, cuda = False, numHist = 3, incrementalEndQ = False, inferenceBackend = "torch", seed = None, envId = 0):
         self.endQPred = endQPred
+        # random stream for start states and response draws
+        #    seeded by (seed, envId) so parallel envs are reproducible and independent,
+        #    or the global np.random stream if seed is None
+        self.rng = _env_rng(seed, envId)
         self.eqmodel = eqmodel
+        # project each week's end questionnaire inputs as the episode runs
+        #    (eqmodel needs project_history / finish, see EndQLSTMNetwork), so the end of the episode
+        #    only adds the final state and runs the LSTM recurrence, with the same result as the full pass
+        self.incrementalEndQ = incrementalEndQ
         self.startingStates = np.stack(startingStates, axis=0)
+        self.sampler = StartStateSampler(self.startingStates)
         self.rewardStateDecay = rewardStateDecay
         self.numHist = numHist
         self.cuda = cuda
-        self.model = torch.load("trainedDiabetesPred.pt")
-        if cuda:
-            self.model = self.model.cuda()
-        self.model.eval()
+        self.model = _load_behavior_model(cuda)
+        # both question rows of a step go through the model as one batch
+        self.inference = BehaviorInference(self.model, inferenceBackend, "cuda" if cuda else "cpu")
         self.currentStartedState = None
         self.maxMsgId = 57
         self.maxQId = 32
         self.maxSId = 17
+        self.episodeLength = 25
 
         self.perCategoryRewards = np.zeros([self.maxSId], dtype=float)
 
-        with open("detailed_question_state_element_map.json", 'r') as fp:
-            qmap = json.loads(fp.read())
-            qCatDict = {}
-            for key in qmap.keys():
-                for elem in qmap[key]:
-                    qCatDict[elem] = int(key)
-            self.qmap = qCatDict
-        self.qmap[0] = 0
-        mmap = np.loadtxt("detailed_message_map.csv", delimiter=',', dtype=int)
-        self.mmap = dict(mmap)
-        self.mmap[0] = 0
+        self.qmap, self.mmap = _load_category_maps()
+        # binary codes of every id, looked up instead of re-encoding with _padded_binary each step
+        self.sidTable = _binary_table(self.maxSId, max([self.maxSId] + list(self.qmap.values()) + list(self.mmap.values())))
+        self.msgTable = _binary_table(self.maxMsgId)
+        self.qTable = _binary_table(self.maxQId)
+        self.rowBuffer = None
 
     def reset(self):
-        if np.random.random() > .5:
-            # start with random real data 
-            idx = np.random.choice(self.startingStates.shape[0])
-            toReturn = self.startingStates[idx]
-        else:
-            # randomly select values for each state element
-            # choose from existing values in dataset
-            mask = np.zeros_like(self.startingStates, dtype=bool)
-            x = np.random.choice(mask.shape[0], mask.shape[1])
-            y = np.arange(mask.shape[1])
-            mask[x, y] = 1
-            toReturn = self.startingStates[mask]
+        toReturn = self.sampler.sample_one(self.rng)
         self.currentStartedState = toReturn
         self.rewardState = toReturn
         self.perCategoryRewards = np.zeros([self.maxSId], dtype=float)
-        self.lastQs = [np.zeros([2], dtype=int) for x in range(self.numHist)]
-        self.lastMs = [np.zeros([2], dtype=int) for x in range(self.numHist)]
-        self.lastRs = [np.zeros([2], dtype=int) for x in range(self.numHist - 1)]
+        # ring buffers with the numHist newest messages / questions and numHist - 1 newest responses
+        #    week w is stored in slot w % buffer length, slots not written yet are zero (no history)
+        self.histMs = np.zeros([self.numHist, 2], dtype=int)
+        self.histQs = np.zeros([self.numHist, 2], dtype=int)
+        self.histRs = np.zeros([max(self.numHist - 1, 1), 2], dtype=int)
+        # whole episode (oldest first) for the end questionnaire features
+        #    week w is row numHist + w, the rows before are zero padding
+        self.logMs = np.zeros([self.numHist + self.episodeLength, 2], dtype=int)
+        self.logQs = np.zeros([self.numHist + self.episodeLength, 2], dtype=int)
+        self.logRs = np.zeros([self.numHist + self.episodeLength, 2], dtype=int)
         self.numEpochs = 0
+        # input projections of the end questionnaire rows so far (one tensor per advance_endq call)
+        #    and the log rows they cover
+        self.endQProj = []
+        self.endQRows = 0
         return toReturn
 
     def step(self, action):
@@ -93,41 +187,49 @@ class DiabetesEnv():
         if qs.min() < 0 or qs.max() >self.maxQId:
             print("Q OUT OF BOUNDS!!!!")
             print(action)
-        self.lastMs = [msgs] + self.lastMs
-        self.lastQs = [qs] + self.lastQs
+        week = self.numEpochs
+        self.histMs[week % self.numHist] = msgs
+        self.histQs[week % self.numHist] = qs
+        if week < self.episodeLength:
+            self.logMs[self.numHist + week] = msgs
+            self.logQs[self.numHist + week] = qs
         rows = self.encode_new_rows()
         observation = np.zeros_like(self.currentStartedState)
         knowns = np.zeros_like(self.currentStartedState, dtype=bool)
         observation[self.maxSId - 1:] = self.currentStartedState[self.maxSId - 1:]
         knowns[self.maxSId - 1:] = 1
-        with torch.no_grad():
-            anses = []
-            for idx, row in enumerate(rows):
-                row = torch.tensor(row).float()
-                if (self.cuda):
-                    row = row.cuda()
-                answer, temp = self.model(row)
-                answer = torch.argmax(answer)
-                if np.random.rand() > 0.5:
-                    anses.append(answer.numpy())
-                    knowns[self.qmap[self.lastQs[0][idx]]] = True
-                    # penalize choosing the same category twice
-                    if observation[self.qmap[self.lastQs[0][idx]]] != 0:
-                        observation[self.qmap[self.lastQs[0][idx]]] = min(observation[self.qmap[self.lastQs[0][idx]]], answer)
-                    else:
-                        observation[self.qmap[self.lastQs[0][idx]]] = answer
+        answers = self.inference.predict_classes(rows)
+        responded = self.rng.random(2) > 0.5
+        anses = []
+        for idx, answer in enumerate(answers):
+            if responded[idx]:
+                anses.append(answer)
+                knowns[self.qmap[qs[idx]]] = True
+                # penalize choosing the same category twice
+                if observation[self.qmap[qs[idx]]] != 0:
+                    observation[self.qmap[qs[idx]]] = min(observation[self.qmap[qs[idx]]], answer)
                 else:
-                    anses.append(-1)
-                # print(observation)
-                # print(knowns)
-            self.lastRs = [np.array(anses)] + self.lastRs
+                    observation[self.qmap[qs[idx]]] = answer
+            else:
+                anses.append(-1)
+            # print(observation)
+            # print(knowns)
+        self.histRs[week % self.histRs.shape[0]] = np.array(anses)
+        if week < self.episodeLength:
+            self.logRs[self.numHist + week] = np.array(anses)
         self.numEpochs += 1
         self.rewardState[~knowns] = self.rewardState[~knowns] * self.rewardStateDecay
 
-        if self.numEpochs > 24:
-            feats = self.encode_final_statepred_feats()
-            with torch.no_grad():
-                eqpred = self.eqmodel(feats).numpy()
+        if self.incrementalEndQ:
+            self.advance_endq()
+
+        if self.numEpochs > self.episodeLength - 1:
+            if self.incrementalEndQ:
+                eqpred = self.running_improvement()
+            else:
+                feats = self.encode_final_statepred_feats()
+                with torch.no_grad():
+                    eqpred = self.eqmodel(feats).numpy()
             predictedImprovement = eqpred
             if self.endQPred:
                 self.perCategoryRewards = predictedImprovement
@@ -141,35 +243,249 @@ class DiabetesEnv():
             predictedImprovement = None
         self.rewardState[knowns] = observation[knowns]
 
-        return observation, knowns, reward, self.numEpochs > 24, predictedImprovement
+        return observation, knowns, reward, self.numEpochs > self.episodeLength - 1, predictedImprovement
         
     def encode_final_statepred_feats(self):
-        feats = []
-        for x in range(len(self.lastRs) - 1, self.numHist, -1):
-            toReturn = np.array(self.currentStartedState)
-            for qid in self.lastQs[x]:
-                toReturn = np.append(_padded_binary(qid,self.maxQId), toReturn)
-            for mid in self.lastMs[x]:
-                toReturn = np.append(_padded_binary(mid,self.maxMsgId), toReturn)
-            for res in self.lastRs[x]:
-                toReturn = np.append(_onehot_response(res, 3), toReturn)
-            feats.append(toReturn)
-        feats = np.stack(feats)
+        # one row per week (oldest first, leaving out the numHist + 1 newest):
+        #    responses, message ids, question ids (second question first), then the state
+        # (the first row is the zero padding from before the episode)
+        return self.encode_statepred_rows(1, min(self.numEpochs, self.episodeLength) - 1)
+
+    def encode_statepred_rows(self, start, end):
+        # end questionnaire model rows for episode log rows start..end-1, with the current state
+        history = self.encode_statepred_history(start, end)
+        state = np.broadcast_to(self.currentStartedState, [history.shape[0], self.currentStartedState.shape[0]])
+        feats = np.concatenate([history, state], axis=-1)
         feats = torch.tensor(feats).float()
         return feats
 
+    def encode_statepred_history(self, start, end):
+        # the columns of those rows before the state
+        Rs = self.logRs[start:end]
+        Ms = self.logMs[start:end]
+        Qs = self.logQs[start:end]
+        return np.concatenate([
+            _RESPONSE_TABLE[Rs[:, 1] + 1], _RESPONSE_TABLE[Rs[:, 0] + 1],
+            self.msgTable[Ms[:, 1]], self.msgTable[Ms[:, 0]],
+            self.qTable[Qs[:, 1]], self.qTable[Qs[:, 0]],
+        ], axis=-1)
+
+    def advance_endq(self):
+        # project the history columns of every log row that is complete and
+        #    part of the final window (encode_final_statepred_feats) and not projected yet
+        last = min(self.numHist + self.numEpochs - 1, self.episodeLength - 2)
+        if last <= self.endQRows:
+            return
+        history = torch.tensor(self.encode_statepred_history(self.endQRows + 1, last + 1)).float()
+        with torch.no_grad():
+            self.endQProj.append(self.eqmodel.project_history(history))
+        self.endQRows = last
+
+    def running_improvement(self):
+        # eqmodel(encode_final_statepred_feats()) from the projected rows: the end questionnaire prediction
+        #    if the episode ended now, None before the first row of the window
+        # optional per step info for reward shaping, costs one recurrence over the rows
+        rows = min(self.numEpochs, self.episodeLength) - 2
+        if rows <= 0:
+            return None
+        state = torch.tensor(self.currentStartedState).float()
+        with torch.no_grad():
+            return self.eqmodel.finish(torch.cat(self.endQProj, 0)[:rows], state).numpy()
+
     def encode_new_rows(self):
-        toReturn = [None, None]
+        # feature rows of both questions, written in place into a reused buffer:
+        #    responses of the numHist - 1 previous weeks (oldest first), the state,
+        #    then the message/question codes of the numHist newest weeks (newest first)
+        nResp = 3 * (self.numHist - 1)
+        nState = self.currentStartedState.shape[0]
+        weekWidth = 2 * self.sidTable.shape[1] + self.msgTable.shape[1] + self.qTable.shape[1]
+        if self.rowBuffer is None or self.rowBuffer.shape[1] != nResp + nState + self.numHist * weekWidth:
+            self.rowBuffer = np.zeros([2, nResp + nState + self.numHist * weekWidth])
+        rows = self.rowBuffer
+        # newest week with messages / questions (responses only go up to the week before)
+        week = self.numEpochs
         for y in [0, 1]:
-            toReturn[y] = self.currentStartedState
             for x in range(self.numHist - 1):
-                toReturn[y] = np.append(_onehot_response(self.lastRs[x][y], 3), toReturn[y])
+                col = nResp - 3 * (x + 1)
+                rows[y, col:col + 3] = _RESPONSE_TABLE[self.histRs[(week - 1 - x) % self.histRs.shape[0]][y] + 1]
+            rows[y, nResp:nResp + nState] = self.currentStartedState
+            col = nResp + nState
             for x in range(self.numHist):
-                toReturn[y] = np.append(toReturn[y], _padded_binary(self.mmap[self.lastMs[x][y]],self.maxSId))
-                toReturn[y] = np.append(toReturn[y], _padded_binary(self.qmap[self.lastQs[x][y]],self.maxSId))
-                toReturn[y] = np.append(toReturn[y], _padded_binary(self.lastMs[x][y],self.maxMsgId))
-                toReturn[y] = np.append(toReturn[y], _padded_binary(self.lastQs[x][y],self.maxQId))
-        return toReturn
+                mid, qid = self.histMs[(week - x) % self.numHist][y], self.histQs[(week - x) % self.numHist][y]
+                for code in [self.sidTable[self.mmap[mid]], self.sidTable[self.qmap[qid]], self.msgTable[mid], self.qTable[qid]]:
+                    rows[y, col:col + code.shape[0]] = code
+                    col += code.shape[0]
+        return rows
+
+
+class VectorDiabetesEnv():
+    # numEnvs DiabetesEnv participants simulated together
+    # every per participant field is an array with the participant on axis 0, so
+    #    one step is one batched forward of the behavior model for all 2 * numEnvs questions
+    # histories are kept oldest first ([numEnvs, numHist + episode length, 2]) instead of
+    #    the newest first lists of DiabetesEnv, so they never need to be rebuilt
+    # finished participants are reset automatically at the end of step
+    def __init__(self, startingStates, eqmodel, rewardStateDecay, endQPred, numEnvs, cuda = False, numHist = 3, inferenceBackend = "torch", seed = None, envId = 0, startPoolSize = 4096):
+        self.endQPred = endQPred
+        # one random stream per participant slot, seeded by (seed, envId, slot),
+        #    so a slot's draws do not depend on numEnvs or the other slots
+        # with seed None every slot shares the global np.random stream (drawn for all slots at once)
+        self.seed = seed
+        if seed is not None:
+            self.rngs = [_env_rng(seed, envId, slot) for slot in range(numEnvs)]
+        self.eqmodel = eqmodel
+        self.startingStates = np.stack(startingStates, axis=0)
+        # unseeded resets take start states from a pre-generated pool
+        self.sampler = StartStateSampler(self.startingStates, startPoolSize)
+        self.rewardStateDecay = rewardStateDecay
+        self.numEnvs = numEnvs
+        self.numHist = numHist
+        self.cuda = cuda
+        self.model = _load_behavior_model(cuda)
+        self.inference = BehaviorInference(self.model, inferenceBackend, "cuda" if cuda else "cpu")
+        self.maxMsgId = 57
+        self.maxQId = 32
+        self.maxSId = 17
+        self.episodeLength = 25
 
-    
+        qmap, mmap = _load_category_maps()
+        self.qmap, self.mmap = qmap, mmap
+        # dict lookups as arrays so whole batches of ids can be mapped at once
+        self.qmapArr = np.zeros([self.maxQId + 1], dtype=int)
+        for qid, cat in qmap.items():
+            self.qmapArr[qid] = cat
+        self.mmapArr = np.zeros([self.maxMsgId + 1], dtype=int)
+        for mid, cat in mmap.items():
+            self.mmapArr[mid] = cat
+        # binary codes of every id, same as _padded_binary
+        self.sidTable = _binary_table(self.maxSId, max(self.maxSId, self.qmapArr.max(), self.mmapArr.max()))
+        self.msgTable = _binary_table(self.maxMsgId)
+        self.qTable = _binary_table(self.maxQId)
 
+        dim = self.startingStates.shape[1]
+        histLen = self.numHist + self.episodeLength
+        # the first numHist history slots stay zero (no message / question / response yet)
+        self.histMs = np.zeros([numEnvs, histLen, 2], dtype=int)
+        self.histQs = np.zeros([numEnvs, histLen, 2], dtype=int)
+        self.histRs = np.zeros([numEnvs, histLen, 2], dtype=int)
+        # also the state features given to the behavior model (as in DiabetesEnv)
+        self.rewardState = np.zeros([numEnvs, dim], dtype=self.startingStates.dtype)
+        self.perCategoryRewards = np.zeros([numEnvs, self.maxSId], dtype=float)
+        self.numEpochs = np.zeros([numEnvs], dtype=int)
+
+    def reset_envs(self, envs):
+        # reset the participants selected by envs (bool mask or indices)
+        envs = np.arange(self.numEnvs)[envs]
+        if self.seed is None:
+            states = self.sampler.next_states(envs.shape[0])
+        else:
+            states = np.stack([self.sampler.sample_one(self.rngs[env]) for env in envs])
+        self.rewardState[envs] = states
+        self.perCategoryRewards[envs] = 0
+        self.histMs[envs] = 0
+        self.histQs[envs] = 0
+        self.histRs[envs] = 0
+        self.numEpochs[envs] = 0
+        return states
+
+    def reset(self):
+        self.reset_envs(np.ones([self.numEnvs], dtype=bool))
+        return self.rewardState.copy()
+
+    def step(self, actions):
+        # actions: [numEnvs, 4], each row as for DiabetesEnv.step
+        # returns observation, knowns, reward, done, predictedImprovement, nextStart
+        #    predictedImprovement is only meaningful for rows that are done
+        #    nextStart is observation, except for done rows where it is the reset state
+        envs = np.arange(self.numEnvs)
+        actions = (np.asarray(actions) + 1) / 2
+        msgs = np.ceil(actions[:, 0:2] * self.maxMsgId).astype(int)
+        if msgs.min() < 0 or msgs.max() > self.maxMsgId:
+            print("MSG OUT OF BOUNDS!!!!")
+            print(actions)
+        qs = np.ceil(actions[:, 2:4] * self.maxQId).astype(int)
+        if qs.min() < 0 or qs.max() > self.maxQId:
+            print("Q OUT OF BOUNDS!!!!")
+            print(actions)
+        t = self.numEpochs + self.numHist
+        self.histMs[envs, t] = msgs
+        self.histQs[envs, t] = qs
+        rows = self.encode_new_rows()
+        observation = np.zeros_like(self.rewardState)
+        knowns = np.zeros(self.rewardState.shape, dtype=bool)
+        observation[:, self.maxSId - 1:] = self.rewardState[:, self.maxSId - 1:]
+        knowns[:, self.maxSId - 1:] = 1
+        answers = self.inference.predict_classes(rows.reshape([-1, rows.shape[-1]])).reshape([self.numEnvs, 2])
+        if self.seed is None:
+            responded = np.random.rand(self.numEnvs, 2) > 0.5
+        else:
+            responded = np.stack([rng.random(2) for rng in self.rngs]) > 0.5
+        for idx in [0, 1]:
+            resp = envs[responded[:, idx]]
+            cats = self.qmapArr[qs[resp, idx]]
+            ans = answers[resp, idx]
+            knowns[resp, cats] = True
+            # penalize choosing the same category twice
+            current = observation[resp, cats]
+            observation[resp, cats] = np.where(current != 0, np.minimum(current, ans), ans)
+        self.histRs[envs, t] = np.where(responded, answers, -1)
+        self.numEpochs += 1
+        self.rewardState = np.where(knowns, self.rewardState, self.rewardState * self.rewardStateDecay)
+
+        done = self.numEpochs > self.episodeLength - 1
+        if not self.endQPred:
+            gain = observation[:, :self.maxSId] - self.rewardState[:, :self.maxSId]
+            self.perCategoryRewards += np.where(knowns[:, :self.maxSId], gain, 0)
+        predictedImprovement = np.zeros([self.numEnvs, self.maxSId], dtype=float)
+        if done.any():
+            feats = self.encode_final_statepred_feats(done)
+            with torch.no_grad():
+                predictedImprovement[done] = self.eqmodel(feats).numpy()
+            if self.endQPred:
+                self.perCategoryRewards[done] = predictedImprovement[done]
+        reward = np.where(done, self.perCategoryRewards.sum(axis=1), 0)
+        self.rewardState = np.where(knowns, observation, self.rewardState)
+
+        nextStart = observation.copy()
+        if done.any():
+            nextStart[done] = self.reset_envs(done)
+        return observation, knowns, reward, done, predictedImprovement, nextStart
+
+    def encode_new_rows(self):
+        # behavior model features for both questions of the current week
+        # matches DiabetesEnv.encode_new_rows, returns [numEnvs, 2, features]
+        envs = np.arange(self.numEnvs)[:, None]
+        t = self.numEpochs[:, None] + self.numHist
+        questions = np.arange(2)[None, :]
+        parts = []
+        # responses to the previous numHist - 1 weeks, oldest first
+        for x in range(self.numHist - 2, -1, -1):
+            parts.append(_RESPONSE_TABLE[self.histRs[envs, t - 1 - x, questions] + 1])
+        parts.append(np.broadcast_to(self.rewardState[:, None, :], [self.numEnvs, 2, self.rewardState.shape[1]]))
+        # messages and questions of this week and the numHist - 1 before, newest first
+        for x in range(self.numHist):
+            ms = self.histMs[envs, t - x, questions]
+            qs = self.histQs[envs, t - x, questions]
+            parts.append(self.sidTable[self.mmapArr[ms]])
+            parts.append(self.sidTable[self.qmapArr[qs]])
+            parts.append(self.msgTable[ms])
+            parts.append(self.qTable[qs])
+        return np.concatenate(parts, axis=-1)
+
+    def encode_final_statepred_feats(self, envs):
+        # end questionnaire model input for the selected (finished) participants
+        # matches DiabetesEnv.encode_final_statepred_feats, returns [weeks, participants, features]
+        t = self.numEpochs[envs][0]
+        # weeks oldest first, leaving out the numHist + 1 newest (same rows as DiabetesEnv)
+        Rs = self.histRs[envs, 1:t - 1]
+        Ms = self.histMs[envs, 1:t - 1]
+        Qs = self.histQs[envs, 1:t - 1]
+        state = self.rewardState[envs]
+        feats = np.concatenate([
+            _RESPONSE_TABLE[Rs[:, :, 1] + 1], _RESPONSE_TABLE[Rs[:, :, 0] + 1],
+            self.msgTable[Ms[:, :, 1]], self.msgTable[Ms[:, :, 0]],
+            self.qTable[Qs[:, :, 1]], self.qTable[Qs[:, :, 0]],
+            np.broadcast_to(state[:, None, :], [state.shape[0], Rs.shape[1], state.shape[1]]),
+        ], axis=-1)
+        feats = torch.tensor(feats).float().transpose(0, 1)
+        return feats
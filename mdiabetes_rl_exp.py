@@ -8,9 +8,16 @@ import torch.optim as optim
 from torch.distributions import Normal
 import os
 import time
+import copy
+import queue
+from collections import deque
+import torch.multiprocessing as mp
 from utils.behavior_data import BehaviorData
 from utils.content import StatesHandler
-from mdiabetesEnv import DiabetesEnv
+from mdiabetesEnv import DiabetesEnv, VectorDiabetesEnv
+from utils.sac_learner import SACLearner
+from utils.ensemble_critic import EnsembleQNetwork
+from utils.seed_stack import stackModules, loadMember, stackBatches
 
 
 def toBool(x):
@@ -32,17 +39,36 @@ parser.add_argument("--startLearning", type=int, default=10000, help="no. sample
 parser.add_argument("--bufferSize", type=int, default=100000, help="no. samples in buffer")
 parser.add_argument("--train_batches", type=int, default=100, help="no. batches per timestep")
 parser.add_argument("--envSteps", type=int, default=100, help="no. environment steps per timestep")
+parser.add_argument("--numEnvs", type=int, default=1, help="no. simulated participants stepped together (VectorDiabetesEnv if > 1)")
 parser.add_argument("--logging", type=toBool, default=False, help="Log data to disk")
 parser.add_argument("--keepRealData", type=toBool, default=True, help="Keep all real world data in the replay buffer (do not replace it)")
 parser.add_argument("--cuda", type=toBool, default=False, help="Use GPU for neural nets")
 parser.add_argument("--endQPred", type=toBool, default=True, help="Use prediction of end questionnare to compute episodic rewards")
+parser.add_argument("--inferenceBackend", type=str, default="torch", help="Simulator behavior model backend: torch, torchscript, compile or numpy")
+parser.add_argument("--reportLatency", type=toBool, default=False, help="Print percentiles of the training simulator's behavior model call latency with each evaluation")
+parser.add_argument("--asyncSamplers", type=int, default=0, help="no. sampler processes feeding trajectories to the learner (0 = alternate env steps and training)")
+parser.add_argument("--broadcastEvery", type=int, default=1, help="outer steps between policy broadcasts to the sampler processes")
+parser.add_argument("--maxPolicyLag", type=int, default=2, help="drop trajectories sampled with a policy more than this many broadcasts old")
+parser.add_argument("--compileLearner", type=toBool, default=False, help="torch.compile the RRD / SAC loss computations")
+parser.add_argument("--ensembleSize", type=int, default=0, help="Q networks in one stacked-weight ensemble critic (0 = separate twin SoftQNetworks)")
+parser.add_argument("--ensembleMin", type=int, default=2, help="Ensemble members (chosen at random) whose min gives the target Q; the actor uses the ensemble mean when this is below ensembleSize (REDQ)")
+parser.add_argument("--numSeeds", type=int, default=1, help="Train seeds seed, seed + 1, ... together in this process (actor / critic / RRD stacked along a seed dimension)")
+parser.add_argument("--evalBatch", type=toBool, default=True, help="Run all evaluation rollouts together in a VectorDiabetesEnv")
+parser.add_argument("--incrementalEndQ", type=toBool, default=False, help="Project each week's end questionnaire model inputs as the episode runs, leaving only the LSTM recurrence for the end (single env only)")
 parser.add_argument("--statepred", type=toBool, default=False, help="Use state predictive model (our method)")
 parser.add_argument("--statemodel", type=str, default="lstm", help="Architecture to use for state predictive model")
+parser.add_argument("--beliefCarry", type=toBool, default=False, help="Carry the state predictor's LSTM state through single env rollouts instead of re-running it over the last context steps")
+parser.add_argument("--checkBelief", type=toBool, default=False, help="With beliefCarry, also compute the windowed belief and report the largest difference")
 parser.add_argument("--numBreaks", type=int, default=4, help="Minibatches for state pred training")
 
 
 
 args = parser.parse_args()
+if args.numSeeds > 1 and (args.numEnvs > 1 or args.asyncSamplers > 0 or args.ensembleSize > 0):
+    raise ValueError("numSeeds > 1 is only supported with numEnvs 1, asyncSamplers 0 and ensembleSize 0")
+if args.numEnvs > 1 and args.envSteps % args.numEnvs != 0:
+    # each vector env step gives numEnvs transitions, the reported step counts assume envSteps per timestep
+    raise ValueError(f"envSteps ({args.envSteps}) must be a multiple of numEnvs ({args.numEnvs})")
 
 # overwrite
 if args.cuda:
@@ -54,142 +80,211 @@ np.random.seed(args.seed)
 # print(args.actlr, args.qlr, args.bufferSize, args.startLearning
 
 
-class Trajectory:
-    def __init__(self, observations, actions, rewards, dones, knownses):
-        # print(observations[0])
-        self.obs = np.stack(observations, axis=0)
-        # print(self.obs.max(), self.obs.min()).
-        self.actions = np.stack(actions, axis=0)
-        self.dones = np.stack(dones, axis=0)
-        self.knownses = np.stack(knownses, axis=0)
-        self.rewards = np.stack(rewards, axis=0)
-        # print("_________IN BUFFER________________", self.obs[0], self.actions[0], self.obs[1], self.rewards[0], sep="\n")
-        if len(self.obs) != len(self.actions) + 1 != len(self.dones) != len(self.knownses) != len(self.rewards) + 1:
-            print("ERROR IN BUFFER STORAGE")
-
-        self.length = len(actions)
-
-    def getElement(self, idx):
-        # print(idx, self.length)
-        return {
-            'obs':self.obs[idx], 
-            'actions': self.actions[idx], 
-            'nextobs': self.obs[idx + 1], 
-            'dones': self.dones[idx + 1], 
-            'knowns': self.knownses[idx], 
-            'nextknowns': self.knownses[idx + 1], 
-            'rewards': self.rewards[idx]}
-    
-    def sample(self, size):
-        idxs = np.random.choice(self.length, size, replace = size>self.length)
-        # if size > self.length:
-        #     mult = 1
-        # else:
-        #     mult = 1
-        return {
-            'obs': self.obs[idxs], 
-            'actions': self.actions[idxs], 
-            'nextobs': self.obs[idxs + 1], 
-            'dones': self.dones[idxs + 1], 
-            'knowns': self.knownses[idxs], 
-            'nextknowns': self.knownses[idxs + 1], 
-            'rewards': [np.mean(self.rewards)]}
-            # 'rewards': self.rewards}
-    
-    def retrieveStateFeatures(self, idx):
-        mindx = max(idx - args.context, 0)
-        obs = self.obs[mindx:idx + 1]
-        acts = self.actions[mindx:idx + 1]
-        labels = np.copy(self.obs[idx + 1]) - self.obs[idx]
-        feats = np.concatenate([obs, acts], axis=1)
-        knowns = self.knownses[idx]
-        return feats, labels, knowns
-
-
-
+# [len(lengths), subLen] random offsets into episodes of the given lengths,
+# without repeats for episodes with at least subLen transitions (like np.random.choice)
+def subSeqOffsets(lengths, subLen, rng=np.random):
+    lengths = np.asarray(lengths)
+    offsets = np.floor(rng.rand(len(lengths), subLen) * lengths[:, None]).astype(np.int64)
+    long = lengths >= subLen
+    if long.any():
+        # random order of each long episode's offsets, padding past the length sorts last
+        keys = rng.rand(long.sum(), lengths.max())
+        keys[np.arange(lengths.max())[None, :] >= lengths[long][:, None]] = 2
+        offsets[long] = np.argsort(keys, axis=1)[:, :subLen]
+    return offsets
+
+# replay buffer stored as preallocated arrays, one row per transition
+# each episode is written to consecutive rows, so context windows / sub sequences are slices
+# rows [0, cutoffRow) hold protected (real world) data, the rest is a ring:
+# new episodes are written at head, wrapping back to cutoffRow, and the oldest episodes
+# are evicted once more than numElements transitions are stored
 class Buffer:
     def __init__(self, numElements):
         self.n = numElements
         self.count = 0
-        self.els = []
-        self.splits = []
-        self.cutoff = 0
+        self.capacity = 0
+        self.head = 0
+        self.cutoffRow = 0
+        # no. rows ever written (rows beyond this are empty)
+        self.filled = 0
+        self.nextEpisode = 0
+        # live episodes, oldest first: id -> (first row, length)
+        self.episodes = {}
+        # ids of live episodes for uniform episode sampling (swap remove)
+        self.episodeIds = []
+        self.episodePos = {}
+        self.protected = set()
+        # unprotected episodes in the order they were written (= eviction order)
+        self.ring = deque()
+        self.meanRewards = {}
+        # random stream for sampling: a seed's own RandomState, or None for np.random
+        self.rng = None
+
+    def _allocate(self, obs, act, capacity):
+        self.capacity = capacity
+        self.obs = np.zeros([capacity] + list(obs.shape[1:]), dtype=obs.dtype)
+        self.actions = np.zeros([capacity] + list(act.shape[1:]), dtype=act.dtype)
+        self.nextobs = np.zeros_like(self.obs)
+        self.knowns = np.zeros([capacity] + list(obs.shape[1:]), dtype=np.float64)
+        self.nextknowns = np.zeros_like(self.knowns)
+        # obs || action for each row, the state pred features of one step
+        self.statefeats = np.zeros([capacity, obs.shape[1] + act.shape[1]], dtype=np.result_type(obs, act))
+        self.dones = np.zeros(capacity, dtype=np.float64)
+        self.rewards = np.zeros(capacity, dtype=np.float64)
+        # -1 marks rows with no live transition
+        self.episode_id = np.full(capacity, -1, dtype=np.int64)
+        self.step_idx = np.zeros(capacity, dtype=np.int32)
+
+    def _grow(self, capacity):
+        old = self.capacity
+        for name in ["obs", "actions", "nextobs", "knowns", "nextknowns", "statefeats", "dones", "rewards", "step_idx"]:
+            arr = getattr(self, name)
+            grown = np.zeros([capacity] + list(arr.shape[1:]), dtype=arr.dtype)
+            grown[:old] = arr
+            setattr(self, name, grown)
+        self.episode_id = np.concatenate([self.episode_id, np.full(capacity - old, -1, dtype=np.int64)])
+        self.capacity = capacity
+
+    def _evict(self, episode):
+        row, length = self.episodes.pop(episode)
+        self.episode_id[row:row + length] = -1
+        self.count -= length
+        pos = self.episodePos.pop(episode)
+        last = self.episodeIds.pop()
+        if last != episode:
+            self.episodeIds[pos] = last
+            self.episodePos[last] = pos
+        self.meanRewards.pop(episode)
+
+    def _evictOldest(self):
+        # skip ids already evicted by being overwritten
+        while len(self.ring) > 0 and self.ring[0] not in self.episodes:
+            self.ring.popleft()
+        if len(self.ring) == 0:
+            return False
+        self._evict(self.ring.popleft())
+        return True
 
     def setCutoff(self):
-        self.cutoff = len(self.els)
+        # protect everything stored so far, moving it to the front of the arrays if the ring wrapped
+        rows = [(row, length) for row, length in self.episodes.values()]
+        if (len(rows) > 0 and rows[0][0] != 0) or any(rows[i][0] + rows[i][1] != rows[i + 1][0] for i in range(len(rows) - 1)):
+            order = np.concatenate([np.arange(row, row + length) for row, length in rows])
+            for name in ["obs", "actions", "nextobs", "knowns", "nextknowns", "statefeats", "dones", "rewards", "episode_id", "step_idx"]:
+                arr = getattr(self, name)
+                arr[:len(order)] = arr[order]
+            self.episode_id[len(order):] = -1
+            row = 0
+            for episode, (start, length) in list(self.episodes.items()):
+                self.episodes[episode] = (row, length)
+                row += length
+        self.cutoffRow = self.count
+        self.head = self.count
+        self.filled = self.count
+        self.protected = set(self.episodes.keys())
+        self.ring.clear()
 
     def addElement(self, obs, act, rew, dones, knownses):
-        e = Trajectory(obs, act, rew, dones, knownses)
-        self.els.append(e)
-        self.count += e.length
-
-        if len(self.splits) > 0:
-            self.splits.append(self.splits[-1] + len(act))
-        else: 
-            self.splits.append(len(act))
-        if self.count > self.n:
-            temp = self.els.pop(self.cutoff)
-            self.splits.pop(self.cutoff)
-            self.count -= temp.length
-            tempSplits = self.splits[self.cutoff:]
-            tempSplits = list(map(lambda x: x - temp.length, tempSplits))
-            self.splits[self.cutoff:] = tempSplits
-
-    def sample(self, size):
-        idxs = np.random.choice(self.count, size, replace = size>self.count)
-        idxs = sorted(idxs)
-        i = 0
-        toReturn = []
-        for idx in idxs:
-            while (idx >= self.splits[i]):
-                i += 1
-            if i == 0:
-                offset = 0
-            else:
-                offset = self.splits[i - 1]
-            if (idx - offset) < 0:
-                print("ERRORR!!!!!!! Buffer index offset wrong")
-            toReturn.append(self.els[i].getElement(idx - offset))
-        return toReturn
-    
+        obs = np.stack(obs, axis=0)
+        act = np.stack(act, axis=0)
+        dones = np.stack(dones, axis=0)
+        knownses = np.stack(knownses, axis=0)
+        rew = np.stack(rew, axis=0)
+        if len(obs) != len(act) + 1 != len(dones) != len(knownses) != len(rew) + 1:
+            print("ERROR IN BUFFER STORAGE")
+        length = len(act)
+        if self.capacity == 0:
+            self._allocate(obs, act, self.n + 64)
+        # wrap the ring if the episode does not fit before the end of the arrays
+        if self.head + length > self.capacity:
+            self.filled = max(self.filled, self.head)
+            self.head = self.cutoffRow
+            if self.head + length > self.capacity:
+                self._grow(self.head + length)
+        # evict whatever is stored where this episode goes
+        for episode in np.unique(self.episode_id[self.head:self.head + length]):
+            if episode >= 0:
+                self._evict(int(episode))
+        rows = slice(self.head, self.head + length)
+        self.obs[rows] = obs[:-1]
+        self.nextobs[rows] = obs[1:]
+        self.actions[rows] = act
+        self.knowns[rows] = knownses[:-1]
+        self.nextknowns[rows] = knownses[1:]
+        self.statefeats[rows] = np.concatenate([obs[:-1], act], axis=1)
+        self.dones[rows] = dones[1:]
+        self.rewards[rows] = rew[:length]
+        self.episode_id[rows] = self.nextEpisode
+        self.step_idx[rows] = np.arange(length)
+        self.episodes[self.nextEpisode] = (self.head, length)
+        self.episodePos[self.nextEpisode] = len(self.episodeIds)
+        self.episodeIds.append(self.nextEpisode)
+        self.ring.append(self.nextEpisode)
+        self.meanRewards[self.nextEpisode] = np.mean(rew)
+        self.nextEpisode += 1
+        self.count += length
+        self.head += length
+        self.filled = max(self.filled, self.head)
+        while self.count > self.n:
+            if not self._evictOldest():
+                break
+
+    def random(self):
+        return np.random if self.rng is None else self.rng
+
+    def sampleIndices(self, size):
+        # uniform over stored transitions, without replacement unless size > count (like np.random.choice)
+        live = np.flatnonzero(self.episode_id[:self.filled] >= 0)
+        return live[self.random().choice(len(live), size, replace = size>len(live))]
+
+    def sampleBatch(self, size):
+        # dict of [size, ...] tensors (random transitions, like sample)
+        idxs = self.sampleIndices(size)
+        batch = {
+            'obs': self.obs[idxs],
+            'actions': self.actions[idxs],
+            'nextobs': self.nextobs[idxs],
+            'dones': self.dones[idxs],
+            'knowns': self.knowns[idxs],
+            'nextknowns': self.nextknowns[idxs],
+            'rewards': self.rewards[idxs]}
+        for key in batch:
+            batch[key] = torch.from_numpy(batch[key]).float()
+        return batch
+
     def sampleSubSeqs(self, subLen, numSubs):
-        idxs = np.random.choice(len(self.els), numSubs, replace = numSubs>len(self.els))
-        toReturn = {}
-        # print(idxs, "!!")
-        for i in idxs:
-            temp = self.els[i].sample(subLen)
-            for key in temp.keys():
-                if key in toReturn:
-                    # print("HAS", i)
-                    # print(toReturn[key].shape)
-                    toReturn[key].append(temp[key])
-                else:
-                    # print("HASNOT", i)
-                    toReturn[key] = [temp[key]]
-                    # print(toReturn[key])
-        return toReturn
-    
+        # subLen transitions from each of numSubs random episodes, as [numSubs, subLen, ...] tensors
+        # rewards are the episodes' mean rewards [numSubs, 1], computed when they were added
+        idxs = self.random().choice(len(self.episodeIds), numSubs, replace = numSubs>len(self.episodeIds))
+        episodes = [self.episodeIds[i] for i in idxs]
+        starts = np.array([self.episodes[e][0] for e in episodes])
+        lengths = np.array([self.episodes[e][1] for e in episodes])
+        rows = starts[:, None] + subSeqOffsets(lengths, subLen, self.random())
+        batch = {
+            'obs': self.obs[rows],
+            'actions': self.actions[rows],
+            'nextobs': self.nextobs[rows],
+            'dones': self.dones[rows],
+            'knowns': self.knowns[rows],
+            'nextknowns': self.nextknowns[rows],
+            'rewards': np.array([[self.meanRewards[e]] for e in episodes])}
+        for key in batch:
+            batch[key] = torch.from_numpy(batch[key]).float()
+        return batch
+
     def sampleForStatePred(self, size):
-        idxs = np.random.choice(self.count, size, replace = size>self.count)
-        idxs = sorted(idxs)
-        i = 0
-        returnFeats, returnLabs, returnKnowns = [], [], []
-        for idx in idxs:
-            while (idx >= self.splits[i]):
-                i += 1
-            if i == 0:
-                offset = 0
-            else:
-                offset = self.splits[i - 1]
-            if (idx - offset) < 0:
-                print("ERRORR!!!!!!! Buffer index offset wrong")
-            tfeat, tlab, tknown = self.els[i].retrieveStateFeatures(idx - offset)
-            returnFeats.append(torch.tensor(tfeat))
-            returnLabs.append(tlab)
-            returnKnowns.append(tknown)
-        lengths = [len(feat) for feat in returnFeats]
+        # windows of the last (up to) context + 1 steps before each sampled transition, within its episode
+        # gathered with one fancy index into statefeats, zero after each window's length
+        idxs = self.sampleIndices(size)
+        lengths = np.minimum(self.step_idx[idxs], args.context) + 1
+        steps = np.arange(lengths.max())
+        valid = steps[None, :] < lengths[:, None]
+        rows = np.where(valid, (idxs - lengths + 1)[:, None] + steps[None, :], idxs[:, None])
+        feats = self.statefeats[rows] * valid[:, :, None]
+        labels = self.nextobs[idxs] - self.obs[idxs]
         # shape is (sequence, batch, features)
-        return torch.nn.utils.rnn.pad_sequence(returnFeats).float(), np.stack(returnLabs, axis=0), np.stack(returnKnowns, axis=0), lengths
+        feats = torch.from_numpy(np.ascontiguousarray(feats.transpose(1, 0, 2))).float()
+        return feats, labels, self.knowns[idxs], lengths.tolist()
 
 
 def layer_init(layer, bias_const=0.1):
@@ -216,6 +311,14 @@ class StateLSTMNetwork(nn.Module):
         output = F.relu(output)
         output = self.outlayer(output)
         return output
+
+    def step(self, x_t, state=None):
+        # advance one timestep, x_t is a single row [obs + action]
+        # returns (prediction if the sequence ended with x_t, new (h, c) state)
+        output, state = self.lstm(x_t.view(1, 1, -1), state)
+        output = F.relu(output[-1])
+        output = self.outlayer(output).squeeze(0)
+        return output, state
     
 # lstm network for predicting end questionnaire values
 class EndQLSTMNetwork(nn.Module):
@@ -240,6 +343,30 @@ class EndQLSTMNetwork(nn.Module):
         output = 2 * F.tanh(output)
         return output
 
+    # incremental version of forward for rows that end with the same state columns (DiabetesEnv.advance_endq):
+    #    the input projection of the history columns is computed once per row as the episode goes,
+    #    the state columns are projected once at the end and only the recurrence runs then
+
+    def project_history(self, x_hist):
+        # x_hist: [T, no. history columns], the inputs before the state in each row
+        # returns their part of the LSTM input projection, [T, 4 * hidden_size]
+        return x_hist @ self.lstm.weight_ih_l0[:, :x_hist.shape[-1]].t()
+
+    def finish(self, historyProj, state):
+        # forward() over the rows whose history columns project to historyProj [T, 4 * hidden_size]
+        #    and whose remaining columns are state in every row
+        w_ih, w_hh = self.lstm.weight_ih_l0, self.lstm.weight_hh_l0
+        gates = historyProj + (w_ih[:, w_ih.shape[1] - state.shape[-1]:] @ state + self.lstm.bias_ih_l0 + self.lstm.bias_hh_l0)
+        # the recurrence in the same fused kernel nn.LSTM uses, with the gates as input
+        #    (identity input weights, no biases)
+        zeros = torch.zeros(1, 1, self.hidden_size, device=gates.device)
+        identity = torch.eye(gates.shape[-1], device=gates.device)
+        output, H, C = torch.lstm(gates.unsqueeze(1), (zeros, zeros), [identity, w_hh], False, 1, 0.0, False, False, False)
+        output = F.relu(output[-1, 0])
+        output = self.outlayer(output)
+        output = 2 * F.tanh(output)
+        return output
+
 # simple neural network for predicting states (UNUSED in final experiments)
 class StateNNNetwork(nn.Module):
     def __init__(self, obs_shape, action_shape, hidden_size=256):
@@ -293,8 +420,9 @@ class Actor(nn.Module):
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
         temp = self.fc_mean_logdev(x)
-        mean = temp[:, :self.action_shape[0]]
-        logdev = temp[:, self.action_shape[0]:]
+        # last dim, so seed stacked inputs [seeds, batch, obs] work too
+        mean = temp[..., :self.action_shape[0]]
+        logdev = temp[..., self.action_shape[0]:]
         logdev = torch.clamp(logdev, -20, 2)
 
         return mean, logdev
@@ -329,7 +457,7 @@ class Actor(nn.Module):
         action = torch.tanh(samp)
         logprob = policy_dist.log_prob(samp)
         logprob -= torch.log((1 - action.pow(2)) + epsilon)
-        logprob = logprob.sum(1, keepdim=True)
+        logprob = logprob.sum(-1, keepdim=True)
         # print(samp.shape, action.shape, logprob.shape)
         # exit()
         return action, logdev, logprob
@@ -377,6 +505,68 @@ def getStateBelief(observations, knowns, acts=None, statepred: torch.nn.Module =
             observations[x] = latest
     return observations
 
+# getStateBelief for one rollout that keeps the state predictor's LSTM (h, c) between steps,
+# so each step is one LSTM step instead of a pass over the last context steps
+# same as getStateBelief for the first context steps of an episode, after that the carried
+# state also remembers steps older than the window
+# check: also compute the windowed belief, the largest differences (within / after the first context steps) are kept
+class BeliefTracker:
+    def __init__(self, statepred, check=False):
+        self.statepred = statepred
+        self.check = check
+        self.maxDiff = 0.0
+        self.maxDiffBeyond = 0.0
+        self.reset()
+
+    def reset(self):
+        self.state = None
+        self.steps = 0
+
+    def update(self, observations, knowns, acts):
+        # observations / acts: the episode so far, the newest (observation, action) pair is added to the state
+        x = torch.tensor(np.concatenate([observations[-1], acts[-1]], axis=-1)).float()
+        if args.cuda:
+            x = x.cuda()
+        with torch.no_grad():
+            pred, self.state = self.statepred.step(x, self.state)
+        toReturn = pred.cpu().numpy() + observations[-1]
+        self.steps += 1
+        if self.check:
+            start = min(args.context, len(observations))
+            with torch.no_grad():
+                windowed = getStateBelief(observations[-start:], knowns, acts[-start:], self.statepred)
+            diff = np.abs(windowed - toReturn).max()
+            if self.steps <= args.context:
+                self.maxDiff = max(self.maxDiff, diff)
+            else:
+                self.maxDiffBeyond = max(self.maxDiffBeyond, diff)
+        return toReturn
+
+def makeBeliefTracker(statepred):
+    # None when beliefs are computed with getStateBelief
+    if args.statepred and args.beliefCarry:
+        return BeliefTracker(statepred, args.checkBelief)
+    return None
+
+# getStateBelief for a batch of trajectories stepped together
+# observations / acts: lists (over time) of [batch, ...] arrays, knowns: [batch, obs]
+def getStateBeliefBatch(observations, knowns, acts=None, statepred: torch.nn.Module = None):
+    if args.statepred:
+        # [time, batch, obs + act], the batch dimension getStateBelief sets to 1
+        obsfeat = torch.tensor(np.concatenate([np.stack(observations), np.stack(acts)], axis=-1)).float()
+        if args.cuda:
+            obsfeat = obsfeat.cuda()
+        toReturn = statepred(obsfeat)
+        toReturn = toReturn.cpu().detach().numpy()
+        return toReturn + observations[-1]
+    # same fill as getStateBelief, for every row at once (also in place)
+    observations = observations[-1]
+    latest = observations[:, 0]
+    for x in range(1, observations.shape[1]):
+        latest = (knowns[:, x] * observations[:, x]) + ((1 - knowns[:, x]) * latest)
+        observations[:, x] = latest
+    return observations
+
 # set random seeds for reproducible results
 random.seed(args.seed)
 np.random.seed(args.seed)
@@ -561,46 +751,93 @@ for b in range(501):
 if args.keepRealData:
     buff.setCutoff()
 
+# seeds trained in this process, each gets its own copy of the (real data) buffer,
+# sampled with its own random stream, and its own environments
+seeds = [args.seed + k for k in range(args.numSeeds)]
+buffs = [buff]
+if args.numSeeds > 1:
+    buffs = [copy.deepcopy(buff) for seed in seeds]
+    for b, seed in zip(buffs, seeds):
+        b.rng = np.random.RandomState(seed)
+
 # set up test and train environments
-env = DiabetesEnv(startingStates, eqmodel, args.rewardStateDecay, args.endQPred)
-testenv = DiabetesEnv(startingStates, eqmodel, args.rewardStateDecay, args.endQPred)
+if args.numEnvs > 1:
+    env = VectorDiabetesEnv(startingStates, eqmodel, args.rewardStateDecay, args.endQPred, args.numEnvs, cuda=args.cuda, inferenceBackend=args.inferenceBackend, seed=args.seed, envId=0)
+else:
+    env = DiabetesEnv(startingStates, eqmodel, args.rewardStateDecay, args.endQPred, incrementalEndQ=args.incrementalEndQ, inferenceBackend=args.inferenceBackend, seed=args.seed, envId=0)
+# separate random streams for training and evaluation rollouts
+testenv = DiabetesEnv(startingStates, eqmodel, args.rewardStateDecay, args.endQPred, incrementalEndQ=args.incrementalEndQ, inferenceBackend=args.inferenceBackend, seed=args.seed, envId=1)
+if args.evalBatch:
+    testvenv = VectorDiabetesEnv(startingStates, eqmodel, args.rewardStateDecay, args.endQPred, 100, cuda=args.cuda, inferenceBackend=args.inferenceBackend, seed=args.seed, envId=1)
+envs = [env]
+testenvs = [testenv]
+testvenvs = [testvenv] if args.evalBatch else []
+for seed in seeds[1:]:
+    envs.append(DiabetesEnv(startingStates, eqmodel, args.rewardStateDecay, args.endQPred, incrementalEndQ=args.incrementalEndQ, inferenceBackend=args.inferenceBackend, seed=seed, envId=0))
+    testenvs.append(DiabetesEnv(startingStates, eqmodel, args.rewardStateDecay, args.endQPred, incrementalEndQ=args.incrementalEndQ, inferenceBackend=args.inferenceBackend, seed=seed, envId=1))
+    if args.evalBatch:
+        testvenvs.append(VectorDiabetesEnv(startingStates, eqmodel, args.rewardStateDecay, args.endQPred, 100, cuda=args.cuda, inferenceBackend=args.inferenceBackend, seed=seed, envId=1))
+
+# one network per seed: the network itself for a single seed,
+# otherwise the seeds' copies stacked along a leading seed dimension
+def seedNetwork(make):
+    networks = [make() for seed in seeds]
+    if len(networks) == 1:
+        return networks[0]
+    return stackModules(networks)
 
 # initialize all networks required for the reinforcement learning process
 action_shape = [4, 1]
 obs_shape = [22, 1]
-actor = Actor(obs_shape, action_shape)
-qf1 = SoftQNetwork(obs_shape, action_shape)
-qf2 = SoftQNetwork(obs_shape, action_shape)
-qf1_target = SoftQNetwork(obs_shape, action_shape)
-qf2_target = SoftQNetwork(obs_shape, action_shape)
-rrder = RRDModel(obs_shape, action_shape)
+actor = seedNetwork(lambda: Actor(obs_shape, action_shape))
+if args.ensembleSize > 0:
+    # all Q networks stacked in qf1 / qf1_target, there is no separate qf2
+    qf1 = EnsembleQNetwork(obs_shape[0] + action_shape[0], args.hiddenSize, args.ensembleSize)
+    qf2 = None
+    qf1_target = EnsembleQNetwork(obs_shape[0] + action_shape[0], args.hiddenSize, args.ensembleSize)
+    qf2_target = None
+else:
+    qf1 = seedNetwork(lambda: SoftQNetwork(obs_shape, action_shape))
+    qf2 = seedNetwork(lambda: SoftQNetwork(obs_shape, action_shape))
+    qf1_target = seedNetwork(lambda: SoftQNetwork(obs_shape, action_shape))
+    qf2_target = seedNetwork(lambda: SoftQNetwork(obs_shape, action_shape))
+qfs = [qf for qf in (qf1, qf2) if qf is not None]
+qf_targets = [qf for qf in (qf1_target, qf2_target) if qf is not None]
+rrder = seedNetwork(lambda: RRDModel(obs_shape, action_shape))
 if args.cuda:
     actor = actor.cuda()
-    qf1 = qf1.cuda()
-    qf1_target = qf1_target.cuda()
-    qf2 = qf2.cuda()
-    qf2_target = qf2_target.cuda()
+    for qf in qfs + qf_targets:
+        qf.cuda()
     rrder = rrder.cuda()
 # this experiment uses state prediction - initialize LSTM
-if (args.statepred):
-    if args.statemodel == "lstm":
-        # exit()
-        statepred = StateLSTMNetwork(obs_shape, action_shape)
-        statepred_target = StateLSTMNetwork(obs_shape, action_shape)
-        statepred_target.load_state_dict(statepred.state_dict())
-    if args.cuda:
-        statepred = statepred.cuda()
-        statepred_target = statepred_target.cuda()
-else:
-    statepred = None
-    statepred_target = None
+# (one per seed, not stacked: statepreds[0] / statepred_targets[0] are statepred / statepred_target)
+statepreds = []
+statepred_targets = []
+for seed in seeds:
+    if (args.statepred):
+        if args.statemodel == "lstm":
+            # exit()
+            statepred = StateLSTMNetwork(obs_shape, action_shape)
+            statepred_target = StateLSTMNetwork(obs_shape, action_shape)
+            statepred_target.load_state_dict(statepred.state_dict())
+        if args.cuda:
+            statepred = statepred.cuda()
+            statepred_target = statepred_target.cuda()
+    else:
+        statepred = None
+        statepred_target = None
+    statepreds.append(statepred)
+    statepred_targets.append(statepred_target)
+statepred = statepreds[0]
+statepred_target = statepred_targets[0]
 # disable gradient tracking for target networks
-for p1, p2 in zip(qf1_target.parameters(), qf2_target.parameters()):
-    p1.requires_grad = False
-    p2.requires_grad = False
+for qf in qf_targets:
+    for p in qf.parameters():
+        p.requires_grad = False
 # set up optimizer for alpha if we are learning it, otherwise, use static value
 if (args.alpha_lr > 0):
-    logalpha = torch.tensor(0).float()
+    # one value per seed when the seeds are stacked
+    logalpha = torch.zeros(args.numSeeds) if args.numSeeds > 1 else torch.tensor(0).float()
     logalpha.requires_grad = True
     alpha_opt = optim.Adam([logalpha], lr=args.alpha_lr)
     alpha = torch.exp(logalpha)
@@ -609,18 +846,31 @@ else:
 
 
 # ensure target network and training network alignment
-qf1_target.load_state_dict(qf1.state_dict())
-qf2_target.load_state_dict(qf2.state_dict())
+for qf, qf_target in zip(qfs, qf_targets):
+    qf_target.load_state_dict(qf.state_dict())
 # optimizers for each component of the RL model
-q_opt = optim.Adam(list(qf1.parameters()) + list(qf2.parameters()), lr=args.qlr)
+q_opt = optim.Adam([p for qf in qfs for p in qf.parameters()], lr=args.qlr)
 act_opt = optim.Adam(list(actor.parameters()), lr=args.actlr)
 rrd_opt = optim.Adam(list(rrder.parameters()), lr=3e-4)
 if args.statepred:
-    stateopt = optim.Adam(list(statepred.parameters()), lr=args.statelr)
+    stateopts = [optim.Adam(list(sp.parameters()), lr=args.statelr) for sp in statepreds]
+    stateopt = stateopts[0]
+# RRD and SAC update steps
+# (RRD gradients are never cleared here, as in the original training loop)
+learner = SACLearner(actor, qf1, qf2, qf1_target, qf2_target, rrder, q_opt, act_opt, rrd_opt, args.gamma, np.prod(action_shape),
+                     alpha, logalpha if args.alpha_lr > 0 else None, alpha_opt if args.alpha_lr > 0 else None,
+                     extraTargets=list(zip(statepred_targets, statepreds)) if args.statepred else [],
+                     device="cuda" if args.cuda else "cpu", compile=args.compileLearner, rrdZeroGrad=False,
+                     targetMembers=args.ensembleMin, actorMean=0 < args.ensembleMin < args.ensembleSize)
 
 # evaluate the policy (using on-policy actions)
 # for reporting purposes
-def evaluatePolicy(numRollouts=100):
+# policy / predictor default to actor / statepred, seedIdx: index of the seed whose test env to use
+# (multi seed runs pass each seed's policy and predictor)
+def evaluatePolicy(numRollouts=100, policy=None, predictor=None, seedIdx=0):
+    if policy is None:
+        policy, predictor = actor, statepred
+    evalEnv = testenvs[seedIdx]
     totalReward = 0
     totalLoss = 0
     obstrajs = []
@@ -631,23 +881,27 @@ def evaluatePolicy(numRollouts=100):
         episodicReward = 0
         episodicLoss = 0
         done = False
-        testobs = testenv.reset()
+        testobs = evalEnv.reset()
         knowns = np.ones_like(testobs)
         obsbuff = [testobs]
         actbuff = []
+        tracker = makeBeliefTracker(predictor)
         while not done:
             obsfeat = torch.tensor(testobs).float().unsqueeze(0)
             if args.cuda:
                 obsfeat = obsfeat.cuda()
-            testaction = actor.only_action(obsfeat, exploration=False)
+            testaction = policy.only_action(obsfeat, exploration=False)
             if args.cuda:
                 testaction = testaction.detach().cpu().numpy().squeeze()
             else:
                 testaction = testaction.detach().numpy().squeeze()
-            nextobsUn, knowns, testreward, done, percat = testenv.step(testaction)
+            nextobsUn, knowns, testreward, done, percat = evalEnv.step(testaction)
             actbuff.append(testaction)
-            start = min(args.context, len(obsbuff))
-            nextObsPred = getStateBelief(obsbuff[-start:], knowns, actbuff[-start:], statepred)
+            if tracker is not None:
+                nextObsPred = tracker.update(obsbuff, knowns, actbuff)
+            else:
+                start = min(args.context, len(obsbuff))
+                nextObsPred = getStateBelief(obsbuff[-start:], knowns, actbuff[-start:], predictor)
             testobs = (knowns * nextobsUn) + ((1 - knowns) * (nextObsPred))
             testObsIdxs = (1 - knowns) != 0
             # don't track timesteps where num hidden is 0 (first observation)
@@ -663,8 +917,8 @@ def evaluatePolicy(numRollouts=100):
         obstraj = np.stack(obsbuff, axis=0)
         acttraj = np.stack(actbuff, axis=0)
         acttraj = (acttraj + 1) / 2
-        acttraj[:, 0:2] = acttraj[:, 0:2] * testenv.maxMsgId
-        acttraj[:, 2:4] = acttraj[:, 2:4] * testenv.maxQId
+        acttraj[:, 0:2] = acttraj[:, 0:2] * evalEnv.maxMsgId
+        acttraj[:, 2:4] = acttraj[:, 2:4] * evalEnv.maxQId
         acttraj = np.ceil(acttraj).astype(int)
         totalLoss += episodicLoss / len(actbuff)
         if np.sum(percat) > 0:
@@ -679,13 +933,96 @@ def evaluatePolicy(numRollouts=100):
     # print(numImproved, partimp)
     return totalReward / numRollouts, totalLoss / numRollouts, np.stack(obstrajs, axis=0), np.stack(acttrajs, axis=0), partimp, numImproved/numRollouts
 
+# evaluatePolicy with all rollouts run together:
+# one batched actor forward and one batched behavior model forward per week
+# policy / predictor / seedIdx as in evaluatePolicy
+def evaluatePolicyBatch(numRollouts=100, policy=None, predictor=None, seedIdx=0):
+    if policy is None:
+        policy, predictor = actor, statepred
+    if testvenvs[seedIdx].numEnvs != numRollouts:
+        testvenvs[seedIdx] = VectorDiabetesEnv(startingStates, eqmodel, args.rewardStateDecay, args.endQPred, numRollouts, cuda=args.cuda, inferenceBackend=args.inferenceBackend, seed=seeds[seedIdx], envId=1)
+    testvenv = testvenvs[seedIdx]
+    testobs = testvenv.reset()
+    obsbuff = [testobs]
+    actbuff = []
+    episodicReward = np.zeros([numRollouts])
+    episodicLoss = np.zeros([numRollouts])
+    done = np.zeros([numRollouts], dtype=bool)
+    while not done.all():
+        obsfeat = torch.tensor(testobs).float()
+        if args.cuda:
+            obsfeat = obsfeat.cuda()
+        testaction = policy.only_action(obsfeat, exploration=False).detach().cpu().numpy()
+        nextobsUn, knowns, testreward, done, percat, nextStart = testvenv.step(testaction)
+        actbuff.append(testaction)
+        start = min(args.context, len(obsbuff))
+        nextObsPred = getStateBeliefBatch(obsbuff[-start:], knowns, actbuff[-start:], predictor)
+        testobs = (knowns * nextobsUn) + ((1 - knowns) * (nextObsPred))
+        hidden = (1 - knowns) != 0
+        numHidden = hidden.sum(axis=1)
+        # don't track timesteps where num hidden is 0 (first observation)
+        sqErr = np.where(hidden, (nextobsUn - nextObsPred) ** 2, 0).sum(axis=1)
+        episodicLoss += np.where(numHidden > 0, sqErr / np.maximum(numHidden, 1), 0)
+        obsbuff.append(testobs)
+        episodicReward += testreward
+    obstrajs = np.stack(obsbuff, axis=1)
+    acttrajs = np.stack(actbuff, axis=1)
+    acttrajs = (acttrajs + 1) / 2
+    acttrajs[:, :, 0:2] = acttrajs[:, :, 0:2] * testvenv.maxMsgId
+    acttrajs[:, :, 2:4] = acttrajs[:, :, 2:4] * testvenv.maxQId
+    acttrajs = np.ceil(acttrajs).astype(int)
+    totalLoss = np.sum(episodicLoss / len(actbuff))
+    numImproved = np.sum(np.sum(percat, axis=1) > 0)
+    # translate final category reward list to % of participants that improved
+    partimp = np.mean(np.where(percat > 0, 1, 0), axis=0)
+    return episodicReward.sum() / numRollouts, totalLoss / numRollouts, obstrajs, acttrajs, partimp, numImproved/numRollouts
+
+# one round of state prediction training (numBreaks minibatches from buff), returns the last minibatch loss
+def trainStatePred(buff, statepred, stateopt):
+    bsize = (args.train_batches * 256) // args.numBreaks
+    # loop to train each batch
+    for x in range(args.numBreaks):
+        # ----------------------
+        # train state prediction network
+        # ----------------------
+
+        feats, labels, mask, lengths = buff.sampleForStatePred(bsize)
+        feats = torch.nn.utils.rnn.pack_padded_sequence(feats, lengths, enforce_sorted=False)
+        labels = torch.tensor(labels).float()
+        mask = torch.tensor(mask).bool()
+        mask[maxSId - 1:] = 0
+        if args.cuda:
+            feats = feats.cuda()
+            labels = labels.cuda()
+            mask = mask.cuda()
+        preds = statepred(feats)
+
+        # EXCLUDE STATIC (demographic) STATE FEATURES FROM LOSS!!
+        preds = preds[:, :maxSId]
+        labels = labels[:, :maxSId]
+        mask = mask[:, maxSId]
+
+        # exclude unobserved components from loss
+        preds = preds[mask]
+        labels = labels[mask]
+        # compute MSE
+        statePredLoss = (preds - labels) ** 2
+        statePredLoss = statePredLoss.mean()
+        stateopt.zero_grad()
+        statePredLoss.backward()
+        # clip gradient values to smooth out training process
+        # probably not necessary in this domain
+        nn.utils.clip_grad_value_(statepred.parameters(), 1.0)
+        stateopt.step()
+    return statePredLoss
+
 # set up directories to save information over the course of training
 statestr = ''
 if args.statepred:
     statestr = args.statemodel
     statestr += '/'
 # avoid file system access collisions by only having one seed try to create folders
-if (args.logging and args.seed == 1):
+if (args.logging and 1 in seeds):
     if not os.path.exists(f"./saved_mdiabetes_rl/{statestr}rewards"):
         os.makedirs(f"./saved_mdiabetes_rl/{statestr}rewards")
     if not os.path.exists(f"./saved_mdiabetes_rl/{statestr}actloss"):
@@ -701,14 +1038,118 @@ if (args.logging and args.seed == 1):
     if not os.path.exists(f"./saved_mdiabetes_rl/{statestr}trajlog"):
         os.makedirs(f"./saved_mdiabetes_rl/{statestr}trajlog")
 
-# empty lists to track information over training process
-rewardList = []
-catImproveList = []
-testStateLossList = []
-qflosslist = []
-actlosslist = []
-rrdlosslist = []
-statelosslist = []
+# results of one seed over the training process, printed and (if logging) saved to
+# ./saved_mdiabetes_rl/{statemodel}<kind>/{fname} files named by the seed
+class RunLog:
+    def __init__(self, seed):
+        self.seed = seed
+        self.fname = f"{seed}H{args.hiddenSize}LR{args.qlr}EQ{args.endQPred}.csv"
+        # empty lists to track information over training process
+        self.rewardList = []
+        self.testStateLossList = []
+        self.qflosslist = []
+        self.actlosslist = []
+        self.rrdlosslist = []
+        self.statelosslist = []
+
+    # record one evaluation (evaluatePolicy results) with the latest losses of this seed
+    # tracker / trainEnv: the seed's belief tracker (or None) and training env
+    def report(self, step, results, actloss, qfloss, rrdloss, alpha, statePredLoss, tracker, trainEnv):
+        testrew, testloss, obstraj, acttraj, partImp, totalImproved = results
+        self.rewardList.append(testrew)
+        # multi seed runs say which seed each line is for
+        prefix = f"Seed {self.seed}, " if args.numSeeds > 1 else ""
+        # print detailed information to stdout if training has started
+        if not actloss is None:
+            if args.statepred:
+                print(f"{prefix}Steps: {step * args.envSteps}, Time: {time.time() - starttime:.3f}s, Test rewards: {self.rewardList[-1]:.3f}, Actor loss: {actloss.item():.3e}, Q loss: {qfloss.item():.3e}, RRD loss: {rrdloss.item():.3e}, Alpha: {alpha:.3e}, StateLoss: {statePredLoss.item():.3e}, Test StateLoss: {testloss:.3e}")
+                # if (args.cuda):
+                #     print(f"GPU: {torch.cuda.max_memory_allocated(device=None)}")
+            else:
+                print(f"{prefix}Steps: {step * args.envSteps}, Time: {time.time() - starttime:.3f}s, Test rewards: {self.rewardList[-1]:.3f}, Actor loss: {actloss.item():.3e}, Q loss: {qfloss.item():.3e}, RRD loss: {rrdloss.item():.3e}, Alpha: {alpha:.3e}")  
+        else:
+            # otherwise, just print current test environment reward
+            print(f"{prefix}{self.rewardList[-1]}")
+        # largest difference between the carried and the windowed state beliefs so far
+        if tracker is not None and args.checkBelief:
+            print(f"{prefix}Carried vs windowed belief, max difference: {tracker.maxDiff:.3e} (first {args.context} steps), {tracker.maxDiffBeyond:.3e} (later steps)")
+        # behavior model call latency (ms) in the training simulator since the last report
+        # (with asyncSamplers the training env is never stepped, the samplers have their own)
+        if args.reportLatency and args.asyncSamplers == 0:
+            print(f"{prefix}Sim latency:", ", ".join([f"{k}: {v:.3f}ms" for k, v in trainEnv.inference.latency_percentiles().items()]))
+            trainEnv.inference.reset_latencies()
+        # record results to files if appropriate
+        if (args.logging):
+            if args.statepred:
+                statemodel = args.statemodel + "/"
+            else:
+                statemodel = ""
+            fname = self.fname
+            np.savetxt(f"./saved_mdiabetes_rl/{statemodel}rewards/{fname}", self.rewardList, delimiter="\n")
+            if not actloss is None:
+                self.actlosslist.append(actloss.item())
+                self.qflosslist.append(qfloss.item())
+                self.rrdlosslist.append(rrdloss.item())
+                if (args.statepred):
+                    self.testStateLossList.append(testloss)
+                    self.statelosslist.append(statePredLoss.item())
+
+                    np.savetxt(f"./saved_mdiabetes_rl/{statemodel}statepredtestloss/{fname}", self.testStateLossList, delimiter="\n")
+                    np.savetxt(f"./saved_mdiabetes_rl/{statemodel}statepredloss/{fname}", self.statelosslist, delimiter="\n")
+
+                np.savetxt(f"./saved_mdiabetes_rl/{statemodel}actloss/{fname}", self.actlosslist, delimiter="\n")
+                np.savetxt(f"./saved_mdiabetes_rl/{statemodel}qfloss/{fname}", self.qflosslist, delimiter="\n")
+                np.savetxt(f"./saved_mdiabetes_rl/{statemodel}rrdloss/{fname}", self.rrdlosslist, delimiter="\n")
+
+                weeklyobsmeans = np.mean(obstraj, axis=0)
+
+                weeklyobsstd = np.std(obstraj, axis=0)
+                mrowtotals = np.zeros([acttraj.shape[1], testenv.maxMsgId + 1], dtype=int)
+                qrowtotals = np.zeros([acttraj.shape[1], testenv.maxQId + 1], dtype=int)
+                for week in range(acttraj.shape[1]):
+                    for msgid in range(testenv.maxMsgId + 1):
+                        mrowtotals[week, msgid] = (acttraj[:, week, 0:2] == msgid).sum()
+                for week in range(acttraj.shape[1]):
+                    for qid in range(testenv.maxQId + 1):
+                        qrowtotals[week, qid] = (acttraj[:, week, 2:4] == qid).sum()
+                for w in range(acttraj.shape[1]):        
+                    with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/weekobsmean{w}{fname}", "a+") as f:
+                        np.savetxt(f, weeklyobsmeans[w], delimiter=', ', newline=", ")
+                        f.write("\n")
+                    with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/weekobsstd{w}{fname}", "a+") as f:
+                        np.savetxt(f, weeklyobsstd[w], delimiter=', ', newline=", ")
+                        f.write("\n")
+                    with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/weekmsgcount{w}{fname}", "a+") as f:
+                        np.savetxt(f, mrowtotals[w], delimiter=', ', newline=", ")
+                        f.write("\n")
+                    with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/weekqcount{w}{fname}", "a+") as f:
+                        np.savetxt(f, qrowtotals[w], delimiter=', ', newline=", ")
+                        f.write("\n")
+                with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/obsmeans{fname}", "a+") as f:
+                    np.savetxt(f, weeklyobsmeans.mean(axis=0), delimiter=', ', newline=", ")
+                    f.write("\n")
+                with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/obsstd{fname}", "a+") as f:
+                    np.savetxt(f, np.sqrt(np.square(weeklyobsstd).mean(axis=0)), delimiter=', ', newline=", ")
+                    f.write("\n")
+                with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/qcount{fname}", "a+") as f:
+                    np.savetxt(f, qrowtotals.sum(axis=0), delimiter=', ', newline=", ")
+                    f.write("\n")
+                with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/msgcount{fname}", "a+") as f:
+                    np.savetxt(f, mrowtotals.sum(axis=0), delimiter=', ', newline=", ")
+                    f.write("\n")
+                with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/partimp{fname}", "a+") as f:
+                    np.savetxt(f, partImp, delimiter=', ', newline=", ")
+                    f.write("\n")
+                with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/totalimp{fname}", "a+") as f:
+                    f.write(f"{totalImproved}\n")
+
+runLogs = [RunLog(seed) for seed in seeds]
+
+# value for seed k of a per seed loss / alpha tensor (stacked seeds), otherwise the value itself
+def seedValue(value, k):
+    if isinstance(value, torch.Tensor) and value.dim() > 0:
+        return value[k]
+    return value
 
 # initialize fields for current trajectory
 observation = env.reset()
@@ -719,11 +1160,156 @@ knowns = np.ones_like(observation)
 knownses = [knowns]
 rewards = []
 numSteps = 0
+if args.numEnvs > 1:
+    # one set of trajectory fields per simulated participant
+    # obsWindow / actWindow: the last context steps of all participants as [numEnvs, ...] arrays,
+    #    the rows of obs are views into obsWindow's arrays (getStateBeliefBatch fills them in place like getStateBelief)
+    obsWindow = deque([observation], maxlen=args.context)
+    actWindow = deque(maxlen=args.context)
+    obs = [[observation[i]] for i in range(args.numEnvs)]
+    acts = [[] for i in range(args.numEnvs)]
+    dones = [[0] for i in range(args.numEnvs)]
+    knownses = [[np.ones_like(observation[i])] for i in range(args.numEnvs)]
+    rewards = [[] for i in range(args.numEnvs)]
+if args.numSeeds > 1:
+    # one set of trajectory fields per seed, numSteps is the fewest transitions any seed has sampled
+    observation = [observation] + [e.reset() for e in envs[1:]]
+    obs = [[o] for o in observation]
+    acts = [[] for seed in seeds]
+    dones = [[0] for seed in seeds]
+    knownses = [[np.ones_like(o)] for o in observation]
+    rewards = [[] for seed in seeds]
+    seedSteps = [0 for seed in seeds]
+    # unstacked actor the seeds' policies are copied into for evaluation
+    evalActor = Actor(obs_shape, action_shape)
+    if args.cuda:
+        evalActor = evalActor.cuda()
 hiddenLeft = 0
 
 # mark losses as None for easier checking when printing results
 actloss = None
 qfloss = None
+rrdloss = None
+statePredLosses = [None for seed in seeds]
+
+# a batch from every seed's buffer (sample(buffer)), stacked along the seed dimension
+# (the batch itself for a single seed)
+def seedBatch(sample):
+    batches = [sample(b) for b in buffs]
+    if len(batches) == 1:
+        return batches[0]
+    return stackBatches(batches)
+
+# asynchronous sampling: sampler processes run their own env with a copy of the policy
+# and send finished trajectories to the learner (this process) through a queue
+# the policy is shared through shared memory tensors, copied under a lock and versioned
+def samplerWorker(workerId, sharedActor, sharedStatepred, policyVersion, trajQueue, stopEvent):
+    # samplers always run on the cpu, one thread each
+    args.cuda = False
+    torch.set_num_threads(1)
+    # forked workers inherit the learner's random state, give each its own exploration noise
+    # (seeded like its env, envId 2 + workerId)
+    torch.manual_seed(args.seed * 1000 + 2 + workerId)
+    np.random.seed(args.seed * 1000 + 2 + workerId)
+    workerEnv = DiabetesEnv(startingStates, eqmodel, args.rewardStateDecay, args.endQPred, incrementalEndQ=args.incrementalEndQ, inferenceBackend=args.inferenceBackend, seed=args.seed, envId=2 + workerId)
+    localActor = Actor(obs_shape, action_shape)
+    localStatepred = None
+    if sharedStatepred is not None:
+        localStatepred = StateLSTMNetwork(obs_shape, action_shape)
+    version = -1
+    tracker = makeBeliefTracker(localStatepred)
+    while not stopEvent.is_set():
+        # pick up the newest broadcast policy
+        if policyVersion.value != version:
+            with policyVersion.get_lock():
+                version = policyVersion.value
+                localActor.load_state_dict(sharedActor.state_dict())
+                if localStatepred is not None:
+                    localStatepred.load_state_dict(sharedStatepred.state_dict())
+        # one full trajectory, same as the synchronous loop
+        observation = workerEnv.reset()
+        if tracker is not None:
+            tracker.reset()
+        obs = [observation]
+        acts = []
+        dones = [0]
+        knownses = [np.ones_like(observation)]
+        rewards = []
+        done = False
+        with torch.no_grad():
+            while not done:
+                action = localActor.only_action(torch.tensor(observation).float().unsqueeze(0))
+                action = action.detach().numpy().squeeze()
+                nextObs, knowns, reward, done, percat = workerEnv.step(action)
+                acts.append(action)
+                if tracker is not None:
+                    nextObsPred = tracker.update(obs, knowns, acts)
+                else:
+                    start = min(args.context, len(obs))
+                    nextObsPred = getStateBelief(obs[-start:], knowns, acts[-start:], localStatepred)
+                observation = (knowns * nextObs) + ((1 - knowns) * (nextObsPred))
+                knownses.append(knowns)
+                rewards.append(reward)
+                obs.append(observation)
+                dones.append(0)
+        # bounded queue, keep checking for shutdown while the learner is behind
+        while not stopEvent.is_set():
+            try:
+                trajQueue.put((version, obs, acts, rewards, dones, knownses), timeout=1)
+                break
+            except queue.Full:
+                continue
+
+def broadcastPolicy():
+    # copy the learner's policy into the shared modules the samplers read
+    with policyVersion.get_lock():
+        with torch.no_grad():
+            for shared, module in [(sharedActor, actor), (sharedStatepred, statepred_target)]:
+                if shared is None:
+                    continue
+                weights = module.state_dict()
+                for name, w in shared.state_dict().items():
+                    w.copy_(weights[name])
+        policyVersion.value += 1
+
+def receiveTrajectories(wait):
+    # add every finished trajectory to the replay buffer, returns (no. steps added, no. dropped)
+    # wait: block until at least one trajectory arrives
+    added = 0
+    dropped = 0
+    while True:
+        try:
+            version, tobs, tacts, trewards, tdones, tknownses = trajQueue.get(timeout=60) if (wait and added == 0) else trajQueue.get_nowait()
+        except queue.Empty:
+            break
+        # staleness bound
+        if policyVersion.value - version > args.maxPolicyLag:
+            dropped += 1
+            continue
+        buff.addElement(tobs, tacts, trewards, tdones, tknownses)
+        added += len(tacts)
+    return added, dropped
+
+if args.asyncSamplers > 0:
+    ctx = mp.get_context("fork")
+    sharedActor = Actor(obs_shape, action_shape).share_memory()
+    sharedStatepred = StateLSTMNetwork(obs_shape, action_shape).share_memory() if args.statepred else None
+    policyVersion = ctx.Value('i', -1)
+    trajQueue = ctx.Queue(maxsize=4 * args.asyncSamplers)
+    stopEvent = ctx.Event()
+    broadcastPolicy()
+    samplers = [ctx.Process(target=samplerWorker, args=(w, sharedActor, sharedStatepred, policyVersion, trajQueue, stopEvent), daemon=True)
+                for w in range(args.asyncSamplers)]
+    for sampler in samplers:
+        sampler.start()
+    numDropped = 0
+
+# incremental state beliefs for the single env sampling loop
+beliefTracker = None
+if args.numEnvs <= 1 and args.asyncSamplers == 0:
+    beliefTracker = makeBeliefTracker(statepred_target)
+# one per seed (beliefTrackers[0] is beliefTracker)
+beliefTrackers = [beliefTracker] + [makeBeliefTracker(t) for t in statepred_targets[1:]]
 
 # keep track of total runtime
 starttime = time.time()
@@ -731,88 +1317,136 @@ starttime = time.time()
 # overall loop for entire training process
 for step in range(int(args.numSteps)):
     # loop for sampling steps from the environment
-    for envStep in range(args.envSteps):
-        with torch.no_grad():
-            obsfeat = torch.tensor(observation).float().unsqueeze(0)
-            if args.cuda:
-                obsfeat = obsfeat.cuda()
-            if (envStep % 100) == 55 and step % 10 == 1:
-                # print(obsfeat.max())
-                None
-            action = actor.only_action(obsfeat)
-            if args.cuda:
-                action = action.cpu().detach().numpy().squeeze()
-            else:
-                action = action.detach().numpy().squeeze()
-            nextObs, knowns, reward, done, percat = env.step(action)
-            acts.append(action)
-            start = min(args.context, len(obs))
-            # compute state belief using raw observation, previous observation(s), and "knowns" mask
-            nextObsPred = getStateBelief(obs[-start:], knowns, acts[-start:], statepred_target)
-            observation = (knowns * nextObs) + ((1 - knowns) * (nextObsPred))
-            knownses.append(knowns)
-            rewards.append(reward)
-            obs.append(observation)
-            # trajectory has reached end state 
-            # record results in replay buffer, and reset environment
-            if done:
-                # as this domain exclusively uses timestep termination,
-                # we always indicate that this is NOT a real terminal state
-                # in SAC, REAL terminal states indicate that the agent's actions
-                # led to the termination of the trajectory (eg robot breaking)
-                dones.append(0)
-                buff.addElement(obs, acts, rewards, dones, knownses)
-                numSteps += len(acts)
-                # init
-                observation = env.reset()
-                obs = [observation]
-                acts = []
-                dones = [0]
-                knowns = np.ones_like(observation)
-                knownses = [knowns]
-                rewards = []
-                hiddenLeft = 0
-            else:
-                dones.append(0)
+    if args.asyncSamplers > 0:
+        if step % args.broadcastEvery == 0:
+            broadcastPolicy()
+        # train on whatever the samplers have finished, only wait for data before learning starts
+        added, dropped = receiveTrajectories(numSteps < args.startLearning)
+        numSteps += added
+        numDropped += dropped
+    elif args.numEnvs > 1:
+        # every env step gives one transition per simulated participant
+        for envStep in range(args.envSteps // args.numEnvs):
+            with torch.no_grad():
+                obsfeat = torch.tensor(observation).float()
+                if args.cuda:
+                    obsfeat = obsfeat.cuda()
+                action = actor.only_action(obsfeat).cpu().detach().numpy()
+                nextObs, knowns, reward, done, percat, nextStart = env.step(action)
+                # the participants start and finish their episodes together,
+                #    so their windows have the same length and one call gives every belief
+                actWindow.append(action)
+                nextObsPred = getStateBeliefBatch(list(obsWindow), knowns, list(actWindow), statepred_target)
+                observation = (knowns * nextObs) + ((1 - knowns) * (nextObsPred))
+                obsWindow.append(observation)
+                for i in range(args.numEnvs):
+                    acts[i].append(action[i])
+                    knownses[i].append(knowns[i])
+                    rewards[i].append(reward[i])
+                    obs[i].append(observation[i])
+                    # never a real terminal state (see single env loop below)
+                    dones[i].append(0)
+                    if done[i]:
+                        buff.addElement(obs[i], acts[i], rewards[i], dones[i], knownses[i])
+                        numSteps += len(acts[i])
+                        # env already reset this participant
+                        obs[i] = [nextStart[i]]
+                        acts[i] = []
+                        dones[i] = [0]
+                        knownses[i] = [np.ones_like(nextStart[i])]
+                        rewards[i] = []
+                if done.any():
+                    observation = nextStart
+                    obsWindow = deque([observation], maxlen=args.context)
+                    actWindow.clear()
+    elif args.numSeeds > 1:
+        # every seed steps its own env, actions for all seeds from one stacked actor forward
+        for envStep in range(args.envSteps):
+            with torch.no_grad():
+                obsfeat = torch.tensor(np.stack(observation)).float().unsqueeze(1)
+                if args.cuda:
+                    obsfeat = obsfeat.cuda()
+                action = actor.only_action(obsfeat).cpu().detach().numpy()[:, 0]
+                for k in range(args.numSeeds):
+                    nextObs, knowns, reward, done, percat = envs[k].step(action[k])
+                    acts[k].append(action[k])
+                    if beliefTrackers[k] is not None:
+                        nextObsPred = beliefTrackers[k].update(obs[k], knowns, acts[k])
+                    else:
+                        start = min(args.context, len(obs[k]))
+                        nextObsPred = getStateBelief(obs[k][-start:], knowns, acts[k][-start:], statepred_targets[k])
+                    observation[k] = (knowns * nextObs) + ((1 - knowns) * (nextObsPred))
+                    knownses[k].append(knowns)
+                    rewards[k].append(reward)
+                    obs[k].append(observation[k])
+                    # never a real terminal state (see single env loop below)
+                    dones[k].append(0)
+                    if done:
+                        buffs[k].addElement(obs[k], acts[k], rewards[k], dones[k], knownses[k])
+                        seedSteps[k] += len(acts[k])
+                        observation[k] = envs[k].reset()
+                        if beliefTrackers[k] is not None:
+                            beliefTrackers[k].reset()
+                        obs[k] = [observation[k]]
+                        acts[k] = []
+                        dones[k] = [0]
+                        knownses[k] = [np.ones_like(observation[k])]
+                        rewards[k] = []
+        numSteps = min(seedSteps)
+    else:
+        for envStep in range(args.envSteps):
+            with torch.no_grad():
+                obsfeat = torch.tensor(observation).float().unsqueeze(0)
+                if args.cuda:
+                    obsfeat = obsfeat.cuda()
+                if (envStep % 100) == 55 and step % 10 == 1:
+                    # print(obsfeat.max())
+                    None
+                action = actor.only_action(obsfeat)
+                if args.cuda:
+                    action = action.cpu().detach().numpy().squeeze()
+                else:
+                    action = action.detach().numpy().squeeze()
+                nextObs, knowns, reward, done, percat = env.step(action)
+                acts.append(action)
+                # compute state belief using raw observation, previous observation(s), and "knowns" mask
+                if beliefTracker is not None:
+                    nextObsPred = beliefTracker.update(obs, knowns, acts)
+                else:
+                    start = min(args.context, len(obs))
+                    nextObsPred = getStateBelief(obs[-start:], knowns, acts[-start:], statepred_target)
+                observation = (knowns * nextObs) + ((1 - knowns) * (nextObsPred))
+                knownses.append(knowns)
+                rewards.append(reward)
+                obs.append(observation)
+                # trajectory has reached end state 
+                # record results in replay buffer, and reset environment
+                if done:
+                    # as this domain exclusively uses timestep termination,
+                    # we always indicate that this is NOT a real terminal state
+                    # in SAC, REAL terminal states indicate that the agent's actions
+                    # led to the termination of the trajectory (eg robot breaking)
+                    dones.append(0)
+                    buff.addElement(obs, acts, rewards, dones, knownses)
+                    numSteps += len(acts)
+                    # init
+                    observation = env.reset()
+                    if beliefTracker is not None:
+                        beliefTracker.reset()
+                    obs = [observation]
+                    acts = []
+                    dones = [0]
+                    knowns = np.ones_like(observation)
+                    knownses = [knowns]
+                    rewards = []
+                    hiddenLeft = 0
+                else:
+                    dones.append(0)
     # check if it is time to start training the RL models
     if (numSteps) >= args.startLearning:
-        # train state prediction model
+        # train state prediction model (each seed's own)
         if args.statepred:
-            bsize = (args.train_batches * 256) // args.numBreaks
-            # loop to train each batch
-            for x in range(args.numBreaks):
-                # ----------------------
-                # train state prediction network
-                # ----------------------
-
-                feats, labels, mask, lengths = buff.sampleForStatePred(bsize)
-                feats = torch.nn.utils.rnn.pack_padded_sequence(feats, lengths, enforce_sorted=False)
-                labels = torch.tensor(labels).float()
-                mask = torch.tensor(mask).bool()
-                mask[maxSId - 1:] = 0
-                if args.cuda:
-                    feats = feats.cuda()
-                    labels = labels.cuda()
-                    mask = mask.cuda()
-                preds = statepred(feats)
-
-                # EXCLUDE STATIC (demographic) STATE FEATURES FROM LOSS!!
-                preds = preds[:, :maxSId]
-                labels = labels[:, :maxSId]
-                mask = mask[:, maxSId]
-                
-                # exclude unobserved components from loss
-                preds = preds[mask]
-                labels = labels[mask]
-                # compute MSE
-                statePredLoss = (preds - labels) ** 2
-                statePredLoss = statePredLoss.mean()
-                stateopt.zero_grad()
-                statePredLoss.backward()
-                # clip gradient values to smooth out training process
-                # probably not necessary in this domain
-                nn.utils.clip_grad_value_(statepred.parameters(), 1.0)
-                stateopt.step()
+            statePredLosses = [trainStatePred(buffs[k], statepreds[k], stateopts[k]) for k in range(args.numSeeds)]
         # train reward redistribution, actor, and critic networks
         for trainstep in range(args.train_batches):
             # 1 update here for every environment step
@@ -821,225 +1455,38 @@ for step in range(int(args.numSteps)):
             # train RRD network
             # ----------------------
 
-            # sample from replay buffer, extract individual components
-            samples = buff.sampleSubSeqs(64, 4)
-            obSamp = np.array(samples['obs'])
-            actSamp = np.array(samples['actions'])
-            if len(actSamp.shape) < len(obSamp.shape):
-                actSamp = np.expand_dims(actSamp, -1)
-            ob2Samp = np.array(samples['nextobs'])
-            rewSamp = np.array(samples['rewards'])
-            knownSamp = np.array(samples['knowns'])
-            known2Samp = np.array(samples['nextknowns'])
-
-            # create features for the reward redistribution model
-            feats = torch.tensor(np.concatenate((obSamp, actSamp, obSamp - ob2Samp), axis=-1)).float()
-            if args.cuda:
-                feats = feats.cuda()
-            rHat = rrder(feats).squeeze(-1)
-            # sum predicted rewards, per episode
-            episodicSums = torch.mean(rHat, dim=-1, keepdim=True)
-            rewTens = torch.tensor(rewSamp).float()
-            if args.cuda:
-                rewTens = rewTens.cuda()
-            rrdloss = F.mse_loss(episodicSums, rewTens)
-            rrdloss.backward()
-            rrd_opt.step()
-
-            # ----------------------
-            # train Q-value networks
-            # ----------------------
-
-            samples = buff.sample(256)
-
-            obSamp = np.array([samp['obs'] for samp in samples])
-            actSamp = np.array([samp['actions'] for samp in samples])
-            if len(actSamp.shape) < len(obSamp.shape):
-                actSamp = np.expand_dims(actSamp, -1)
-            nextObsSamp = np.array([samp['nextobs'] for samp in samples])
-            donesSamp = torch.tensor([samp['dones'] for samp in samples]).float().unsqueeze(-1)
-            if args.cuda:
-                donesSamp = donesSamp.cuda()
-            knownSamp = np.array([samp['knowns'] for samp in samples])
-            nextKnownSamp = np.array([samp['nextknowns'] for samp in samples])
-
-            # no gradients required for this part
-            with torch.no_grad():
-                # set up features for reward redistribution network
-                feats = torch.tensor(np.concatenate((obSamp, actSamp, obSamp - nextObsSamp), axis=-1)).float()
-                # features for actor network
-                obsfeats = torch.tensor(nextObsSamp).float()
-                if(args.cuda):
-                    feats = feats.cuda()
-                    obsfeats = obsfeats.cuda()
-                rHat = rrder(feats)
-                # sample new action at current observation based on current policy (with exploration)
-                nextActions, logdev, logprob = actor.get_action(obsfeats, debug=False, exploration=True)
-                nextFeats = torch.concat([obsfeats, nextActions], dim=-1).float()
-                if args.cuda:
-                    nextFeats = nextFeats.cuda()
-                # use target networks to calculate the target q value for this new action
-                qtarg1 = qf1_target(nextFeats)
-                qtarg2 = qf2_target(nextFeats)
-                qtargmin = torch.min(qtarg1, qtarg2) - (alpha * logprob)
-                qtarget = rHat + (args.gamma * (1 - donesSamp) * qtargmin)
-
-            # this part requires gradient
-
-            # create features for q value networks
-            feats = np.concatenate((obSamp, actSamp), axis=-1)
-            feats1 = torch.tensor(feats).float()
-            feats2 = torch.tensor(feats).float()
-            if args.cuda:
-                feats1 = feats1.cuda()
-                feats2 = feats2.cuda()
-            # compute q values using each network
-            qf1vals = qf1(feats1)
-            qf2vals = qf2(feats2)
-            # compute losses
-            qf1loss = F.mse_loss(qf1vals, qtarget)
-            qf2loss = F.mse_loss(qf2vals, qtarget)
-            # combine losses to allow for single backwards pass
-            qfloss = qf1loss + qf2loss
-            q_opt.zero_grad()
-            qfloss.backward()
-            q_opt.step()
-
-            # ----------------------
-            # train actor network
-            # ----------------------
-
-            # create features from observation
-            obsfeat = torch.tensor(obSamp).float()
-            if args.cuda:
-                obsfeat = obsfeat.cuda()
-            # sample action using exploration
-            actSamp, logdev, logprob = actor.get_action(obsfeat, debug=False, exploration=True)
-            # create features for computing Q value of the new action
-            feats = torch.concat((obsfeat, actSamp), dim=-1).float()
-            if args.cuda:
-                feats = feats.cuda()
-
-            # do NOT compute gradient w.r.t. q value networks
-            # however, we NEED the gradient to go THROUGH these networks
-            # to update the actor network
-            for p1, p2 in zip(qf1.parameters(), qf2.parameters()):
-                p1.requires_grad = False
-                p2.requires_grad = False
-            # compute q values from networks
-            qf1vals = qf1(feats)
-            qf2vals = qf2(feats)
-            # calculate actor loss based on alpha, logprob of the action, and the q value
-            actloss = torch.mean((alpha * logprob) - torch.min(qf1vals, qf2vals))
-            act_opt.zero_grad()
-            actloss.backward()
-            act_opt.step()
-            # re-enable gradients
-            for p1, p2 in zip(qf1.parameters(), qf2.parameters()):
-                p1.requires_grad = True
-                p2.requires_grad = True
+            # sample from replay buffer
+            rrdloss = learner.update_rrd(seedBatch(lambda b: b.sampleSubSeqs(64, 4)))
 
             # ----------------------
-            # update alpha, if appropriate
+            # train Q-value and actor networks (and alpha), then smoothly update target networks
             # ----------------------
 
-            if (args.alpha_lr > 0):
-                alpha_opt.zero_grad()
-                with torch.no_grad():
-                    multiplier = logprob - np.prod(action_shape)
-                aloss = -1.0*(torch.exp(logalpha) * multiplier).mean()
-                aloss.backward()
-                alpha_opt.step()
-                alpha = torch.exp(logalpha)
-
-            # smoothly update target networks at each iteration of the training algorithm
-            with torch.no_grad():
-                for qt1w, qf1w in zip(qf1_target.parameters(), qf1.parameters()):
-                    qt1w.data.copy_(0.995 * qt1w.data + (.005 * qf1w.data))
-                for qt2w, qf2w in zip(qf2_target.parameters(), qf2.parameters()):
-                    qt2w.data.copy_(0.995 * qt2w.data + (.005 * qf2w.data))
-
-                if args.statepred:
-                    for spt, sp in zip(statepred_target.parameters(), statepred.parameters()):
-                        spt.data.copy_(0.995 * spt.data + (.005 * sp.data))
+            qfloss, actloss = learner.update(seedBatch(lambda b: b.sampleBatch(256)))
+            alpha = learner.alpha
 
         # evaluate current policy and record results every 50 outer steps
         if (step % 50) == 0 or (step == args.numSteps - 1):
-            with torch.no_grad():
-                testrew, testloss, obstraj, acttraj, partImp, totalImproved = evaluatePolicy()
-                rewardList.append(testrew)
-            # print detailed information to stdout if training has started
-            if not actloss is None:
-                if args.statepred:
-                    print(f"Steps: {step * args.envSteps}, Time: {time.time() - starttime:.3f}s, Test rewards: {rewardList[-1]:.3f}, Actor loss: {actloss.item():.3e}, Q loss: {qfloss.item():.3e}, RRD loss: {rrdloss.item():.3e}, Alpha: {alpha:.3e}, StateLoss: {statePredLoss.item():.3e}, Test StateLoss: {testloss:.3e}")
-                    # if (args.cuda):
-                    #     print(f"GPU: {torch.cuda.max_memory_allocated(device=None)}")
-                else:
-                    print(f"Steps: {step * args.envSteps}, Time: {time.time() - starttime:.3f}s, Test rewards: {rewardList[-1]:.3f}, Actor loss: {actloss.item():.3e}, Q loss: {qfloss.item():.3e}, RRD loss: {rrdloss.item():.3e}, Alpha: {alpha:.3e}")  
-            else:
-                # otherwise, just print current test environment reward
-                print(rewardList[-1])
-            # record results to files if appropriate
-            if (args.logging):
-                if args.statepred:
-                    statemodel = args.statemodel + "/"
-                else:
-                    statemodel = ""
-                fname = f"{args.seed}H{args.hiddenSize}LR{args.qlr}EQ{args.endQPred}.csv"
-                np.savetxt(f"./saved_mdiabetes_rl/{statemodel}rewards/{fname}", rewardList, delimiter="\n")
-                if not actloss is None:
-                    actlosslist.append(actloss.item())
-                    qflosslist.append(qfloss.item())
-                    rrdlosslist.append(rrdloss.item())
-                    if (args.statepred):
-                        testStateLossList.append(testloss)
-                        statelosslist.append(statePredLoss.item())
-
-                        np.savetxt(f"./saved_mdiabetes_rl/{statemodel}statepredtestloss/{fname}", testStateLossList, delimiter="\n")
-                        np.savetxt(f"./saved_mdiabetes_rl/{statemodel}statepredloss/{fname}", statelosslist, delimiter="\n")
-
-                    np.savetxt(f"./saved_mdiabetes_rl/{statemodel}actloss/{fname}", actlosslist, delimiter="\n")
-                    np.savetxt(f"./saved_mdiabetes_rl/{statemodel}qfloss/{fname}", qflosslist, delimiter="\n")
-                    np.savetxt(f"./saved_mdiabetes_rl/{statemodel}rrdloss/{fname}", rrdlosslist, delimiter="\n")
-
-                    weeklyobsmeans = np.mean(obstraj, axis=0)
-
-                    weeklyobsstd = np.std(obstraj, axis=0)
-                    mrowtotals = np.zeros([acttraj.shape[1], testenv.maxMsgId + 1], dtype=int)
-                    qrowtotals = np.zeros([acttraj.shape[1], testenv.maxQId + 1], dtype=int)
-                    for week in range(acttraj.shape[1]):
-                        for msgid in range(testenv.maxMsgId + 1):
-                            mrowtotals[week, msgid] = (acttraj[:, week, 0:2] == msgid).sum()
-                    for week in range(acttraj.shape[1]):
-                        for qid in range(testenv.maxQId + 1):
-                            qrowtotals[week, qid] = (acttraj[:, week, 2:4] == qid).sum()
-                    for w in range(acttraj.shape[1]):        
-                        with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/weekobsmean{w}{fname}", "a+") as f:
-                            np.savetxt(f, weeklyobsmeans[w], delimiter=', ', newline=", ")
-                            f.write("\n")
-                        with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/weekobsstd{w}{fname}", "a+") as f:
-                            np.savetxt(f, weeklyobsstd[w], delimiter=', ', newline=", ")
-                            f.write("\n")
-                        with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/weekmsgcount{w}{fname}", "a+") as f:
-                            np.savetxt(f, mrowtotals[w], delimiter=', ', newline=", ")
-                            f.write("\n")
-                        with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/weekqcount{w}{fname}", "a+") as f:
-                            np.savetxt(f, qrowtotals[w], delimiter=', ', newline=", ")
-                            f.write("\n")
-                    with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/obsmeans{fname}", "a+") as f:
-                        np.savetxt(f, weeklyobsmeans.mean(axis=0), delimiter=', ', newline=", ")
-                        f.write("\n")
-                    with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/obsstd{fname}", "a+") as f:
-                        np.savetxt(f, np.sqrt(np.square(weeklyobsstd).mean(axis=0)), delimiter=', ', newline=", ")
-                        f.write("\n")
-                    with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/qcount{fname}", "a+") as f:
-                        np.savetxt(f, qrowtotals.sum(axis=0), delimiter=', ', newline=", ")
-                        f.write("\n")
-                    with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/msgcount{fname}", "a+") as f:
-                        np.savetxt(f, mrowtotals.sum(axis=0), delimiter=', ', newline=", ")
-                        f.write("\n")
-                    with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/partimp{fname}", "a+") as f:
-                        np.savetxt(f, partImp, delimiter=', ', newline=", ")
-                        f.write("\n")
-                    with open(f"./saved_mdiabetes_rl/{statemodel}trajlog/totalimp{fname}", "a+") as f:
-                        f.write(f"{totalImproved}\n")
\ No newline at end of file
+            for k in range(args.numSeeds):
+                policy = actor
+                if args.numSeeds > 1:
+                    # this seed's policy, copied out of the stacked actor
+                    loadMember(actor, k, evalActor)
+                    policy = evalActor
+                with torch.no_grad():
+                    if args.evalBatch:
+                        results = evaluatePolicyBatch(policy=policy, predictor=statepreds[k], seedIdx=k)
+                    else:
+                        results = evaluatePolicy(policy=policy, predictor=statepreds[k], seedIdx=k)
+                runLogs[k].report(step, results, seedValue(actloss, k), seedValue(qfloss, k), seedValue(rrdloss, k), seedValue(alpha, k),
+                                  statePredLosses[k], beliefTrackers[k], envs[k])
+
+# stop the sampler processes
+if args.asyncSamplers > 0:
+    stopEvent.set()
+    receiveTrajectories(False)
+    for sampler in samplers:
+        sampler.join(timeout=5)
+        if sampler.is_alive():
+            sampler.terminate()
+    print(f"Trajectories dropped as stale: {numDropped}")
@@ -96,37 +96,120 @@ class AdaptableLSTM(Base):
                 self.physicalLayer.weight.grad = None
                 self.physicalLayer.bias.grad = None
     
-    def forward(self, x):
-        if (self.splitModel):
-            return self.forward_split(x)
+    def causal_mask(self, length):
+        # boolean attention mask hiding future weeks (True = not allowed)
+        # cached per sequence length, built lazily so older pickled models still work
+        if not hasattr(self, "causalMasks"):
+            self.causalMasks = {}
+        if length not in self.causalMasks:
+            self.causalMasks[length] = torch.triu(torch.ones((length, length), dtype=torch.bool), diagonal=1)
+        return self.causalMasks[length]
 
+    def encode(self, x):
+        # Pass one sequence x [SEQ, input_size] thru the LSTM cell
+        #    (and the attention layer if enabled)
+        # returns [SEQ, hidden_size]
+        H0, C0 = self._init_hc()
+        output, (H,C) = self.lstm(x, (H0, C0))
+        output = self.normlayer(output)
+        if (self.transformer):
+            mask = self.causal_mask(x.shape[0]).to(output.device)
+            output = self.tlayer(output, src_mask=mask)
+        return output
+
+    def encode_batch(self, x, lengths):
+        # Batch first version of encode for many participants at once
+        # x:       padded sequences [BATCH, SEQ, input_size]
+        #          (eg torch.nn.utils.rnn.pad_sequence(seqs, batch_first=True))
+        # lengths: true length of each sequence
+        # returns [sum(lengths), hidden_size], one row per real week,
+        #    ordered participant by participant (same as stacking encode outputs)
+        lengths = torch.as_tensor(lengths, dtype=torch.long).cpu()
+        packed = nn.utils.rnn.pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+        output, (H,C) = self.lstm(packed)
+        output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=x.shape[1])
+        valid = torch.arange(x.shape[1]).unsqueeze(0) < lengths.unsqueeze(1)
+        valid = valid.to(output.device)
+        # normalize only real weeks so padding does not leak into batch statistics
+        normed = torch.zeros_like(output)
+        normed[valid] = self.normlayer(output[valid])
+        if (self.transformer):
+            mask = self.causal_mask(x.shape[1]).to(output.device)
+            normed = self.tlayer(normed, src_mask=mask, src_key_padding_mask=~valid)
+        return normed[valid]
+
+    def forward(self, x):
         # One forward pass of input vector/batch x
         # Pass x thru the LSTM cell, then pass output
         #    through each linear output layer for each
         #    response prediction. 
         # Then join predictions together as one vector
-        H0, C0 = self._init_hc()
-        output, (H,C) = self.lstm(x, (H0, C0))
-        output = self.normlayer(output)
+        return self.forward_heads(self.encode(x), x)
+
+    def forward_batch(self, x, lengths):
+        # forward pass for a padded batch of participants [BATCH, SEQ, input_size]
+        # output matches concatenating forward() over each participant
+        # (exactly in eval mode; in train mode BatchNorm statistics are pooled over the batch)
+        lengths = torch.as_tensor(lengths, dtype=torch.long).cpu()
+        valid = torch.arange(x.shape[1]).unsqueeze(0) < lengths.unsqueeze(1)
+        return self.forward_heads(self.encode_batch(x, lengths), x[valid.to(x.device)])
+
+    def init_state(self, batch=1):
+        # zero (h, c) state for batch participants, each [batch, hidden_size]
+        h0 = torch.zeros(batch, self.hidden_size, device=self.lstm.weight_ih_l0.device)
+        c0 = torch.zeros(batch, self.hidden_size, device=self.lstm.weight_ih_l0.device)
+        return h0, c0
+
+    def step(self, x_t, state=None):
+        # Incremental inference: advance the LSTM by one week
+        # x_t:   newest feature row, [input_size] for one participant
+        #        or [BATCH, input_size] for one row each of BATCH participants
+        # state: (h, c) returned by the previous call (None = start of history)
+        # returns ((pred, RvsNR), new state)
+        # BatchNorm always uses its running statistics here, so the predictions
+        #    match the last row of forward() over the full history in eval mode
         if (self.transformer):
-            mask = torch.zeros((x.shape[0], x.shape[0]))
-            for i in range(x.shape[0]):
-                for j in range(x.shape[0]):
-                    if (i < j):
-                        mask[i, j] = 1
-            mask = mask.bool()
-            output = self.tlayer(output, src_mask=mask)
-        # print(H, output)
+            raise ValueError("step is not available with transformer=True (it needs the full history), use forward")
+        if x_t.dim() < 2:
+            x_t = x_t.unsqueeze(0)
+        if state is None:
+            state = self.init_state(x_t.shape[0])
+        h, c = state
+        output, (h, c) = self.lstm(x_t.unsqueeze(0), (h.unsqueeze(0), c.unsqueeze(0)))
+        norm = self.normlayer
+        output = nn.functional.batch_norm(output.squeeze(0), norm.running_mean, norm.running_var,
+                                          norm.weight, norm.bias, False, 0.0, norm.eps)
+        return self.forward_heads(output, x_t), (h.squeeze(0), c.squeeze(0))
+
+    def head_layers(self):
+        # output layers used by forward_heads (non split model), in order
+        if (self.hierarchical == "Shared"):
+            layers = [self.fc_q1_2, self.fc_q1_1]
+            if (not self.splitWeeklyQuestions):
+                layers += [self.fc_q2_2, self.fc_q2_1]
+        else:
+            layers = [self.fc_q1]
+            if (not self.splitWeeklyQuestions):
+                layers.append(self.fc_q2)
+        return layers
+
+    def forward_heads(self, output, x):
+        # output layers applied to encoded rows output [ROWS, hidden_size]
+        # x holds the matching input rows (used for category features in split mode)
+        if (self.splitModel):
+            return self.forward_split(x, output)
         # [SEQ, hidden_size]
         RvsNR = None
         out = self.relu(output)
+        # raw output layer values, ordered as in head_layers
+        outs = self.head_outputs(out)
         if (self.regression):
             if (self.hierarchical == "Shared"):
-                RvsNR = self.fc_q1_1(out).softmax(-1)
-                classpreds = self.fc_q1_2(out).clamp(1, 3)
+                RvsNR = outs[1].softmax(-1)
+                classpreds = outs[0].clamp(1, 3)
                 if (not self.splitWeeklyQuestions):
-                    RvsNR = torch.cat([RvsNR, self.fc_q2_1(out).softmax(-1)], 0)
-                    classpreds = torch.cat([classpreds, self.fc_q2_2(out).clamp(1, 3)], 0)
+                    RvsNR = torch.cat([RvsNR, outs[3].softmax(-1)], 0)
+                    classpreds = torch.cat([classpreds, outs[2].clamp(1, 3)], 0)
                 # print(classpreds.shape, RvsNR.shape)
                 toReturn = torch.where((RvsNR[:, 0] > RvsNR[:, 1]).unsqueeze(-1), (RvsNR[:, 1]).unsqueeze(-1), classpreds)
                 # print(toReturn.shape)
@@ -138,52 +221,45 @@ class AdaptableLSTM(Base):
                 minClamp = 0
             else:
                 minClamp = 1
-            out_q1 = self.fc_q1(out).clamp(minClamp, 3)
+            out_q1 = outs[0].clamp(minClamp, 3)
             # [SEQ, output_size//2]
             if (self.splitWeeklyQuestions):
                 return out_q1, RvsNR
             else:
-                out_q2 = self.fc_q2(out).clamp(minClamp, 3)
+                out_q2 = outs[1].clamp(minClamp, 3)
                 # [SEQ, output_size//2]
                 return torch.cat([out_q1, out_q2],-1), RvsNR
 
         else:
             if (self.hierarchical == "Shared"):
-                RvsNR = self.fc_q1_1(out).softmax(-1)
-                classpreds = self.fc_q1_2(out).softmax(-1)
+                RvsNR = outs[1].softmax(-1)
+                classpreds = outs[0].softmax(-1)
                 if (not self.splitWeeklyQuestions):
-                    RvsNR = torch.cat([RvsNR, self.fc_q2_1(out).softmax(-1)], 0)
-                    classpreds = torch.cat([classpreds, self.fc_q2_2(out).softmax(-1)], 0)
+                    RvsNR = torch.cat([RvsNR, outs[3].softmax(-1)], 0)
+                    classpreds = torch.cat([classpreds, outs[2].softmax(-1)], 0)
                 toReturn = torch.cat([RvsNR[:, 0].unsqueeze(-1), (RvsNR[:, 1]).unsqueeze(-1) * classpreds], -1)
                 if (not self.splitWeeklyQuestions):
                     toReturn = torch.cat([toReturn[0:toReturn.shape[0] // 2], toReturn[toReturn.shape[0]:]], -1)
                 return toReturn, RvsNR
-            out_q1 = self.fc_q1(out).softmax(-1)
+            out_q1 = outs[0].softmax(-1)
             # [SEQ, output_size//2]
             if (self.splitWeeklyQuestions):
                 return out_q1, RvsNR
             else:
-                out_q2 = self.fc_q2(out).softmax(-1)
+                out_q2 = outs[1].softmax(-1)
                 # [SEQ, output_size//2]
                 return torch.cat([out_q1, out_q2],-1), RvsNR
 
-    def forward_split(self, x):
+    def forward_split(self, x, datas=None):
         # One forward pass of input vector/batch x
         # Pass x thru the LSTM cell, then pass output
         #    through each linear output layer for each
         #    response prediction. 
         # Then join predictions together as one vector
-        H0, C0 = self._init_hc()
-        datas, (H,C) = self.lstm(x, (H0, C0))
-        datas = self.normlayer(datas)
-        if (self.transformer):
-            mask = torch.zeros((x.shape[0], x.shape[0]))
-            for i in range(x.shape[0]):
-                for j in range(x.shape[0]):
-                    if (i < j):
-                        mask[i, j] = 1
-            mask = mask.bool()
-            datas = self.tlayer(datas, src_mask=mask)
+        if datas is None:
+            datas = self.encode(x)
+        if getattr(self, "fusedHeads", False):
+            return self.forward_split_grouped(x, datas)
         RvsNR = None
         if (self.regression):
             osize = 1
@@ -372,6 +448,39 @@ class AdaptableLSTM(Base):
             pred = torch.cat((pred[0:datas.shape[0]], pred[datas.shape[0]:]), dim = -1)
         return pred, RvsNR
     
+    def forward_split_grouped(self, x, datas):
+        # forward_split with all category layers evaluated as one matmul,
+        #    each row then keeps the output of its own category
+        categories = CategoryCodes(x[:, -1], x[:, -2])
+        if (not self.splitWeeklyQuestions):
+            # rows for weekly question 1 first, then weekly question 2
+            categories = torch.cat([CategoryCodes(x[:, -3], x[:, -4]), categories], 0)
+            datas = torch.cat([datas, datas], 0)
+        layers = [self.consumptionLayer, self.knowledgeLayer, self.physicalLayer]
+        if (self.hierarchical == "Shared"):
+            layers += [self.consumptionLayerRNR, self.knowledgeLayerRNR, self.physicalLayerRNR]
+        outs = FusedLinear(datas, layers)
+        pred = SelectGroup(torch.stack(outs[0:3]), categories)
+        if (self.regression):
+            if (self.no_response_class and (self.splitWeeklyQuestions or not self.hierarchical == "Shared")):
+                pred = pred.clamp(0, 3)
+            else:
+                pred = pred.clamp(1, 3)
+        else:
+            pred = pred.softmax(-1)
+        RvsNR = None
+        if (self.hierarchical == "Shared"):
+            RvsNR = SelectGroup(torch.stack(outs[3:6]), categories).softmax(-1)
+            if (self.regression):
+                pred = torch.where((RvsNR[:, 0] > RvsNR[:, 1]).unsqueeze(-1), RvsNR[:, 1].unsqueeze(-1), pred)
+            else:
+                pred = torch.cat([RvsNR[:, 0].unsqueeze(-1), pred * (RvsNR[:, 1].unsqueeze(-1))], -1)
+        if (not self.splitWeeklyQuestions):
+            # reshape to match single model output
+            rows = datas.shape[0] // 2
+            pred = torch.cat((pred[0:rows], pred[rows:]), dim = -1)
+        return pred, RvsNR
+
     def w1_reg(self, y):
         k = self.fc_q1.out_features
         y1 = y[:, :k]
@@ -37,43 +37,65 @@ class BasicNN(Base):
     def forward(self, x):
         output = self.inputLayer(x)
         out = self.relu(output)
+        return self.forward_heads(self.head_outputs(out))
+
+    def head_layers(self):
+        # output layers used by forward_heads, in order
+        if (self.hierarchical == "Shared"):
+            layers = [self.fc_q1, self.fc_q1RNR]
+            if (not self.splitWeeklyQuestions):
+                layers += [self.fc_q2, self.fc_q2RNR]
+        else:
+            layers = [self.fc_q1]
+            if (not (self.splitModel or self.splitWeeklyQuestions)):
+                layers.append(self.fc_q2)
+        return layers
+
+    def forward_heads(self, outs):
+        # turn raw output layer values (ordered as in head_layers) into predictions
         RvsNR = None
-        if (self.regression):
-            if (self.hierarchical == "Shared"):
-                RvsNR = self.fc_q1RNR(out).softmax(-1)
-                classpreds = self.relu(self.fc_q1(out)) + 1
+        if (self.hierarchical == "Shared"):
+            RvsNR = outs[1].softmax(-1)
+            if (self.regression):
+                classpreds = self.relu(outs[0]) + 1
                 if (not self.splitWeeklyQuestions):
-                    RvsNR = torch.cat([RvsNR, self.fc_q2RNR(out).softmax(-1)], 0)
-                    classpreds = torch.cat([classpreds, self.relu(self.fc_q2(out))], 0)
+                    RvsNR = torch.cat([RvsNR, outs[3].softmax(-1)], 0)
+                    classpreds = torch.cat([classpreds, self.relu(outs[2])], 0)
                 # print(classpreds.shape, RvsNR.shape)
                 toReturn = torch.where((RvsNR[:, 0] > RvsNR[:, 1]).unsqueeze(-1), (RvsNR[:, 1]).unsqueeze(-1), classpreds)
-                # print(toReturn.shape)
-                if (not self.splitWeeklyQuestions):
-                    toReturn = torch.cat([toReturn[0:toReturn.shape[0] // 2], toReturn[toReturn.shape[0]:]], -1)
-                return toReturn, RvsNR
-            out_q1 = self.relu(self.fc_q1(out))
-            if (self.splitModel or self.splitWeeklyQuestions):
-                return out_q1, RvsNR
             else:
-                out_q2 = self.relu(self.fc_q2(out))
-                return torch.cat([out_q1, out_q2],-1), RvsNR
-        else:
-            if (self.hierarchical == "Shared"):
-                RvsNR = self.fc_q1RNR(out).softmax(-1)
-                classpreds = self.fc_q1(out).softmax(-1)
+                classpreds = outs[0].softmax(-1)
                 if (not self.splitWeeklyQuestions):
-                    RvsNR = torch.cat([RvsNR, self.fc_q2RNR(out).softmax(-1)], 0)
-                    classpreds = torch.cat([classpreds, self.fc_q2(out).softmax(-1)], 0)
+                    RvsNR = torch.cat([RvsNR, outs[3].softmax(-1)], 0)
+                    classpreds = torch.cat([classpreds, outs[2].softmax(-1)], 0)
                 toReturn = torch.cat([RvsNR[:, 0].unsqueeze(-1), (RvsNR[:, 1]).unsqueeze(-1) * classpreds], -1)
-                if (not self.splitWeeklyQuestions):
-                    toReturn = torch.cat([toReturn[0:toReturn.shape[0] // 2], toReturn[toReturn.shape[0]:]], -1)
-                return toReturn, RvsNR
-            out_q1 = self.fc_q1(out).softmax(-1)
-            if (self.splitModel or self.splitWeeklyQuestions):
-                return out_q1, RvsNR
-            else:
-                out_q2 = self.fc_q2(out).softmax(-1)
-                return torch.cat([out_q1, out_q2],-1), RvsNR
+            # print(toReturn.shape)
+            if (not self.splitWeeklyQuestions):
+                toReturn = torch.cat([toReturn[0:toReturn.shape[0] // 2], toReturn[toReturn.shape[0]:]], -1)
+            return toReturn, RvsNR
+        if (self.regression):
+            preds = [self.relu(out) for out in outs]
+        else:
+            preds = [out.softmax(-1) for out in outs]
+        if (len(preds) == 1):
+            return preds[0], RvsNR
+        return torch.cat(preds, -1), RvsNR
+
+    @staticmethod
+    def forward_grouped(models, x, categories):
+        # evaluate per-category models (eg consumption, knowledge, physical)
+        #    together: every layer runs as one grouped matmul over the stacked
+        #    weights of all models, then each row keeps its own model's output
+        # categories: index into models for each row of x
+        #    rows with any other value are all zeros, as if no model saw them
+        hidden = models[0].relu(GroupedLinear(x, [[m.inputLayer] for m in models])[0])
+        outs = GroupedLinear(hidden, [m.head_layers() for m in models])
+        pred, RvsNR = models[0].forward_heads([SelectGroup(out, categories) for out in outs])
+        valid = (categories < len(models)).unsqueeze(-1)
+        pred = torch.where(valid, pred, torch.zeros_like(pred))
+        if RvsNR is not None:
+            RvsNR = torch.where(valid, RvsNR, torch.zeros_like(RvsNR))
+        return pred, RvsNR
 
     def maybe_zero_weights(self, trainConsumption=True, trainKnowledge=True, trainPhys=True, do="All"):
         if not self.splitModel or (trainConsumption and trainKnowledge and trainPhys):
@@ -0,0 +1,60 @@
+import torch
+
+class LSTMStateStore:
+    # keeps the AdaptableLSTM (h, c) state of every participant between
+    # weekly scoring runs, so a new week only costs one LSTM step
+    # (see AdaptableLSTM.step)
+
+    def __init__(self, hidden_size):
+        self.hidden_size = hidden_size
+        # participant id -> (h, c), each [hidden_size]
+        self.states = {}
+
+    def __contains__(self, pid):
+        return pid in self.states
+
+    def __len__(self):
+        return len(self.states)
+
+    def get(self, pid):
+        # zeros for a participant we have not seen yet
+        if pid not in self.states:
+            return torch.zeros(self.hidden_size), torch.zeros(self.hidden_size)
+        return self.states[pid]
+
+    def set(self, pid, state):
+        h, c = state
+        self.states[pid] = (h.detach().cpu(), c.detach().cpu())
+
+    def reset(self, pid):
+        self.states.pop(pid, None)
+
+    def step(self, model, pids, rows):
+        # score one new week for each participant in pids
+        # rows: [len(pids), input_size] newest feature row of each participant
+        # returns (pred, RvsNR) with one row per participant, and updates the stored states
+        device = rows.device
+        h = torch.stack([self.get(pid)[0] for pid in pids]).to(device)
+        c = torch.stack([self.get(pid)[1] for pid in pids]).to(device)
+        with torch.no_grad():
+            out, (h, c) = model.step(rows, (h, c))
+        for i, pid in enumerate(pids):
+            self.set(pid, (h[i], c[i]))
+        return out
+
+    def save(self, path):
+        # plain tensors only, no pickled model classes
+        pids = list(self.states.keys())
+        if len(pids) > 0:
+            hc = torch.stack([torch.stack(self.states[pid]) for pid in pids])
+        else:
+            hc = torch.zeros([0, 2, self.hidden_size])
+        torch.save({"hidden_size": self.hidden_size, "pids": pids, "states": hc}, path)
+
+    @classmethod
+    def load(cls, path):
+        saved = torch.load(path)
+        store = cls(saved["hidden_size"])
+        for pid, hc in zip(saved["pids"], saved["states"]):
+            store.states[pid] = (hc[0], hc[1])
+        return store
@@ -28,6 +28,69 @@ def MRR(pred, y):
     mrr = (y / ranks).sum(axis=1).mean()
     return mrr
 
+def CategoryCodes(physical, knowledge):
+    # question category of each row from its two category feature columns
+    # 0 = consumption, 1 = knowledge, 2 = physical, 3 = no category
+    codes = torch.full(physical.shape, 3, dtype=torch.long, device=physical.device)
+    codes[(physical == 0) & (knowledge == 0)] = 0
+    codes[(physical == 0) & (knowledge == 1)] = 1
+    codes[(physical == 1) & (knowledge == 0)] = 2
+    return codes
+
+def FusedLinear(x, layers):
+    # apply several linear layers to the same input with one matmul
+    # returns one output per layer (slices of the fused output)
+    weight = torch.cat([layer.weight for layer in layers], 0)
+    bias = torch.cat([layer.bias for layer in layers], 0)
+    out = torch.nn.functional.linear(x, weight, bias)
+    return torch.split(out, [layer.out_features for layer in layers], -1)
+
+def GroupedLinear(x, layerGroups):
+    # grouped matmul: group g applies its layers to x (or to x[g] if x is [G, N, F])
+    # layerGroups: one list of layers per group, all groups shaped the same
+    # returns one [G, N, out_features] output per layer position
+    weight = torch.stack([torch.cat([layer.weight for layer in layers], 0) for layers in layerGroups])
+    bias = torch.stack([torch.cat([layer.bias for layer in layers], 0) for layers in layerGroups])
+    if x.dim() == 2:
+        x = x.unsqueeze(0).expand(len(layerGroups), -1, -1)
+    out = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+    return torch.split(out, [layer.out_features for layer in layerGroups[0]], -1)
+
+def SelectGroup(grouped, groups):
+    # row i of the result is grouped[groups[i], i]
+    # rows whose group is out of range are zero (like rows no category model touched)
+    valid = groups < grouped.shape[0]
+    rows = grouped[groups.clamp_max(grouped.shape[0] - 1), torch.arange(grouped.shape[1], device=groups.device)]
+    return torch.where(valid.unsqueeze(-1), rows, torch.zeros_like(rows))
+
+def ConfusionCounts(true, pred, numClasses, weeks=None, numWeeks=1, categories=None, numCategories=1):
+    # count (week, category, true class, predicted class) occurrences in one bincount
+    # every metric reported in report_scores_min can be read off these counts
+    # returns long tensor of shape [numWeeks, numCategories, numClasses, numClasses]
+    true = true.long().view(-1)
+    pred = pred.long().view(-1)
+    if weeks is None:
+        weeks = torch.zeros_like(true)
+    if categories is None:
+        categories = torch.zeros_like(true)
+    flat = ((weeks.long() * numCategories + categories.long()) * numClasses + true) * numClasses + pred
+    counts = torch.bincount(flat, minlength=numWeeks * numCategories * numClasses * numClasses)
+    return counts.view(numWeeks, numCategories, numClasses, numClasses)
+
+def PrecisionRecall(confusion):
+    # per class precision and recall from a [true, pred] confusion matrix
+    # matches torchmetrics precision_recall(average='none'):
+    # zero denominators give 0, classes that never appear give nan
+    tp = confusion.diag().float()
+    predTotals = confusion.sum(dim=0).float()
+    trueTotals = confusion.sum(dim=1).float()
+    precision = torch.where(predTotals > 0, tp / predTotals.clamp_min(1), torch.zeros_like(tp))
+    recall = torch.where(trueTotals > 0, tp / trueTotals.clamp_min(1), torch.zeros_like(tp))
+    absent = (predTotals + trueTotals) == 0
+    precision[absent] = float("nan")
+    recall[absent] = float("nan")
+    return precision, recall
+
 def PairwiseLogLoss(pred, y):
     None
 
@@ -1,7 +1,6 @@
 import torch.nn as nn
 from torch.autograd import Variable
 import torch
-import torchmetrics
 from models.ModelUtils import *
 import numpy as np
 
@@ -26,7 +25,8 @@ class Base(nn.Module):
                  hierarchical = None,
                  separateHierLoss = False,
                  only_rnr = False,
-                 transformer = False):
+                 transformer = False,
+                 fusedHeads = False):
         # define all inputs to the model
         # input_size:   # features in input
         # hidden_size:  # size of hidden layer
@@ -35,6 +35,7 @@ class Base(nn.Module):
         # loss_kw:      # keyword arguments to loss fn
         # optimizer:    # string represneting torch optimizer
         # opt_kw:       # keyword arguments to optimizer
+        # fusedHeads:   # run all output layers as one matmul (same outputs)
         super().__init__()
         self.only_rnr = only_rnr
         self.separateHierLoss = separateHierLoss
@@ -54,6 +55,7 @@ class Base(nn.Module):
         self.splitWeeklyQuestions = splitWeeklyQuestions
         self.regression = regression
         self.transformer = transformer
+        self.fusedHeads = fusedHeads
             
         
         
@@ -61,6 +63,19 @@ class Base(nn.Module):
         # fake forward function so we can do other stuff
         return x
     
+    def head_layers(self):
+        # output layers applied to the shared hidden representation
+        return []
+
+    def head_outputs(self, out):
+        # apply every layer from head_layers() to out
+        # with fusedHeads the layers run as one matmul whose output is sliced per layer
+        # (getattr so models pickled before this option existed still load)
+        layers = self.head_layers()
+        if getattr(self, "fusedHeads", False):
+            return FusedLinear(out, layers)
+        return [layer(out) for layer in layers]
+
     def predict(self, x):
         # call forward method but do not collect gradient
         with torch.no_grad():
@@ -200,91 +215,74 @@ class Base(nn.Module):
                 mrr = crit(pred, y)
                 rankingVals = [celoss, ndcg, mrr]
                 rankingLabels = ["CE", "NDCG", "MRR"]
-                predValues = torch.nn.functional.one_hot(torch.argmax(pred, dim=1), num_classes=k)
-                labelValues = y
-                # print(pred.shape, y.shape)
-                class_precision, class_recall = torchmetrics.functional.precision_recall(pred.argmax(dim=1), y.argmax(dim=1), average='none', num_classes=k)
+                numClasses = k
+                predClasses = pred.argmax(dim=1)
+                trueClasses = y.argmax(dim=1)
             else:
                 rankingVals = []
                 rankingLabels = []
                 if (self.only_rnr):
-                    num_classes = 2
+                    numClasses = 2
                     pred = pred.clamp(0, 1)
                 elif (self.no_response_class):
-                    num_classes = 4
+                    numClasses = 4
                     pred = pred.clamp(0, 3)
                 else:
-                    num_classes = 3
+                    numClasses = 3
                     pred = pred.clamp(0, 2)
                     y = y - 1
-                predValues = torch.nn.functional.one_hot(pred.round().long(), num_classes=num_classes).squeeze()
-                labelValues = torch.nn.functional.one_hot(y.long(), num_classes=num_classes).squeeze()
-                # print(predValues.sum(dim=0), labelValues.sum(dim=0))
-                # print(pred.shape, y.shape)
-                class_precision, class_recall = torchmetrics.functional.precision_recall(pred.round().long(), y.long(), average='none', num_classes=num_classes)
-                
+                predClasses = pred.round().long().view(-1)
+                trueClasses = y.long().view(-1)
+
+            # rows are stacked week by week, so position mod numTimesteps gives the week
+            weeks = torch.arange(trueClasses.shape[0]) % self.numTimesteps
+            if (self.splitModel):
+                categories = CategoryCodes(data[:, -1], data[:, -2])
+                numCategories = 4
+            else:
+                categories = None
+                numCategories = 1
+            # every metric below is read off these counts
+            counts = ConfusionCounts(trueClasses, predClasses, numClasses, weeks, self.numTimesteps, categories, numCategories)
+            confusion = counts.sum(dim=(0, 1))
+            correct = confusion.diag()
+            classTotals = confusion.sum(dim=1)
+            numRows = trueClasses.shape[0]
 
-            accuracy = (predValues * labelValues).sum() / labelValues.shape[0]
-            # filter predicted classes by true class
+            accuracy = correct.sum() / numRows
+            # per class accuracy (filter predicted classes by true class)
+            classAcc = correct / classTotals
             if (self.only_rnr):
                 accLabels = ["Acc0", "Acc1"]
-                pred0 = predValues[labelValues[:, 0] == 1]
-                pred1 = predValues[labelValues[:, 1] == 1]
-                acc0 = (pred0[:, 0].sum()) / pred0.shape[0]
-                acc1 = (pred1[:, 1].sum()) / pred1.shape[0]
-                accValues = [acc0, acc1]
+                accValues = classAcc[[0, 1]].tolist()
             elif self.no_response_class:
                 accLabels = ["Acc0", "AccRes", "Acc1", "Acc2", "Acc3"]
-                pred0 = predValues[labelValues[:, 0] == 1]
-                predRes = predValues[labelValues[:, 0] != 1]
-                pred1 = predValues[labelValues[:, 1] == 1]
-                pred2 = predValues[labelValues[:, 2] == 1]
-                pred3 = predValues[labelValues[:, 3] == 1]
-                # per class accuracy
-                acc0 = (pred0[:, 0].sum()) / pred0.shape[0]
-                accRes = (predRes * labelValues[labelValues[:, 0] != 1]).sum() / predRes.shape[0]
-                acc1 = (pred1[:, 1].sum()) / pred1.shape[0]
-                acc2 = (pred2[:, 2].sum()) / pred2.shape[0]
-                acc3 = (pred3[:, 3].sum()) / pred3.shape[0]
-                accValues = [acc0, accRes, acc1, acc2, acc3]
+                accRes = (correct.sum() - correct[0]) / (numRows - classTotals[0])
+                accValues = [classAcc[0].item(), accRes.item()] + classAcc[[1, 2, 3]].tolist()
+                countClasses = [1, 2, 3]
             else:
                 accLabels = ["Acc1", "Acc2", "Acc3"]
-                pred1 = predValues[labelValues[:, 0] == 1]
-                pred2 = predValues[labelValues[:, 1] == 1]
-                pred3 = predValues[labelValues[:, 2] == 1]
-                # per class accuracy
-                acc1 = (pred1[:, 0].sum()) / pred1.shape[0]
-                acc2 = (pred2[:, 1].sum()) / pred2.shape[0]
-                acc3 = (pred3[:, 2].sum()) / pred3.shape[0]
-                accValues = [acc1, acc2, acc3]
+                accValues = classAcc[[0, 1, 2]].tolist()
+                countClasses = [0, 1, 2]
 
             # record per category accuracy
             if (self.splitModel):
                 classLabels = ["AccConsumption", "AccExercise", "AccKnowledge"]
-                consumptionRows = (torch.where(data[:, -1] == 0, 1, 0) * torch.where(data[:, -2] == 0, 1, 0)).nonzero()
-                knowledgeRows = (torch.where(data[:, -1] == 0, 1, 0) * torch.where(data[:, -2] == 1, 1, 0)).nonzero()
-                physRows = (torch.where(data[:, -1] == 1, 1, 0) * torch.where(data[:, -2] == 0, 1, 0)).nonzero()
-                conRows, conYs = predValues[consumptionRows], labelValues[consumptionRows]
-                exerRows, exerYs = predValues[physRows], labelValues[physRows]
-                knowRows, knowYs = predValues[knowledgeRows], labelValues[knowledgeRows]
-                consumptionAcc = (conRows * conYs).sum() / conRows.shape[0]
-                exerciseAcc = (exerRows * exerYs).sum() / exerRows.shape[0]
-                knowledgeAcc = (knowRows * knowYs).sum() / knowRows.shape[0]
-                classStats = [consumptionAcc, exerciseAcc, knowledgeAcc]
+                catCounts = counts.sum(dim=0)
+                catAcc = catCounts.diagonal(dim1=-2, dim2=-1).sum(dim=-1) / catCounts.sum(dim=(-2, -1))
+                classStats = catAcc[[0, 2, 1]].tolist()
             else:
                 classLabels = []
                 classStats = []
                 
             # per timestep accuracy
-            timeAcc = []
-            timeLabels = []
-            for x in range(self.numTimesteps):
-                indices = np.arange(x, predValues.shape[0], self.numTimesteps)
-                timeAcc.append((predValues[indices] * labelValues[indices]).sum() / len(indices))
-                timeLabels.append(f"Week{x}Acc")
+            weekCounts = counts.sum(dim=1)
+            timeAcc = (weekCounts.diagonal(dim1=-2, dim2=-1).sum(dim=-1) / weekCounts.sum(dim=(-2, -1))).tolist()
+            timeLabels = [f"Week{x}Acc" for x in range(self.numTimesteps)]
             if (self.only_rnr):
                 return np.array([mseloss.item()] + rankingVals + [accuracy.item()] + classStats + accValues + timeAcc), ["MSE"] + rankingLabels + ["Acc"] + classLabels + accLabels + timeLabels
-            return np.array([mseloss.item()] + rankingVals + [accuracy.item()] + classStats + accValues + [class_precision[0].item(), class_precision[1].item(), class_precision[2].item(), class_recall[0].item(), class_recall[1].item(), class_recall[2].item(), pred1.shape[0], pred2.shape[0], pred3.shape[0]] + timeAcc), ["MSE"] + rankingLabels + ["Acc"] + classLabels + accLabels + ["Prec1", "Prec2", "Prec3", "Rec1", "Rec2", "Rec3", "Count1", "Count2", "Count3"] + timeLabels
+            class_precision, class_recall = PrecisionRecall(confusion)
+            return np.array([mseloss.item()] + rankingVals + [accuracy.item()] + classStats + accValues + class_precision[[0, 1, 2]].tolist() + class_recall[[0, 1, 2]].tolist() + classTotals[countClasses].tolist() + timeAcc), ["MSE"] + rankingLabels + ["Acc"] + classLabels + accLabels + ["Prec1", "Prec2", "Prec3", "Rec1", "Rec2", "Rec3", "Count1", "Count2", "Count3"] + timeLabels
         else:
             return [], ["MSE", "CE", "NDCG", "MRR", "Acc", "ResCount"]
                     
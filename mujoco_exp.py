@@ -10,6 +10,9 @@ import torch.optim as optim
 from torch.distributions import Normal
 import os
 import time
+from utils.mmap_buffer import MmapBuffer, subSeqOffsets
+from utils.sac_learner import SACLearner
+from utils.ensemble_critic import EnsembleQNetwork
 
 
 def toBool(x):
@@ -39,9 +42,18 @@ parser.add_argument("--statepred", type=toBool, default=False, help="Use explici
 parser.add_argument("--statefill", type=toBool, default=True, help="Fill unobserved state components with previously observed values")
 parser.add_argument("--contextSAC", type=toBool, default=False)
 parser.add_argument("--statemodel", type=str, default="lstm", help="Type of model for predicting states")
+parser.add_argument("--beliefCarry", type=toBool, default=False, help="Carry the state predictor's LSTM state and attention keys/values through rollouts instead of re-running it over the last context steps")
+parser.add_argument("--checkBelief", type=toBool, default=False, help="With beliefCarry, also compute the windowed belief and report the largest difference")
 parser.add_argument("--numBreaks", type=int, default=4, help="Minibatches for state pred training")
 parser.add_argument("--stateTrainMult", type=int, default=1, help="Multiplier for state learning epochs")
 parser.add_argument("--hiddenSizeLSTM", type=int, default=64, help="Hidden size for LSTM network")
+parser.add_argument("--compactBuffer", type=toBool, default=False, help="Store replay buffer observations/actions as float32 and knowns masks as bits")
+parser.add_argument("--bufferDir", type=str, default="", help="Keep the replay buffer in memory-mapped files in this directory (reopened if it already holds one)")
+parser.add_argument("--numEnvs", type=int, default=1, help="no. environments stepped together with a gym vector env")
+parser.add_argument("--asyncEnvs", type=toBool, default=True, help="Step the vector env's environments in subprocesses (AsyncVectorEnv) instead of in this process")
+parser.add_argument("--compileLearner", type=toBool, default=False, help="torch.compile the RRD / SAC loss computations")
+parser.add_argument("--ensembleSize", type=int, default=0, help="Q networks in one stacked-weight ensemble critic (0 = separate twin SoftQNetworks)")
+parser.add_argument("--ensembleMin", type=int, default=2, help="Ensemble members (chosen at random) whose min gives the target Q; the actor uses the ensemble mean when this is below ensembleSize (REDQ)")
 parser.add_argument("--policyResetStep", type=int, default=-1, help="No. algorithmic steps at which to reset the policy")
 
 
@@ -58,17 +70,51 @@ np.random.seed(args.seed)
 # trajectory class - helper for lessons buffer
 class Trajectory:
     def __init__(self, observations, actions, rewards, dones, knownses):
-        self.obs = np.stack(observations, axis=0)
-        self.actions = np.stack(actions, axis=0)
+        obs = np.stack(observations, axis=0)
+        actions = np.stack(actions, axis=0)
+        knownses = np.stack(knownses, axis=0)
         self.dones = np.stack(dones, axis=0)
-        self.knownses = np.stack(knownses, axis=0)
         self.rewards = np.stack(rewards, axis=0)
 
         # validate trajectory
-        if len(self.obs) != len(self.actions) + 1 != len(self.dones) != len(self.knownses) != len(self.rewards) + 1:
+        if len(obs) != len(actions) + 1 != len(self.dones) != len(knownses) != len(self.rewards) + 1:
             print("ERROR IN BUFFER STORAGE")
 
         self.length = len(actions)
+        self.obsDim = obs.shape[1]
+        # RRD label for every sub sequence of this trajectory
+        self.meanReward = np.mean(self.rewards)
+
+        # obs || action per step, one array for everything:
+        # obs / actions are views into it (next obs is just the following row),
+        # row length holds the final obs, and the rows after it pad the state prediction windows
+        dtype = np.float32 if args.compactBuffer else np.result_type(obs, actions)
+        self.steps = np.zeros([self.length + max(args.context, 1), obs.shape[1] + actions.shape[1]], dtype=dtype)
+        self.steps[:self.length + 1, :self.obsDim] = obs
+        self.steps[:self.length, self.obsDim:] = actions
+        self.obs = self.steps[:self.length + 1, :self.obsDim]
+        self.actions = self.steps[:self.length, self.obsDim:]
+        # windows[j] is a strided view of steps j .. j + context (nothing is copied)
+        self.windows = np.lib.stride_tricks.as_strided(self.steps, shape=(self.length, args.context + 1, self.steps.shape[1]), strides=(self.steps.strides[0],) + self.steps.strides, writeable=False)
+
+        if args.compactBuffer:
+            # knowns masks are 0/1, so 1 bit per component
+            self.knownsPacked = np.packbits(knownses > 0, axis=1)
+            self.rewards = self.rewards.astype(np.float32)
+            self.dones = self.dones.astype(np.uint8)
+        else:
+            self.knownses = knownses
+
+    # knowns masks at timesteps idxs
+    def getKnowns(self, idxs):
+        if args.compactBuffer:
+            return np.unpackbits(self.knownsPacked[idxs], axis=-1, count=self.obsDim).astype(np.float32)
+        return self.knownses[idxs]
+
+    # bytes held by this trajectory
+    def nbytes(self):
+        knowns = self.knownsPacked if args.compactBuffer else self.knownses
+        return self.steps.nbytes + knowns.nbytes + self.dones.nbytes + self.rewards.nbytes
 
     # return specific timestep of trajectory
     def getElement(self, idx):
@@ -78,8 +124,8 @@ class Trajectory:
             'actions': self.actions[idx], 
             'nextobs': self.obs[idx + 1], 
             'dones': self.dones[idx + 1], 
-            'knowns': self.knownses[idx], 
-            'nextknowns': self.knownses[idx + 1], 
+            'knowns': self.getKnowns(idx), 
+            'nextknowns': self.getKnowns(idx + 1), 
             'rewards': self.rewards[idx]}
     
     # sample SIZE entries from trajectory
@@ -94,20 +140,20 @@ class Trajectory:
             'actions': self.actions[idxs], 
             'nextobs': self.obs[idxs + 1], 
             'dones': self.dones[idxs + 1], 
-            'knowns': self.knownses[idxs], 
-            'nextknowns': self.knownses[idxs + 1], 
-            'rewards': [np.mean(self.rewards)]}
+            'knowns': self.getKnowns(idxs), 
+            'nextknowns': self.getKnowns(idxs + 1), 
+            'rewards': [self.meanReward]}
             # 'rewards': self.rewards}
     
-    # retrieve features for state prediction task
-    def retrieveStateFeatures(self, idx):
-        mindx = max(idx - args.context, 0)
-        obs = self.obs[mindx:idx + 1]
-        acts = self.actions[mindx:idx + 1]
-        labels = np.copy(self.obs[idx + 1]) - self.obs[idx]
-        feats = np.concatenate([obs, acts], axis=1)
-        knowns = self.knownses[idx + 1]
-        return feats, labels, knowns
+    # retrieve features for state prediction task, for an array of timesteps
+    # each window covers the (up to) context previous steps and idx, zero after its length
+    def retrieveStateFeatures(self, idxs):
+        lengths = np.minimum(idxs, args.context) + 1
+        valid = np.arange(args.context + 1)[None, :] < lengths[:, None]
+        feats = self.windows[idxs - lengths + 1] * valid[:, :, None]
+        labels = self.obs[idxs + 1] - self.obs[idxs]
+        knowns = self.getKnowns(idxs + 1)
+        return feats, labels, knowns, lengths
 
 # lessons buffer class
 class Buffer:
@@ -163,46 +209,70 @@ class Buffer:
             toReturn.append(self.els[i].getElement(idx - offset))
         return toReturn
     
+    # same transitions as sample, as a dict of [size, ...] tensors gathered per trajectory
+    def sampleBatch(self, size):
+        idxs = np.sort(np.random.choice(self.count, size, replace = size > self.count))
+        splits = np.array(self.splits)
+        traj = np.searchsorted(splits, idxs, side='right')
+        offsets = idxs - (splits - [el.length for el in self.els])[traj]
+        groups, groupStarts = np.unique(traj, return_index=True)
+        groupEnds = np.append(groupStarts[1:], size)
+        parts = [self.els[i].getElement(offsets[start:end]) for i, start, end in zip(groups, groupStarts, groupEnds)]
+        batch = {}
+        for key in parts[0]:
+            batch[key] = torch.from_numpy(np.concatenate([part[key] for part in parts])).float()
+        return batch
+
+    # subLen transitions from each of numSubs random trajectories, as [numSubs, subLen, ...] tensors
+    # rewards are the trajectories' mean rewards [numSubs, 1], computed when they were added
     def sampleSubSeqs(self, subLen, numSubs):
         idxs = np.random.choice(len(self.els), numSubs, replace = numSubs>len(self.els))
-        toReturn = {}
-        # recombine samples into their own vectors
-        for i in idxs:
-            temp = self.els[i].sample(subLen)
-            for key in temp.keys():
-                if key in toReturn:
-                    toReturn[key].append(temp[key])
-                else:
-                    toReturn[key] = [temp[key]]
-        return toReturn
+        els = [self.els[i] for i in idxs]
+        offsets = subSeqOffsets([el.length for el in els], subLen)
+        batch = {
+            'obs': np.stack([el.obs[o] for el, o in zip(els, offsets)]),
+            'actions': np.stack([el.actions[o] for el, o in zip(els, offsets)]),
+            'nextobs': np.stack([el.obs[o + 1] for el, o in zip(els, offsets)]),
+            'dones': np.stack([el.dones[o + 1] for el, o in zip(els, offsets)]),
+            'knowns': np.stack([el.getKnowns(o) for el, o in zip(els, offsets)]),
+            'nextknowns': np.stack([el.getKnowns(o + 1) for el, o in zip(els, offsets)]),
+            'rewards': np.array([[el.meanReward] for el in els])}
+        for key in batch:
+            batch[key] = torch.from_numpy(batch[key]).float()
+        return batch
     
+    # memory held by stored trajectories: (total bytes, bytes per transition)
+    def memoryUsage(self):
+        total = sum([el.nbytes() for el in self.els])
+        return total, total / max(self.count, 1)
+
     def sampleForStatePred(self, size):
         idxs = np.random.choice(self.count, size, replace = size>self.count)
-        idxs = sorted(idxs)
-        i = 0
-
-        returnFeats, returnLabs, returnKnowns = [], [], []
-        for idx in idxs:
-            while (idx >= self.splits[i]):
-                i += 1
-            if i == 0:
-                offset = 0
-            else:
-                offset = self.splits[i - 1]
-            if (idx - offset) < 0:
-                print("ERRORR!!!!!!! Buffer index offset wrong")
-
-            tfeat, tlab, tknown = self.els[i].retrieveStateFeatures(idx - offset)
-
-            # combine individually returned values into vectors for each
-            returnFeats.append(torch.tensor(tfeat))
-            returnLabs.append(tlab)
-            returnKnowns.append(tknown)
-
-        lengths = [len(feat) for feat in returnFeats]
+        # trajectory and offset of each index
+        splits = np.array(self.splits)
+        traj = np.searchsorted(splits, idxs, side='right')
+        offsets = idxs - (splits - [el.length for el in self.els])[traj]
+
+        # gather each trajectory's windows in one go
+        returnFeats, returnLabs, returnKnowns, lengths = None, None, None, np.zeros(size, dtype=np.int64)
+        order = np.argsort(traj, kind='stable')
+        groups, groupStarts = np.unique(traj[order], return_index=True)
+        groupEnds = np.append(groupStarts[1:], size)
+        for i, start, end in zip(groups, groupStarts, groupEnds):
+            sel = order[start:end]
+            tfeat, tlab, tknown, tlength = self.els[i].retrieveStateFeatures(offsets[sel])
+            if returnFeats is None:
+                returnFeats = np.zeros((size,) + tfeat.shape[1:], dtype=tfeat.dtype)
+                returnLabs = np.zeros((size,) + tlab.shape[1:], dtype=tlab.dtype)
+                returnKnowns = np.zeros((size,) + tknown.shape[1:], dtype=tknown.dtype)
+            returnFeats[sel] = tfeat
+            returnLabs[sel] = tlab
+            returnKnowns[sel] = tknown
+            lengths[sel] = tlength
 
         # shape is (sequence, batch, features)
-        return torch.nn.utils.rnn.pad_sequence(returnFeats).float(), np.stack(returnLabs, axis=0), np.stack(returnKnowns, axis=0), lengths
+        returnFeats = returnFeats[:, :lengths.max()].transpose(1, 0, 2)
+        return torch.from_numpy(np.ascontiguousarray(returnFeats)).float(), returnLabs, returnKnowns, lengths.tolist()
 
 
 def layer_init(layer, bias_const=0.1):
@@ -239,6 +309,32 @@ class StateLSTMNetwork(nn.Module):
         #         maxes = maxes.cuda()
         #     output = torch.clamp(output, mins, maxes)
         return output
+
+    # advance one timestep, x_t is a single row [obs + action]
+    # cache holds the LSTM (h, c) and the attention keys / values of the last context steps
+    # returns (prediction if the sequence ended with x_t, new cache)
+    def step(self, x_t, cache=None):
+        state, keys, values = (None, None, None) if cache is None else cache
+        output, state = self.lstm(x_t.view(1, 1, -1), state)
+        output = torch.sigmoid(output[-1, 0])
+        # same projections MultiheadAttention applies to its query / key / value inputs
+        attn = self.attnlayer
+        wq, wk, wv = attn.in_proj_weight.chunk(3)
+        bq, bk, bv = attn.in_proj_bias.chunk(3)
+        k = F.linear(output, wk, bk).unsqueeze(0)
+        v = F.linear(output, wv, bv).unsqueeze(0)
+        keys = k if keys is None else torch.cat([keys[-(args.context - 1):], k])[-args.context:]
+        values = v if values is None else torch.cat([values[-(args.context - 1):], v])[-args.context:]
+        # [heads, steps, head dim]
+        headDim = self.hidden_size // attn.num_heads
+        q = F.linear(output, wq, bq).view(attn.num_heads, 1, headDim) * (headDim ** -0.5)
+        kh = keys.view(-1, attn.num_heads, headDim).transpose(0, 1)
+        vh = values.view(-1, attn.num_heads, headDim).transpose(0, 1)
+        weights = torch.softmax(q @ kh.transpose(1, 2), dim=-1)
+        output = attn.out_proj((weights @ vh).reshape(-1))
+        output = torch.relu(output)
+        output = self.outlayer(output)
+        return output, (state, keys, values)
     
 # state predictor using only linear layers
 # UNUSED
@@ -411,29 +507,38 @@ partsLookup = {"Ant-v2": antParts,
                "Hopper-v2": hopperParts,
                "Walker2d-v2": walkerParts}
 
-# returns filtered observation based on how much information should be hidden
+# [num parts, obs dim] boolean matrix, row p marks the observation components of part p
+def buildPartMasks(parts, obsDim):
+    masks = np.zeros([len(parts), obsDim], dtype=bool)
+    for p, part in enumerate(parts):
+        masks[p, part] = True
+    return masks
+
+# returns filtered observations based on how much information should be hidden, for a batch of environments
 # this accomplishes the modification to the MuJoCo Gym environments 
-def obsFilter(observation, numHidden, lastKnown, leftTilRandom):
-    parts = partsLookup[args.env]
+# observations / lastKnowns: [envs, obs dim], leftTilRandom: [envs] no. steps left hiding the same parts
+def obsFilterBatch(observations, numHidden, lastKnowns, leftTilRandom):
+    observations = np.asarray(observations)
+    leftTilRandom = np.asarray(leftTilRandom)
     if (numHidden > 0):
-        # NEW parts need to be hidden
-        if leftTilRandom <= 1:
-            hiddenParts = np.random.choice(len(parts), numHidden, replace=False)
-            known = np.ones_like(observation)
-            leftReturn = args.consecHidden
-            observation = np.copy(observation)
-            for part in hiddenParts:
-                observation[parts[part]] = 0
-                known[parts[part]] = 0
-        else:
-            # hide the same parts as the last timestep (UNUSED)
-            known = np.copy(lastKnown)
-            observation = observation * known
-            leftReturn = leftTilRandom - 1
-    
-        return observation, known, leftReturn
+        # NEW parts need to be hidden where the counter ran out:
+        # random part order per environment, first numHidden parts hidden (no repeats)
+        fresh = leftTilRandom <= 1
+        chosen = np.zeros([len(observations), len(partMasks)])
+        order = np.argsort(np.random.rand(len(observations), len(partMasks)), axis=1)[:, :numHidden]
+        np.put_along_axis(chosen, order, 1, axis=1)
+        hidden = (chosen @ partMasks) > 0
+        # otherwise hide the same parts as the last timestep (UNUSED)
+        knowns = np.where(fresh[:, None], ~hidden, np.asarray(lastKnowns) != 0).astype(observations.dtype)
+        leftReturn = np.where(fresh, args.consecHidden, leftTilRandom - 1)
+        return np.where(knowns != 0, observations, 0), knowns, leftReturn
     # default
-    return observation, np.ones_like(observation), leftTilRandom
+    return observations, np.ones_like(observations), leftTilRandom
+
+# single environment version of obsFilterBatch
+def obsFilter(observation, numHidden, lastKnown, leftTilRandom):
+    observations, knowns, leftReturn = obsFilterBatch(observation[None], numHidden, np.asarray(lastKnown)[None], np.array([leftTilRandom]))
+    return observations[0], knowns[0], int(leftReturn[0])
 
 # return agent's state belief based on the previous state, current action, and trajectory before that
 # will be combined with observable components to yield final predicted observation
@@ -457,6 +562,84 @@ def getStateBelief(observations, knowns, acts=None, statepred = None, mins=None,
     # no explicit permission - assume values unchanged
     return observations[-1]
 
+# getStateBelief for one rollout that keeps the LSTM state and attention keys / values between steps,
+# so each step is one LSTM step and one attention query instead of a pass over the last context steps
+# same as getStateBelief for the first context steps of an episode, after that the carried
+# LSTM state also remembers steps older than the window (the attention cache stays at context steps)
+# check: also compute the windowed belief, the largest differences (within / after the first context steps) are kept
+class BeliefTracker:
+    def __init__(self, statepred, check=False):
+        self.statepred = statepred
+        self.check = check
+        self.maxDiff = 0.0
+        self.maxDiffBeyond = 0.0
+        self.reset()
+
+    def reset(self):
+        self.cache = None
+        self.steps = 0
+
+    def update(self, observations, knowns, acts, mins=None, maxes=None):
+        # observations / acts: the episode so far, the newest (observation, action) pair is added to the cache
+        x = torch.tensor(np.concatenate([observations[-1], acts[-1]], axis=-1)).float()
+        if args.cuda:
+            x = x.cuda()
+        with torch.no_grad():
+            pred, self.cache = self.statepred.step(x, self.cache)
+        toReturn = pred.cpu().numpy() + observations[-1]
+        self.steps += 1
+        if self.check:
+            start = min(args.context, len(observations))
+            windowed = getStateBelief(observations[-start:], knowns, acts[-start:], self.statepred, mins, maxes)
+            diff = np.abs(windowed - toReturn).max()
+            if self.steps <= args.context:
+                self.maxDiff = max(self.maxDiff, diff)
+            else:
+                self.maxDiffBeyond = max(self.maxDiffBeyond, diff)
+        return toReturn
+
+# None when beliefs are computed with getStateBelief
+def makeBeliefTracker(statepred):
+    if args.statepred and args.beliefCarry and hasattr(statepred, "step"):
+        return BeliefTracker(statepred, args.checkBelief)
+    return None
+
+# getStateBelief for every environment of the vector env
+# observations / acts: per environment lists of the trajectory so far
+# environments with the same window length are predicted together
+def getStateBeliefVector(observations, acts, statepred = None):
+    if not args.statepred:
+        return [obsList[-1] for obsList in observations]
+    toReturn = [None] * len(observations)
+    starts = [min(args.context, len(obsList)) for obsList in observations]
+    for start in set(starts):
+        group = [i for i in range(len(observations)) if starts[i] == start]
+        # [window, group, obs + action]
+        obsfeat = np.stack([np.concatenate([observations[i][-start:], acts[i][-start:]], axis=-1) for i in group], axis=1)
+        obsfeat = torch.tensor(obsfeat).float()
+        if args.cuda:
+            obsfeat = obsfeat.cuda()
+        with torch.no_grad():
+            preds = statepred(obsfeat).cpu().numpy()
+        for pred, i in zip(preds, group):
+            toReturn[i] = pred + observations[i][-1]
+    return toReturn
+
+# per environment info dicts, from either a list of dicts or a dict of arrays (newer gym)
+def vectorInfos(infos, numEnvs):
+    if isinstance(infos, dict):
+        return [dict([(key, value[i]) for key, value in infos.items() if not key.startswith("_")]) for i in range(numEnvs)]
+    return infos
+
+# puts the last observation of an episode in info["terminal_observation"]: the vector envs reset
+# a finished environment right away, and gym 0.18's do not keep that observation anywhere
+class TerminalObservation(gym.Wrapper):
+    def step(self, action):
+        observation, reward, done, info = self.env.step(action)
+        if done:
+            info = dict(info)
+            info["terminal_observation"] = observation
+        return observation, reward, done, info
 # set seeds for reproducibility 
 random.seed(args.seed)
 np.random.seed(args.seed)
@@ -468,13 +651,26 @@ env = gym.make(args.env)
 env.seed(args.seed)
 testenv = gym.make(args.env)
 testenv.seed(args.seed)
+# parts that can be hidden, compiled once
+if args.numHidden > 0 and args.env not in partsLookup:
+    raise ValueError(f"numHidden > 0 needs the parts of {args.env} in partsLookup")
+if args.numHidden > len(partsLookup.get(args.env, [])):
+    raise ValueError(f"numHidden ({args.numHidden}) is more than the {len(partsLookup[args.env])} parts of {args.env}")
+partMasks = buildPartMasks(partsLookup.get(args.env, []), env.observation_space.shape[0])
+
+# Q networks and targets: twin SoftQNetworks, or all of them stacked in one
+# EnsembleQNetwork as qf1 / qf1_target (qf2 / qf2_target are then None)
+def makeCritics():
+    if args.ensembleSize > 0:
+        inputSize = env.observation_space.shape[0] + env.action_space.shape[0]
+        return EnsembleQNetwork(inputSize, 256, args.ensembleSize), None, EnsembleQNetwork(inputSize, 256, args.ensembleSize), None
+    return SoftQNetwork(env), SoftQNetwork(env), SoftQNetwork(env), SoftQNetwork(env)
 
 # initialize networks
 actor = Actor(env)
-qf1 = SoftQNetwork(env)
-qf2 = SoftQNetwork(env)
-qf1_target = SoftQNetwork(env)
-qf2_target = SoftQNetwork(env)
+qf1, qf2, qf1_target, qf2_target = makeCritics()
+qfs = [qf for qf in (qf1, qf2) if qf is not None]
+qf_targets = [qf for qf in (qf1_target, qf2_target) if qf is not None]
 rrder = RRDModel(env)
 if (args.statepred):
     if args.statemodel == "nn":
@@ -489,18 +685,16 @@ else:
     statepred_target = None
 if args.cuda:
     actor = actor.cuda()
-    qf1 = qf1.cuda()
-    qf2 = qf2.cuda()
-    qf1_target = qf1_target.cuda()
-    qf2_target = qf2_target.cuda()
+    for qf in qfs + qf_targets:
+        qf.cuda()
     rrder = rrder.cuda()
     if (args.statepred):
         statepred = statepred.cuda()
         statepred_target = statepred_target.cuda()
         statepred_target.load_state_dict(statepred.state_dict())
-for p1, p2 in zip(qf1_target.parameters(), qf2_target.parameters()):
-    p1.requires_grad = False
-    p2.requires_grad = False
+for qf in qf_targets:
+    for p in qf.parameters():
+        p.requires_grad = False
 
 # initialize alpha optimization, if used
 if (args.alpha_lr > 0):
@@ -514,16 +708,25 @@ else:
     alpha = args.alpha
 
 # copy values to target networks
-qf1_target.load_state_dict(qf1.state_dict())
-qf2_target.load_state_dict(qf2.state_dict())
+for qf, qf_target in zip(qfs, qf_targets):
+    qf_target.load_state_dict(qf.state_dict())
 
 # initialize optimizers
-q_opt = optim.Adam(list(qf1.parameters()) + list(qf2.parameters()), lr=args.qlr)
+q_opt = optim.Adam([p for qf in qfs for p in qf.parameters()], lr=args.qlr)
 act_opt = optim.Adam(list(actor.parameters()), lr=args.actlr)
 rrd_opt = optim.Adam(list(rrder.parameters()), lr=3e-4)
 if args.statepred:
     stateopt = optim.Adam(list(statepred.parameters()), lr=args.statelr)
 
+# RRD / SAC update steps (see utils/sac_learner.py), rebuilt whenever the networks are
+def makeLearner():
+    return SACLearner(actor, qf1, qf2, qf1_target, qf2_target, rrder, q_opt, act_opt, rrd_opt, args.gamma, np.prod(env.action_space.shape),
+                      alpha, logalpha if args.alpha_lr > 0 else None, alpha_opt if args.alpha_lr > 0 else None,
+                      extraTargets=[(statepred_target, statepred)] if args.statepred else [],
+                      device="cuda" if args.cuda else "cpu", compile=args.compileLearner,
+                      targetMembers=args.ensembleMin, actorMean=0 < args.ensembleMin < args.ensembleSize)
+learner = makeLearner()
+
 
 # method to evaluate current policy
 def evaluatePolicy(numRollouts=10):
@@ -538,6 +741,7 @@ def evaluatePolicy(numRollouts=10):
         knowns = np.ones_like(testobs)
         obsbuff = [testobs]
         actbuff = []
+        tracker = makeBeliefTracker(statepred)
         while not done:
             start = min(args.context, len(obsbuff))
             if args.contextSAC:
@@ -553,7 +757,10 @@ def evaluatePolicy(numRollouts=10):
                 testaction = testaction.detach().numpy().squeeze()
             nextobsUn, testreward, done, _info = testenv.step(testaction)
             actbuff.append(testaction)
-            nextObsPred = getStateBelief(obsbuff[-start:], knowns, actbuff[-start:], statepred, mins=buff.minStateVals, maxes=buff.maxStateVals)
+            if tracker is not None:
+                nextObsPred = tracker.update(obsbuff, knowns, actbuff, mins=buff.minStateVals, maxes=buff.maxStateVals)
+            else:
+                nextObsPred = getStateBelief(obsbuff[-start:], knowns, actbuff[-start:], statepred, mins=buff.minStateVals, maxes=buff.maxStateVals)
             nextobs, knowns, hiddenLeft = obsFilter(nextobsUn, args.numHidden, knowns, hiddenLeft)
             testobs = (knowns * nextobs) + ((1 - knowns) * (nextObsPred))
             testObsIdxs = (1 - knowns) != 0
@@ -612,7 +819,10 @@ rrdlosslist = []
 statelosslist = []
 
 # initialize trajectory buffer
-buff = Buffer(args.bufferSize)
+if args.bufferDir:
+    buff = MmapBuffer(args.bufferDir, args.bufferSize, args.context, compact=args.compactBuffer)
+else:
+    buff = Buffer(args.bufferSize)
 
 # initialize values for environmental sampling
 observation = env.reset()
@@ -624,11 +834,37 @@ knownses = [knowns]
 rewards = []
 numSteps = 0
 hiddenLeft = 0
+if buff.count > 0:
+    # reopened buffer, continue from the transitions it already holds
+    print(f"Reopened replay buffer in {args.bufferDir} with {buff.count} transitions")
+    numSteps = buff.count
 
 actloss = None
 qfloss = None
 
 
+# incremental state beliefs for the sampling loop
+beliefTracker = makeBeliefTracker(statepred_target)
+
+# vector env sampling, one list of trajectory values per environment
+if args.numEnvs > 1:
+    if args.contextSAC:
+        raise ValueError("contextSAC is not supported with numEnvs > 1")
+    if args.envSteps % args.numEnvs != 0:
+        # each vector env step gives numEnvs transitions, the reported step counts assume envSteps per timestep
+        raise ValueError(f"envSteps ({args.envSteps}) must be a multiple of numEnvs ({args.numEnvs})")
+    envFns = [lambda: TerminalObservation(gym.make(args.env)) for i in range(args.numEnvs)]
+    venv = gym.vector.AsyncVectorEnv(envFns) if args.asyncEnvs else gym.vector.SyncVectorEnv(envFns)
+    venv.seed([args.seed + i for i in range(args.numEnvs)])
+    vobservation = list(venv.reset())
+    vobs = [[o] for o in vobservation]
+    vacts = [[] for i in range(args.numEnvs)]
+    vdones = [[0] for i in range(args.numEnvs)]
+    vknowns = np.ones_like(np.stack(vobservation))
+    vknownses = [[k] for k in vknowns]
+    vrewards = [[] for i in range(args.numEnvs)]
+    vhiddenLeft = np.zeros(args.numEnvs, dtype=np.int64)
+
 # keep track of runtime
 starttime = time.time()
 
@@ -637,23 +873,20 @@ for step in range(int(args.numSteps)):
     # reset policy to re-train
     # UNUSED
     if step == args.policyResetStep:
-        qf1 = SoftQNetwork(env)
-        qf2 = SoftQNetwork(env)
-        qf1_target = SoftQNetwork(env)
-        qf2_target = SoftQNetwork(env)
+        qf1, qf2, qf1_target, qf2_target = makeCritics()
+        qfs = [qf for qf in (qf1, qf2) if qf is not None]
+        qf_targets = [qf for qf in (qf1_target, qf2_target) if qf is not None]
         if args.cuda:
             actor = actor.cuda()
-            qf1 = qf1.cuda()
-            qf2 = qf2.cuda()
-            qf1_target = qf1_target.cuda()
-            qf2_target = qf2_target.cuda()
+            for qf in qfs + qf_targets:
+                qf.cuda()
             if (args.statepred):
                 statepred = statepred.cuda()
                 statepred_target = statepred_target.cuda()
                 statepred_target.load_state_dict(statepred.state_dict())
-        for p1, p2 in zip(qf1_target.parameters(), qf2_target.parameters()):
-            p1.requires_grad = False
-            p2.requires_grad = False
+        for qf in qf_targets:
+            for p in qf.parameters():
+                p.requires_grad = False
         if (args.alpha_lr > 0):
             logalpha = torch.tensor(0).float()
             if (args.cuda):
@@ -663,67 +896,119 @@ for step in range(int(args.numSteps)):
             alpha = torch.exp(logalpha)
         else: 
             alpha = args.alpha
-        qf1_target.load_state_dict(qf1.state_dict())
-        qf2_target.load_state_dict(qf2.state_dict())
-        q_opt = optim.Adam(list(qf1.parameters()) + list(qf2.parameters()), lr=args.qlr)
+        for qf, qf_target in zip(qfs, qf_targets):
+            qf_target.load_state_dict(qf.state_dict())
+        q_opt = optim.Adam([p for qf in qfs for p in qf.parameters()], lr=args.qlr)
         act_opt = optim.Adam(list(actor.parameters()), lr=args.actlr)
+        learner = makeLearner()
 
     # sample steps from environment
-    for envStep in range(args.envSteps):
-        with torch.no_grad():
-            start = min(args.context, len(obs))
-            if args.contextSAC:
-                obsfeat = torch.tensor(np.array(obs[-start:])).float()
-            else:
-                obsfeat = torch.tensor(obs[-1]).float().unsqueeze(0)
-            if (envStep % 100) == 55 and step % 10 == 1:
-                # print(obsfeat.max())
-                None
-            if args.cuda:
-                obsfeat = obsfeat.cuda()
-            action = actor.only_action(obsfeat)
-            if args.cuda:
-                action = action.detach().cpu().numpy().squeeze()
-            else:
-                action = action.detach().numpy().squeeze()
-            nextObs, reward, done, info = env.step(action)
-            acts.append(action)
-            # get predicted state
-            nextObsPred = getStateBelief(obs[-start:], knowns, acts[-start:], statepred_target, mins=buff.minStateVals, maxes=buff.maxStateVals)
-            # get actually observed state
-            nextObs, knowns, hiddenLeft = obsFilter(nextObs, args.numHidden, knowns, hiddenLeft)
-            # combine predictions with known values, treat as observation going forward
-            observation = (knowns * nextObs) + ((1 - knowns) * (nextObsPred))
-            knownses.append(knowns)
-            rewards.append(reward)
-            obs.append(observation)
-
-            # trajectory is finished
-            if done:
-                # if ended due to time limit - do not treat as "done" for SAC
-                if (info.get('TimeLimit.truncated', False)):
-                    dones.append(0)
+    if args.numEnvs > 1:
+        # every step of the vector env gives one transition per environment
+        for envStep in range(args.envSteps // args.numEnvs):
+            with torch.no_grad():
+                obsfeat = torch.tensor(np.stack(vobservation)).float()
+                if args.cuda:
+                    obsfeat = obsfeat.cuda()
+                action = actor.only_action(obsfeat).cpu().detach().numpy()
+                nextObs, reward, done, infos = venv.step(action)
+                infos = vectorInfos(infos, args.numEnvs)
+                # finished environments are reset by the vector env, their last observation is in the info
+                # (nextObs already holds the next episode's first observation)
+                finalObs = np.array(nextObs)
+                for i in range(args.numEnvs):
+                    if done[i]:
+                        if "terminal_observation" not in infos[i]:
+                            raise RuntimeError("vector env finished an episode without its terminal observation in info")
+                        finalObs[i] = infos[i]["terminal_observation"]
+                for i in range(args.numEnvs):
+                    vacts[i].append(action[i])
+                # get predicted states, then the actually observed states
+                nextObsPred = getStateBeliefVector(vobs, vacts, statepred_target)
+                filtered, vknowns, vhiddenLeft = obsFilterBatch(finalObs, args.numHidden, vknowns, vhiddenLeft)
+                for i in range(args.numEnvs):
+                    vobservation[i] = (vknowns[i] * filtered[i]) + ((1 - vknowns[i]) * (nextObsPred[i]))
+                    vknownses[i].append(vknowns[i])
+                    vrewards[i].append(reward[i])
+                    vobs[i].append(vobservation[i])
+                    if done[i]:
+                        # if ended due to time limit - do not treat as "done" for SAC
+                        vdones[i].append(0 if infos[i].get('TimeLimit.truncated', False) else 1)
+                        buff.addElement(vobs[i], vacts[i], vrewards[i], vdones[i], vknownses[i])
+                        numSteps += len(vacts[i])
+                        # start the environment's next trajectory from its reset observation
+                        vobservation[i] = np.array(nextObs[i])
+                        vobs[i] = [vobservation[i]]
+                        vacts[i] = []
+                        vdones[i] = [0]
+                        vknowns[i] = 1
+                        vknownses[i] = [vknowns[i].copy()]
+                        vrewards[i] = []
+                        vhiddenLeft[i] = 0
+                    else:
+                        vdones[i].append(0)
+    else:
+        for envStep in range(args.envSteps):
+            with torch.no_grad():
+                start = min(args.context, len(obs))
+                if args.contextSAC:
+                    obsfeat = torch.tensor(np.array(obs[-start:])).float()
                 else:
-                    # terminated due to the state, not just truncated
-                    dones.append(1)
-
-                # add completed trajectory to buffer
-                buff.addElement(obs, acts, rewards, dones, knownses)
-
-                # keep track of environmental steps taken
-                numSteps += len(acts)
-
-                # reset environment and variables 
-                observation = env.reset()
-                obs = [observation]
-                acts = []
-                dones = [0]
-                knowns = np.ones_like(observation)
-                knownses = [knowns]
-                rewards = []
-                hiddenLeft = 0
-            else:
-                dones.append(0)
+                    obsfeat = torch.tensor(obs[-1]).float().unsqueeze(0)
+                if (envStep % 100) == 55 and step % 10 == 1:
+                    # print(obsfeat.max())
+                    None
+                if args.cuda:
+                    obsfeat = obsfeat.cuda()
+                action = actor.only_action(obsfeat)
+                if args.cuda:
+                    action = action.detach().cpu().numpy().squeeze()
+                else:
+                    action = action.detach().numpy().squeeze()
+                nextObs, reward, done, info = env.step(action)
+                acts.append(action)
+                # get predicted state
+                if beliefTracker is not None:
+                    nextObsPred = beliefTracker.update(obs, knowns, acts, mins=buff.minStateVals, maxes=buff.maxStateVals)
+                else:
+                    nextObsPred = getStateBelief(obs[-start:], knowns, acts[-start:], statepred_target, mins=buff.minStateVals, maxes=buff.maxStateVals)
+                # get actually observed state
+                nextObs, knowns, hiddenLeft = obsFilter(nextObs, args.numHidden, knowns, hiddenLeft)
+                # combine predictions with known values, treat as observation going forward
+                observation = (knowns * nextObs) + ((1 - knowns) * (nextObsPred))
+                knownses.append(knowns)
+                rewards.append(reward)
+                obs.append(observation)
+
+                # trajectory is finished
+                if done:
+                    # if ended due to time limit - do not treat as "done" for SAC
+                    if (info.get('TimeLimit.truncated', False)):
+                        dones.append(0)
+                    else:
+                        # terminated due to the state, not just truncated
+                        dones.append(1)
+
+                    # add completed trajectory to buffer
+                    buff.addElement(obs, acts, rewards, dones, knownses)
+
+                    # keep track of environmental steps taken
+                    numSteps += len(acts)
+
+                    # reset environment and variables 
+                    observation = env.reset()
+                    if beliefTracker is not None:
+                        beliefTracker.reset()
+                    obs = [observation]
+                    acts = []
+                    dones = [0]
+                    knowns = np.ones_like(observation)
+                    knownses = [knowns]
+                    rewards = []
+                    hiddenLeft = 0
+                else:
+                    dones.append(0)
+
     # train state predictive model if we've sampled enough transitions
     if (numSteps) >= args.startLearningState:
         # train state pred network
@@ -762,142 +1047,10 @@ for step in range(int(args.numSteps)):
         for trainstep in range(args.train_batches):
             # 1 update here for every environment step
             # train RRD network
-            samples = buff.sampleSubSeqs(64, 4)
-            # transform samples to np arrays to prep for training
-            obSamp = np.array(samples['obs'])
-            actSamp = np.array(samples['actions'])
-            if len(actSamp.shape) < len(obSamp.shape):
-                actSamp = np.expand_dims(actSamp, -1)
-            ob2Samp = np.array(samples['nextobs'])
-            rewSamp = np.array(samples['rewards'])
-            knownSamp = np.array(samples['knowns'])
-
-            # construct features for RRD network
-            feats = torch.tensor(np.concatenate((obSamp, actSamp, obSamp - ob2Samp), axis=-1)).float()
-            if args.cuda:
-                feats = feats.cuda()
-            
-            # compute predicted rewards
-            rHat = rrder(feats).squeeze(-1)
-
-            # calculate per-trajectory sums
-            episodicSums = torch.mean(rHat, dim=-1, keepdim=True)
-
-            # labels are per-trajectory totals averaged out to each transition (see RRD paper)
-            # stochastically strikes a balance between least-squares and uniform reward decomp
-            labels = torch.tensor(rewSamp).float()
-            if args.cuda:
-                labels = labels.cuda()
-            rrdloss = F.mse_loss(episodicSums, labels)
-
-            # apply gradient descent
-            rrd_opt.zero_grad()
-            rrdloss.backward()
-            rrd_opt.step()
-
-            # train Q-value networks
-            samples = buff.sample(256)
-
-            # transform sample, prep for learning
-            obSamp = np.array([samp['obs'] for samp in samples])
-            actSamp = np.array([samp['actions'] for samp in samples])
-            if len(actSamp.shape) < len(obSamp.shape):
-                actSamp = np.expand_dims(actSamp, -1)
-            nextObsSamp = np.array([samp['nextobs'] for samp in samples])
-            donesSamp = torch.tensor([samp['dones'] for samp in samples]).float().unsqueeze(-1)
-            if args.cuda:
-                donesSamp = donesSamp.cuda()
-
-            with torch.no_grad():
-                # RRD features
-                feats = torch.tensor(np.concatenate((obSamp, actSamp, obSamp - nextObsSamp), axis=-1)).float()
-                # observation features (for actor network)
-                obsfeats = torch.tensor(nextObsSamp).float()
-                if(args.cuda):
-                    feats = feats.cuda()
-                    obsfeats = obsfeats.cuda()
-                # calculate expected rewards
-                rHat = rrder(feats)
-                # re-calculate action from current observation
-                nextActions, logdev, logprob = actor.get_action(obsfeats, debug=False, exploration=True)
-                # using updated action, predict Q values (NOT training networks here)
-                nextFeats = torch.concat([obsfeats, nextActions], dim=-1).float()
-                if args.cuda:
-                    nextFeats = nextFeats.cuda()
-                qtarg1 = qf1_target(nextFeats)
-                qtarg2 = qf2_target(nextFeats)
-                qtargmin = torch.min(qtarg1, qtarg2) - (alpha * logprob)
-                
-                # target Q (label for Q value networks)
-                # see SAC paper for more detailed understanding
-                qtarget = rHat + (args.gamma * (1 - donesSamp) * qtargmin)
-            
-            # feats for Q value networks - training this time!
-            feats = np.concatenate((obSamp, actSamp), axis=-1)
-            feats1 = torch.tensor(feats).float()
-            feats2 = torch.tensor(feats).float()
-            if args.cuda:
-                feats1 = feats1.cuda()
-                feats2 = feats2.cuda()
-            qf1vals = qf1(feats1)
-            qf2vals = qf2(feats2)
-
-            qf1loss = F.mse_loss(qf1vals, qtarget)
-            qf2loss = F.mse_loss(qf2vals, qtarget)
-            qfloss = qf1loss + qf2loss
-
-            q_opt.zero_grad()
-            qfloss.backward()
-            q_opt.step()
-
-
-            # train actor network
-
-            # features for actor network
-            obsfeat = torch.tensor(obSamp).float()
-            if args.cuda:
-                obsfeat = obsfeat.cuda()
-            actSamp, logdev, logprob = actor.get_action(obsfeat, exploration=True)
-            # features for Q value networks, using new action
-            feats = torch.concat((obsfeat, actSamp), dim=-1).float()
-            if args.cuda:
-                feats = feats.cuda()
-            # disable gradient computation for Q value networks
-            # can't use torch.no_grad because we NEED grad to backpropagate to actor
-            for p1, p2 in zip(qf1.parameters(), qf2.parameters()):
-                p1.requires_grad = False
-                p2.requires_grad = False
-            qf1vals = qf1(feats)
-            qf2vals = qf2(feats)
-            # compute actor loss
-            actloss = torch.mean((alpha * logprob) - torch.min(qf1vals, qf2vals))
-
-            act_opt.zero_grad()
-            actloss.backward()
-            act_opt.step()
-            # re-enable gradient for q value nets
-            for p1, p2 in zip(qf1.parameters(), qf2.parameters()):
-                p1.requires_grad = True
-                p2.requires_grad = True
-            # if we're learning alpha, update it here based on logprop from actor network and shape of action space
-            if (args.alpha_lr > 0):
-                alpha_opt.zero_grad()
-                with torch.no_grad():
-                    multiplier = logprob - np.prod(env.action_space.shape)
-                aloss = -1.0*(torch.exp(logalpha) * multiplier).mean()
-                aloss.backward()
-                alpha_opt.step()
-                alpha = torch.exp(logalpha)
-
-            # update target networks
-            with torch.no_grad():
-                for qt1w, qf1w in zip(qf1_target.parameters(), qf1.parameters()):
-                    qt1w.data.copy_(0.995 * qt1w.data + (.005 * qf1w.data))
-                for qt2w, qf2w in zip(qf2_target.parameters(), qf2.parameters()):
-                    qt2w.data.copy_(0.995 * qt2w.data + (.005 * qf2w.data))
-                if args.statepred:
-                    for spt, sp in zip(statepred_target.parameters(), statepred.parameters()):
-                        spt.data.copy_(0.995 * spt.data + (.005 * sp.data))
+            rrdloss = learner.update_rrd(buff.sampleSubSeqs(64, 4))
+            # train Q-value networks and actor network (and alpha), then update target networks
+            qfloss, actloss = learner.update(buff.sampleBatch(256))
+            alpha = learner.alpha
     # report current results
     if numSteps >= args.startLearningState:
         if (step % 50) == 0 or (step == args.numSteps - 1):
@@ -935,6 +1088,10 @@ for step in range(int(args.numSteps)):
                     print(f"Steps: {step * args.envSteps}, Time: {time.time() - starttime:.3f}s, Test rewards: {rewardList[-1]:.3f}, Actor loss: {actloss.item():.3e}, Q loss: {qfloss.item():.3e}, RRD loss: {rrdloss.item():.3e}, Alpha: {alpha:.3e}")    
             else:
                 print(rewardList[-1])
+            if beliefTracker is not None and args.checkBelief:
+                print(f"Carried vs windowed belief, max difference: {beliefTracker.maxDiff:.3e} (first {args.context} steps), {beliefTracker.maxDiffBeyond:.3e} (later steps)")
+            bufferBytes, bytesPerTransition = buff.memoryUsage()
+            print(f"Buffer memory: {bufferBytes / 1e6:.1f}MB, {bytesPerTransition:.1f} bytes/transition")
 
             # save rewards, RRD, and SAC losses to files
             if (args.logging):
@@ -946,3 +1103,6 @@ for step in range(int(args.numSteps)):
                     np.savetxt(f"{foldern}/actloss/{fname}", actlosslist, delimiter="\n")
                     np.savetxt(f"{foldern}/qfloss/{fname}", qflosslist, delimiter="\n")
                     np.savetxt(f"{foldern}/rrdloss/{fname}", rrdlosslist, delimiter="\n")
+
+if args.numEnvs > 1:
+    venv.close()
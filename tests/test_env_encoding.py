@@ -0,0 +1,88 @@
+import os
+import numpy as np
+import pytest
+import torch
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+import sys
+sys.path.insert(0, REPO)
+import mdiabetesEnv
+from mdiabetesEnv import DiabetesEnv, _padded_binary, _onehot_response
+
+# DiabetesEnv's table based feature rows against the original per step encoding
+#    (_padded_binary / _onehot_response joined with np.append over newest first history lists)
+
+def old_new_rows(env, state, lastMs, lastQs, lastRs):
+    toReturn = [None, None]
+    for y in [0, 1]:
+        toReturn[y] = state
+        for x in range(env.numHist - 1):
+            toReturn[y] = np.append(_onehot_response(lastRs[x][y], 3), toReturn[y])
+        for x in range(env.numHist):
+            toReturn[y] = np.append(toReturn[y], _padded_binary(env.mmap[lastMs[x][y]], env.maxSId))
+            toReturn[y] = np.append(toReturn[y], _padded_binary(env.qmap[lastQs[x][y]], env.maxSId))
+            toReturn[y] = np.append(toReturn[y], _padded_binary(lastMs[x][y], env.maxMsgId))
+            toReturn[y] = np.append(toReturn[y], _padded_binary(lastQs[x][y], env.maxQId))
+    return toReturn
+
+def old_final_feats(env, lastMs, lastQs, lastRs):
+    feats = []
+    for x in range(len(lastRs) - 1, env.numHist, -1):
+        toReturn = np.array(env.currentStartedState)
+        for qid in lastQs[x]:
+            toReturn = np.append(_padded_binary(qid, env.maxQId), toReturn)
+        for mid in lastMs[x]:
+            toReturn = np.append(_padded_binary(mid, env.maxMsgId), toReturn)
+        for res in lastRs[x]:
+            toReturn = np.append(_onehot_response(res, 3), toReturn)
+        feats.append(toReturn)
+    return torch.tensor(np.stack(feats)).float()
+
+class RecordingInference():
+    # random answers, keeps a copy of every batch of rows the env asks about
+    def __init__(self, rng):
+        self.rng = rng
+        self.rows = []
+
+    def predict_classes(self, rows):
+        self.rows.append(np.array(rows))
+        return self.rng.randint(0, 4, size=len(rows))
+
+@pytest.fixture
+def makeEnv(monkeypatch):
+    # the category maps are read from the repo root, the behavior model is not needed
+    monkeypatch.chdir(REPO)
+    monkeypatch.setattr(mdiabetesEnv, "_load_behavior_model", lambda cuda=False: torch.nn.Linear(1, 1))
+    def make(numHist, seed):
+        rng = np.random.RandomState(seed)
+        startingStates = [rng.randint(0, 4, size=40).astype(float) for _ in range(5)]
+        eqmodel = lambda feats: torch.zeros(17)
+        env = DiabetesEnv(startingStates, eqmodel, 0.9, True, numHist=numHist, seed=seed)
+        env.inference = RecordingInference(rng)
+        return env, rng
+    return make
+
+@pytest.mark.parametrize("numHist", [2, 3, 4])
+def test_encoding_matches_append_version(makeEnv, numHist):
+    for seed in range(3):
+        env, rng = makeEnv(numHist, seed)
+        env.reset()
+        lastMs = [np.zeros([2], dtype=int) for x in range(numHist)]
+        lastQs = [np.zeros([2], dtype=int) for x in range(numHist)]
+        lastRs = [np.zeros([2], dtype=int) for x in range(numHist - 1)]
+        done = False
+        while not done:
+            week = env.numEpochs
+            # rows are encoded before step decays the state (rewardState is the same array)
+            state = env.currentStartedState.copy()
+            _, _, _, done, _ = env.step(rng.uniform(-1, 1, size=4))
+            lastMs = [env.histMs[week % numHist].copy()] + lastMs
+            lastQs = [env.histQs[week % numHist].copy()] + lastQs
+            old = old_new_rows(env, state, lastMs, lastQs, lastRs)
+            np.testing.assert_array_equal(env.inference.rows[-1], np.stack(old))
+            lastRs = [env.histRs[week % env.histRs.shape[0]].copy()] + lastRs
+            # end questionnaire rows so far (none before the third week)
+            if 2 <= week < env.episodeLength - 1:
+                assert torch.equal(env.encode_final_statepred_feats(), old_final_feats(env, lastMs, lastQs, lastRs))
+        assert torch.equal(env.encode_final_statepred_feats(), old_final_feats(env, lastMs, lastQs, lastRs))
@@ -0,0 +1,114 @@
+import torch
+import numpy as np
+import time
+from collections import deque
+from utils.model_export import trace_model
+
+# Inference wrapper for the behavior model used by the simulator (mdiabetesEnv.py)
+# Many single row calls are the slow part of a rollout, so this
+#    - runs every call under inference_mode (no autograd bookkeeping)
+#    - can swap the module for a TorchScript trace, torch.compile, or a plain numpy MLP
+#    - records the latency of every model call
+# backends:
+#    "torch"       the model as is
+#    "torchscript" torch.jit.trace of the model
+#    "compile"     torch.compile (falls back to "torch" if this torch does not have it)
+#    "numpy"       numpy forward pass for BasicNN style models
+#                  (input layer, relu, output heads, not hierarchical), else falls back to "torch"
+BACKENDS = ["torch", "torchscript", "compile", "numpy"]
+
+def _inference_context():
+    # inference_mode is newer than no_grad and skips more autograd work
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+class NumpyMLP():
+    # numpy copy of BasicNN.forward for non hierarchical models
+    def __init__(self, model):
+        self.w1 = model.inputLayer.weight.detach().cpu().numpy().T.copy()
+        self.b1 = model.inputLayer.bias.detach().cpu().numpy().copy()
+        self.heads = [(layer.weight.detach().cpu().numpy().T.copy(), layer.bias.detach().cpu().numpy().copy())
+                      for layer in model.head_layers()]
+        self.regression = model.regression
+
+    @staticmethod
+    def supports(model):
+        return (hasattr(model, "inputLayer") and hasattr(model, "head_layers")
+                and not getattr(model, "transformer", False) and model.hierarchical != "Shared")
+
+    def __call__(self, x):
+        hidden = np.maximum(x @ self.w1 + self.b1, 0)
+        preds = []
+        for w, b in self.heads:
+            out = hidden @ w + b
+            if (self.regression):
+                out = np.maximum(out, 0)
+            else:
+                out = np.exp(out - out.max(axis=-1, keepdims=True))
+                out = out / out.sum(axis=-1, keepdims=True)
+            preds.append(out)
+        return np.concatenate(preds, -1), None
+
+class BehaviorInference():
+    def __init__(self, model, backend="torch", device="cpu"):
+        # model: behavior model (pickled module or utils.model_export.ExportedModel)
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend {backend}, expected one of {BACKENDS}")
+        self.model = model
+        self.device = device
+        # seconds per model call, only the most recent calls are kept
+        self.latencies = deque(maxlen=100000)
+        if (backend == "numpy" and not NumpyMLP.supports(model)):
+            backend = "torch"
+        if (backend == "compile" and not hasattr(torch, "compile")):
+            backend = "torch"
+        if (backend == "torchscript" and not isinstance(model, torch.nn.Module)):
+            # already exported
+            backend = "torch"
+        self.backend = backend
+        if (backend == "numpy"):
+            self.fn = NumpyMLP(model)
+        elif (backend == "compile"):
+            self.fn = torch.compile(model)
+        elif (backend == "torchscript"):
+            traced = trace_model(model)[0].to(device)
+            if (model.hierarchical == "Shared"):
+                self.fn = traced
+            else:
+                self.fn = lambda x: (traced(x), None)
+        else:
+            self.fn = model
+
+    def predict(self, rows):
+        # rows: [BATCH, input_size] numpy array or tensor
+        # returns (pred, RvsNR) as numpy arrays (RvsNR None if the model has none)
+        start = time.perf_counter()
+        if (self.backend == "numpy"):
+            pred, RvsNR = self.fn(np.asarray(rows, dtype=np.float32))
+        else:
+            x = torch.as_tensor(rows).float()
+            if (self.device != "cpu"):
+                x = x.to(self.device)
+            with _inference_context():
+                pred, RvsNR = self.fn(x)
+            pred = pred.cpu().numpy()
+            if RvsNR is not None:
+                RvsNR = RvsNR.cpu().numpy()
+        self.latencies.append(time.perf_counter() - start)
+        return pred, RvsNR
+
+    def predict_classes(self, rows):
+        # most likely response class for each row
+        pred, RvsNR = self.predict(rows)
+        return pred.argmax(-1)
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        # latency of model calls so far in milliseconds
+        if len(self.latencies) == 0:
+            return {}
+        values = np.percentile(np.array(self.latencies) * 1000, percentiles)
+        return dict(zip([f"p{p}" for p in percentiles], [float(v) for v in values]))
+
+    def reset_latencies(self):
+        self.latencies.clear()
@@ -0,0 +1,39 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# N Q networks (same layout as SoftQNetwork: 2 relu hidden layers, 1 output) kept as stacked
+#    [members, in, out] weights, so all of them are evaluated with one batched matmul per layer
+# Used in place of qf1 / qf2 (ensemble size 2) or as a REDQ style critic (larger ensembles)
+class EnsembleQNetwork(nn.Module):
+    def __init__(self, inputSize, hiddenSize, ensembleSize=2, bias_const=0.1):
+        super().__init__()
+        self.ensembleSize = ensembleSize
+        self.w1, self.b1 = self._layer(inputSize, hiddenSize, bias_const)
+        self.w2, self.b2 = self._layer(hiddenSize, hiddenSize, bias_const)
+        self.wq, self.bq = self._layer(hiddenSize, 1, bias_const)
+
+    # stacked weights / biases, each member initialized like layer_init does for an nn.Linear
+    def _layer(self, inSize, outSize, bias_const):
+        weight = torch.empty(self.ensembleSize, inSize, outSize)
+        for member in weight:
+            nn.init.xavier_uniform_(member)
+        bias = torch.full((self.ensembleSize, 1, outSize), bias_const)
+        return nn.Parameter(weight), nn.Parameter(bias)
+
+    # x: [batch, in] (same input for every member) or [members, batch, in]
+    # returns Q values [members, batch, 1]
+    def forward(self, x):
+        if x.dim() == 2:
+            x = x.unsqueeze(0).expand(self.ensembleSize, -1, -1)
+        x = F.relu(torch.baddbmm(self.b1, x, self.w1))
+        x = F.relu(torch.baddbmm(self.b2, x, self.w2))
+        return torch.baddbmm(self.bq, x, self.wq)
+
+    # copy weights from separate SoftQNetwork style modules (fc1, fc2, fc_q), one per member
+    def loadMembers(self, nets):
+        with torch.no_grad():
+            for i, net in enumerate(nets):
+                for w, b, layer in [(self.w1, self.b1, net.fc1), (self.w2, self.b2, net.fc2), (self.wq, self.bq, net.fc_q)]:
+                    w[i].copy_(layer.weight.t())
+                    b[i, 0].copy_(layer.bias)
@@ -0,0 +1,274 @@
+import numpy as np
+import torch
+import json
+import os
+from collections import deque
+
+# Replay buffer kept in memory-mapped files under a run directory, same sampling API as
+#    mujoco_exp.Buffer (addElement, sample, sampleBatch, sampleSubSeqs, sampleForStatePred, minStateVals / maxStateVals)
+# Only the pages being sampled need to be resident, so the buffer can be larger than RAM,
+#    and the files plus a small metadata file let a restarted run reopen the buffer
+# Layout: one row per step, each episode of length L takes L + 1 consecutive rows
+#    (the last row holds the final observation), written as a ring over the rows
+# Files in runDir:
+#    steps.dat     obs || action per row (float32 if compact)
+#    knowns.dat    knowns mask per row (bit-packed if compact)
+#    dones.dat     dones per row
+#    rewards.dat   reward per transition row
+#    episode.dat   id of the episode stored in each row, -1 if none
+#    step.dat      timestep of each row in its episode, -1 for final observation rows
+#    buffer.json / episodes.npz   scalars and the live episode table, rewritten after every episode
+
+# [len(lengths), subLen] random offsets into episodes of the given lengths,
+# without repeats for episodes with at least subLen transitions (like np.random.choice)
+def subSeqOffsets(lengths, subLen):
+    lengths = np.asarray(lengths)
+    offsets = np.floor(np.random.rand(len(lengths), subLen) * lengths[:, None]).astype(np.int64)
+    long = lengths >= subLen
+    if long.any():
+        # random order of each long episode's offsets, padding past the length sorts last
+        keys = np.random.rand(long.sum(), lengths.max())
+        keys[np.arange(lengths.max())[None, :] >= lengths[long][:, None]] = 2
+        offsets[long] = np.argsort(keys, axis=1)[:, :subLen]
+    return offsets
+
+class MmapBuffer:
+    def __init__(self, runDir, numElements, context, compact=False, rowCapacity=None):
+        self.runDir = runDir
+        self.n = numElements
+        self.context = context
+        self.compact = compact
+        # rows needed are no. transitions + 1 per episode, extra rows keep short episodes from evicting early
+        self.capacity = rowCapacity if rowCapacity is not None else numElements + numElements // 4 + 1
+        self.count = 0
+        self.head = 0
+        self.filled = 0
+        self.nextEpisode = 0
+        self.minStateVals = None
+        self.maxStateVals = None
+        self.obsDim = None
+        # live episodes oldest first: id -> (first row, length)
+        self.episodes = {}
+        self.meanRewards = {}
+        self.episodeIds = []
+        self.episodePos = {}
+        self.ring = deque()
+        # rows holding a transition of a live episode (sampleRows), None when episodes changed since it was built
+        self.liveRows = None
+        os.makedirs(runDir, exist_ok=True)
+        if os.path.exists(self._path("buffer.json")):
+            self._reopen()
+
+    def _path(self, name):
+        return os.path.join(self.runDir, name)
+
+    def _open(self, mode):
+        obsDim, actDim = self.obsDim, self.actDim
+        floatType = np.float32 if self.compact else np.float64
+        knownsShape = ((obsDim + 7) // 8,) if self.compact else (obsDim,)
+        self.steps = np.memmap(self._path("steps.dat"), dtype=floatType, mode=mode, shape=(self.capacity, obsDim + actDim))
+        self.knowns = np.memmap(self._path("knowns.dat"), dtype=np.uint8 if self.compact else floatType, mode=mode, shape=(self.capacity,) + knownsShape)
+        self.dones = np.memmap(self._path("dones.dat"), dtype=np.uint8, mode=mode, shape=(self.capacity,))
+        self.rewards = np.memmap(self._path("rewards.dat"), dtype=floatType, mode=mode, shape=(self.capacity,))
+        self.episode_id = np.memmap(self._path("episode.dat"), dtype=np.int64, mode=mode, shape=(self.capacity,))
+        self.step_idx = np.memmap(self._path("step.dat"), dtype=np.int32, mode=mode, shape=(self.capacity,))
+        if mode == "w+":
+            self.episode_id[:] = -1
+            self.step_idx[:] = -1
+
+    def _reopen(self):
+        with open(self._path("buffer.json"), "r") as fp:
+            meta = json.load(fp)
+        if meta["compact"] != self.compact:
+            raise ValueError(f"Buffer in {self.runDir} was written with compact={meta['compact']}")
+        for key in ["capacity", "head", "filled", "nextEpisode", "obsDim", "actDim"]:
+            setattr(self, key, meta[key])
+        if meta["minStateVals"] is not None:
+            self.minStateVals = np.array(meta["minStateVals"])
+            self.maxStateVals = np.array(meta["maxStateVals"])
+        if self.obsDim is None:
+            return
+        self._open("r+")
+        table = np.load(self._path("episodes.npz"))
+        for episode, start, length, meanReward in zip(table["ids"], table["starts"], table["lengths"], table["meanRewards"]):
+            episode, start, length = int(episode), int(start), int(length)
+            # an episode whose rows were overwritten after the last metadata write is dropped
+            if not (self.episode_id[start:start + length + 1] == episode).all():
+                continue
+            self._register(episode, start, length, float(meanReward))
+        # rows claimed by episodes the table does not know about are free
+        live = np.zeros(self.capacity, dtype=bool)
+        for start, length in self.episodes.values():
+            live[start:start + length + 1] = True
+        self.episode_id[~live] = -1
+
+    def flush(self):
+        # write data, then the metadata describing it
+        if self.obsDim is not None:
+            for arr in [self.steps, self.knowns, self.dones, self.rewards, self.episode_id, self.step_idx]:
+                arr.flush()
+            ids = np.array(list(self.episodes.keys()), dtype=np.int64)
+            rows = np.array(list(self.episodes.values()), dtype=np.int64).reshape(-1, 2)
+            np.savez(self._path("episodes.tmp.npz"), ids=ids, starts=rows[:, 0], lengths=rows[:, 1],
+                     meanRewards=np.array([self.meanRewards[e] for e in ids], dtype=np.float64))
+            os.replace(self._path("episodes.tmp.npz"), self._path("episodes.npz"))
+        meta = {
+            "compact": self.compact,
+            "capacity": self.capacity,
+            "head": self.head,
+            "filled": self.filled,
+            "nextEpisode": self.nextEpisode,
+            "obsDim": self.obsDim,
+            "actDim": getattr(self, "actDim", None),
+            "minStateVals": None if self.minStateVals is None else self.minStateVals.tolist(),
+            "maxStateVals": None if self.maxStateVals is None else self.maxStateVals.tolist(),
+        }
+        with open(self._path("buffer.tmp.json"), "w") as fp:
+            json.dump(meta, fp)
+        os.replace(self._path("buffer.tmp.json"), self._path("buffer.json"))
+
+    def _register(self, episode, start, length, meanReward):
+        self.episodes[episode] = (start, length)
+        self.meanRewards[episode] = meanReward
+        self.episodePos[episode] = len(self.episodeIds)
+        self.episodeIds.append(episode)
+        self.ring.append(episode)
+        self.count += length
+        self.liveRows = None
+
+    def _evict(self, episode):
+        start, length = self.episodes.pop(episode)
+        self.episode_id[start:start + length + 1] = -1
+        self.count -= length
+        self.liveRows = None
+        self.meanRewards.pop(episode)
+        pos = self.episodePos.pop(episode)
+        last = self.episodeIds.pop()
+        if last != episode:
+            self.episodeIds[pos] = last
+            self.episodePos[last] = pos
+
+    def addElement(self, obs, act, rew, dones, knownses):
+        # keep track of min/max observation
+        tempObsMax = np.max(obs, axis=0)
+        tempObsMin = np.min(obs, axis=0)
+        if (self.minStateVals is None):
+            self.maxStateVals = tempObsMax
+            self.minStateVals = tempObsMin
+        else:
+            self.maxStateVals = np.maximum(self.maxStateVals, tempObsMax)
+            self.minStateVals = np.minimum(self.minStateVals, tempObsMin)
+
+        obs = np.stack(obs, axis=0)
+        act = np.stack(act, axis=0)
+        knownses = np.stack(knownses, axis=0)
+        length = len(act)
+        if self.obsDim is None:
+            self.obsDim = obs.shape[1]
+            self.actDim = act.shape[1]
+            self._open("w+")
+        if length + 1 > self.capacity:
+            raise ValueError(f"Episode of length {length} does not fit in {self.capacity} buffer rows")
+        # wrap the ring, then evict whatever is stored where this episode goes
+        if self.head + length + 1 > self.capacity:
+            self.filled = max(self.filled, self.head)
+            self.head = 0
+        for episode in np.unique(self.episode_id[self.head:self.head + length + 1]):
+            if episode >= 0:
+                self._evict(int(episode))
+        rows = slice(self.head, self.head + length + 1)
+        self.steps[rows, :self.obsDim] = obs
+        self.steps[self.head:self.head + length, self.obsDim:] = act
+        self.steps[self.head + length, self.obsDim:] = 0
+        self.knowns[rows] = np.packbits(knownses > 0, axis=1) if self.compact else knownses
+        self.dones[rows] = np.stack(dones, axis=0)
+        self.rewards[self.head:self.head + length] = np.stack(rew, axis=0)[:length]
+        self.episode_id[rows] = self.nextEpisode
+        self.step_idx[self.head:self.head + length] = np.arange(length)
+        self.step_idx[self.head + length] = -1
+        self._register(self.nextEpisode, self.head, length, float(np.mean(rew)))
+        self.nextEpisode += 1
+        self.head += length + 1
+        self.filled = max(self.filled, self.head)
+        # oldest episodes go first, never the one just added
+        while self.count > self.n and len(self.ring) > 1:
+            episode = self.ring.popleft()
+            if episode in self.episodes:
+                self._evict(episode)
+        self.flush()
+
+    def getKnowns(self, rows):
+        if self.compact:
+            return np.unpackbits(self.knowns[rows], axis=-1, count=self.obsDim).astype(np.float32)
+        return np.asarray(self.knowns[rows])
+
+    def _liveRows(self):
+        # transition rows (not final observations) of every live episode, in row order
+        # built from the episode table, so sampling never reads the episode_id / step_idx pages
+        if self.liveRows is None:
+            table = np.array(list(self.episodes.values()), dtype=np.int64).reshape(-1, 2)
+            table = table[np.argsort(table[:, 0])]
+            starts, lengths = table[:, 0], table[:, 1]
+            # first row of each row's episode + the row's step in it
+            steps = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            self.liveRows = np.repeat(starts, lengths) + steps
+        return self.liveRows
+
+    def sampleRows(self, size):
+        # uniform over stored transitions, without replacement unless size > count (like np.random.choice)
+        live = self._liveRows()
+        return live[np.random.choice(len(live), size, replace=size>len(live))]
+
+    def _transitions(self, rows):
+        return {
+            'obs': np.asarray(self.steps[rows, :self.obsDim]),
+            'actions': np.asarray(self.steps[rows, self.obsDim:]),
+            'nextobs': np.asarray(self.steps[rows + 1, :self.obsDim]),
+            'dones': np.asarray(self.dones[rows + 1]),
+            'knowns': self.getKnowns(rows),
+            'nextknowns': self.getKnowns(rows + 1),
+            'rewards': np.asarray(self.rewards[rows])}
+
+    def sample(self, size):
+        # list of per transition dicts, like Buffer.sample
+        batch = self._transitions(np.sort(self.sampleRows(size)))
+        return [dict([(key, batch[key][i]) for key in batch]) for i in range(size)]
+
+    def sampleBatch(self, size):
+        # same transitions as sample, as a dict of [size, ...] tensors
+        batch = self._transitions(np.sort(self.sampleRows(size)))
+        for key in batch:
+            batch[key] = torch.from_numpy(batch[key]).float()
+        return batch
+
+    def sampleSubSeqs(self, subLen, numSubs):
+        # [numSubs, subLen, ...] tensors, rewards are the episodes' mean rewards [numSubs, 1]
+        idxs = np.random.choice(len(self.episodeIds), numSubs, replace = numSubs>len(self.episodeIds))
+        episodes = [self.episodeIds[i] for i in idxs]
+        starts = np.array([self.episodes[e][0] for e in episodes])
+        lengths = np.array([self.episodes[e][1] for e in episodes])
+        batch = self._transitions(starts[:, None] + subSeqOffsets(lengths, subLen))
+        batch['rewards'] = np.array([[self.meanRewards[e]] for e in episodes])
+        for key in batch:
+            batch[key] = torch.from_numpy(batch[key]).float()
+        return batch
+
+    def sampleForStatePred(self, size):
+        # same windows as Trajectory.retrieveStateFeatures, gathered with one fancy index
+        rows = self.sampleRows(size)
+        lengths = np.minimum(self.step_idx[rows], self.context) + 1
+        steps = np.arange(lengths.max())
+        valid = steps[None, :] < lengths[:, None]
+        windowRows = np.where(valid, (rows - lengths + 1)[:, None] + steps[None, :], rows[:, None])
+        feats = self.steps[windowRows] * valid[:, :, None]
+        labels = self.steps[rows + 1, :self.obsDim] - self.steps[rows, :self.obsDim]
+        # shape is (sequence, batch, features)
+        feats = torch.from_numpy(np.ascontiguousarray(feats.transpose(1, 0, 2))).float()
+        return feats, labels, self.getKnowns(rows + 1), lengths.tolist()
+
+    # size of the buffer files: (total bytes, bytes per transition)
+    def memoryUsage(self):
+        if self.obsDim is None:
+            return 0, 0
+        total = sum([arr.nbytes for arr in [self.steps, self.knowns, self.dones, self.rewards, self.episode_id, self.step_idx]])
+        return total, total / max(self.count, 1)
@@ -0,0 +1,145 @@
+import torch
+import json
+import copy
+import os
+import argparse
+
+# Export trained behavior models (BasicNN / AdaptableLSTM) to TorchScript (and optionally ONNX)
+#    plus a json schema sidecar, and load them back without the project's model classes.
+# Files written for prefix p:
+#    p.ts          TorchScript module, forward(x) -> pred (or (pred, RvsNR) for hierarchical Shared)
+#    p.onnx        optional ONNX graph of the same module
+#    p.schema.json feature layout and model options
+# Loading only needs torch (and onnxruntime for onnx), so experiment.py / transformers are never imported.
+
+SCHEMA_VERSION = 1
+
+class _ExportWrapper(torch.nn.Module):
+    # traced modules cannot return None, so only return RvsNR when the model makes one
+    def __init__(self, model, withRvsNR):
+        super().__init__()
+        self.model = model
+        self.withRvsNR = withRvsNR
+
+    def forward(self, x):
+        pred, RvsNR = self.model(x)
+        if self.withRvsNR:
+            return pred, RvsNR
+        return pred
+
+def model_schema(model, feature_names=None):
+    # everything needed to build inputs for / interpret outputs of an exported model
+    schema = {
+        "version": SCHEMA_VERSION,
+        "model": type(model).__name__,
+        "input_size": model.input_size,
+        "hidden_size": model.hidden_size,
+        "output_size": model.output_size,
+        "splitModel": model.splitModel,
+        "splitWeeklyQuestions": model.splitWeeklyQuestions,
+        "hierarchical": model.hierarchical,
+        "regression": model.regression,
+        "no_response_class": model.no_response_class,
+        "transformer": getattr(model, "transformer", False),
+        # LSTM models take a whole participant history [weeks, input_size],
+        #    BasicNN takes any batch of rows [rows, input_size]
+        "sequence_input": hasattr(model, "lstm"),
+        "outputs": ["pred", "RvsNR"] if model.hierarchical == "Shared" else ["pred"],
+    }
+    if feature_names is not None:
+        feature_names = [str(f) for f in feature_names]
+        if len(feature_names) != model.input_size:
+            raise ValueError(f"{len(feature_names)} feature names for a model with {model.input_size} inputs")
+        schema["features"] = feature_names
+    return schema
+
+def trace_model(model, example_rows=5):
+    # TorchScript trace of a copy of model in eval mode, returns (traced, example, wrapper)
+    # the copy uses fusedHeads so split models have no data dependent branches to freeze
+    # traced(x) returns pred, or (pred, RvsNR) for hierarchical Shared models
+    model = copy.deepcopy(model).cpu().eval()
+    model.fusedHeads = True
+    if hasattr(model, "causalMasks"):
+        # rebuild the attention mask inside the trace so any sequence length works
+        model.causalMasks = {}
+    wrapper = _ExportWrapper(model, model.hierarchical == "Shared").eval()
+    # example with all category codes so every path is exercised
+    example = torch.zeros([example_rows, model.input_size])
+    cats = torch.tensor([[0., 0.], [0., 1.], [1., 0.], [1., 1.]])
+    example[:, -2:] = cats[torch.arange(example_rows) % 4]
+    example[:, -4:-2] = cats[(torch.arange(example_rows) + 1) % 4]
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, example)
+    return traced, example, wrapper
+
+def export_model(model, prefix, feature_names=None, onnx=False, example_rows=5):
+    # write prefix.ts, prefix.schema.json (and prefix.onnx if onnx)
+    # the model itself is not modified, a copy is traced in eval mode
+    schema = model_schema(model, feature_names)
+    traced, example, wrapper = trace_model(model, example_rows)
+    traced.save(f"{prefix}.ts")
+    if (onnx):
+        torch.onnx.export(wrapper, example, f"{prefix}.onnx",
+                          input_names=["x"], output_names=schema["outputs"],
+                          dynamic_axes=dict([(name, {0: "rows"}) for name in ["x"] + schema["outputs"]]))
+        schema["onnx"] = True
+    with open(f"{prefix}.schema.json", "w") as fp:
+        json.dump(schema, fp, indent=2)
+    return schema
+
+class ExportedModel():
+    # callable like the original model: model(x) -> (pred, RvsNR), RvsNR None if not hierarchical
+    def __init__(self, prefix, device="cpu", backend="torchscript"):
+        with open(f"{prefix}.schema.json", "r") as fp:
+            self.schema = json.load(fp)
+        self.device = device
+        self.backend = backend
+        if (backend == "onnx"):
+            import onnxruntime
+            self.session = onnxruntime.InferenceSession(f"{prefix}.onnx")
+        else:
+            self.module = torch.jit.load(f"{prefix}.ts", map_location=device)
+            self.module.eval()
+
+    def __call__(self, x):
+        if (self.backend == "onnx"):
+            outs = self.session.run(None, {"x": x.detach().cpu().float().numpy()})
+            outs = [torch.from_numpy(out) for out in outs]
+        else:
+            outs = self.module(x.to(self.device))
+            if (len(self.schema["outputs"]) == 1):
+                outs = [outs]
+        if (len(outs) == 1):
+            return outs[0], None
+        return outs[0], outs[1]
+
+    def eval(self):
+        # already in eval mode, here so it can stand in for the pickled model
+        return self
+
+    def cuda(self):
+        if (self.backend != "onnx"):
+            self.device = "cuda"
+            self.module = self.module.cuda()
+        return self
+
+def load_exported(prefix, device="cpu", backend="torchscript"):
+    return ExportedModel(prefix, device, backend)
+
+def exported_exists(prefix, backend="torchscript"):
+    ext = "onnx" if backend == "onnx" else "ts"
+    return os.path.exists(f"{prefix}.{ext}") and os.path.exists(f"{prefix}.schema.json")
+
+if __name__ == "__main__":
+    # export an already saved (pickled) model, eg
+    #    python -m utils.model_export trainedDiabetesPred.pt
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=str, help="model saved with torch.save")
+    parser.add_argument('-out', type=str, default=None, help="output prefix, defaults to the model path without .pt")
+    parser.add_argument('-onnx', type=lambda x: (str(x).lower() in ['true', '1', 't']), default=False)
+    args = parser.parse_args()
+    out = args.out
+    if out is None:
+        out = os.path.splitext(args.model)[0]
+    schema = export_model(torch.load(args.model, map_location="cpu"), out, onnx=args.onnx)
+    print(f"exported {schema['model']} to {out}.ts")
@@ -0,0 +1,180 @@
+import torch
+import torch.nn.functional as F
+
+# RRD + SAC update steps shared by mdiabetes_rl_exp.py and mujoco_exp.py
+#    - each sampled batch is moved to the device in one copy (fields packed into one tensor)
+#    - the (obs, action) critic features are built once and used by both Q networks
+#    - target networks are soft updated with torch._foreach ops over whole parameter lists
+#    - the loss computations can be torch.compile'd (compile=True, ignored if this torch has no compile)
+#    - qf1 / qf1_target can be EnsembleQNetworks (utils/ensemble_critic.py) with qf2 / qf2_target None
+#    - the networks can be stacked over seeds (utils/seed_stack.py): batches then have a leading seed
+#      dimension, logalpha holds one value per seed, and the losses returned are per seed ([seeds])
+
+def soft_update(targetParams, params, tau):
+    # target = (1 - tau) * target + tau * source for every pair of parameters
+    with torch.no_grad():
+        if hasattr(torch, "_foreach_mul_"):
+            torch._foreach_mul_(targetParams, 1 - tau)
+            torch._foreach_add_(targetParams, params, alpha=tau)
+        else:
+            for t, p in zip(targetParams, params):
+                t.mul_(1 - tau).add_(p, alpha=tau)
+
+def to_device(batch, device):
+    # dict of tensors with the same first dimension -> same dict on device, one host to device copy
+    if device == "cpu":
+        return batch
+    keys = list(batch.keys())
+    first = batch[keys[0]].shape[0]
+    flat = torch.cat([batch[key].reshape(first, -1).float() for key in keys], dim=1)
+    if flat.device.type == "cpu" and not flat.is_pinned():
+        flat = flat.pin_memory()
+    flat = flat.to(device, non_blocking=True)
+    widths = [batch[key].reshape(first, -1).shape[1] for key in keys]
+    return dict([(key, part.reshape(batch[key].shape)) for key, part in zip(keys, flat.split(widths, dim=1))])
+
+class SACLearner():
+    def __init__(self, actor, qf1, qf2, qf1_target, qf2_target, rrder, q_opt, act_opt, rrd_opt, gamma, actionSize,
+                 alpha, logalpha=None, alpha_opt=None, extraTargets=[], tau=0.005, device="cpu", compile=False, rrdZeroGrad=True,
+                 targetMembers=2, actorMean=False):
+        # alpha: fixed entropy weight, or the current exp(logalpha) when logalpha / alpha_opt are given
+        # extraTargets: (target, source) module pairs soft updated along with the Q targets (eg state predictor)
+        # rrdZeroGrad: clear RRD gradients before each RRD step
+        # targetMembers: the target Q is the min over this many randomly chosen members (all of them if the ensemble is that small)
+        # actorMean: actor maximizes the mean Q over the members instead of the min (REDQ)
+        self.actor = actor
+        self.qf1 = qf1
+        self.qf2 = qf2
+        self.qf1_target = qf1_target
+        self.qf2_target = qf2_target
+        self.rrder = rrder
+        self.q_opt = q_opt
+        self.act_opt = act_opt
+        self.rrd_opt = rrd_opt
+        self.gamma = gamma
+        self.actionSize = actionSize
+        self.alpha = alpha
+        self.logalpha = logalpha
+        self.alpha_opt = alpha_opt
+        self.tau = tau
+        self.device = device
+        self.rrdZeroGrad = rrdZeroGrad
+        self.targetMembers = targetMembers
+        self.actorMean = actorMean
+        # Q networks and their targets, as lists evaluated together by _qvals
+        self.qfs = [qf for qf in (qf1, qf2) if qf is not None]
+        self.qf_targets = [qf for qf in (qf1_target, qf2_target) if qf is not None]
+        self.qParams = [p for qf in self.qfs for p in qf.parameters()]
+        # parameter lists for the soft updates, built once
+        self.targetParams = [p for qf in self.qf_targets for p in qf.parameters()]
+        self.sourceParams = list(self.qParams)
+        for target, source in extraTargets:
+            self.targetParams += list(target.parameters())
+            self.sourceParams += list(source.parameters())
+        self.rrd_loss = self._rrd_loss
+        self.critic_loss = self._critic_loss
+        self.actor_loss = self._actor_loss
+        if compile and hasattr(torch, "compile"):
+            self.rrd_loss = torch.compile(self._rrd_loss)
+            self.critic_loss = torch.compile(self._critic_loss)
+            self.actor_loss = torch.compile(self._actor_loss)
+
+    def _alpha(self):
+        # entropy weight as a constant for the losses (per seed values broadcast over [seeds, batch, 1])
+        if isinstance(self.alpha, torch.Tensor):
+            alpha = self.alpha.detach().to(self.device)
+            return alpha.view(-1, 1, 1) if alpha.dim() > 0 else alpha
+        return self.alpha
+
+    # Q values of every member [members, batch, 1]
+    def _qvals(self, qfs, feats):
+        if len(qfs) == 1:
+            return qfs[0](feats)
+        return torch.stack([qf(feats) for qf in qfs])
+
+    def _rrd_loss(self, obs, actions, nextobs, rewards):
+        # predicted rewards of each sub sequence, their mean should match the episode's mean reward
+        feats = torch.cat((obs, actions, obs - nextobs), dim=-1)
+        rHat = self.rrder(feats).squeeze(-1)
+        episodicSums = torch.mean(rHat, dim=-1, keepdim=True)
+        # means over the [batch, 1] dims: a scalar, or one loss per seed
+        return F.mse_loss(episodicSums, rewards, reduction='none').mean(dim=(-2, -1))
+
+    def _critic_loss(self, obs, actions, nextobs, dones, alpha):
+        with torch.no_grad():
+            # rewards from the reward redistribution network
+            rHat = self.rrder(torch.cat((obs, actions, obs - nextobs), dim=-1))
+            # sample new action at the next observation based on current policy (with exploration)
+            nextActions, logdev, logprob = self.actor.get_action(nextobs, debug=False, exploration=True)
+            nextFeats = torch.cat([nextobs, nextActions], dim=-1)
+            # use target networks to calculate the target q value for this new action
+            qtargs = self._qvals(self.qf_targets, nextFeats)
+            if self.targetMembers < len(qtargs):
+                qtargs = qtargs[torch.randperm(len(qtargs))[:self.targetMembers]]
+            qtargmin = torch.min(qtargs, dim=0)[0] - (alpha * logprob)
+            qtarget = rHat + (self.gamma * (1 - dones.unsqueeze(-1)) * qtargmin)
+        feats = torch.cat((obs, actions), dim=-1)
+        # sum of the members' mean squared errors
+        qvals = self._qvals(self.qfs, feats)
+        return F.mse_loss(qvals, qtarget.expand_as(qvals), reduction='none').mean(dim=(-2, -1)).sum(0)
+
+    def _actor_loss(self, obs, alpha):
+        actions, logdev, logprob = self.actor.get_action(obs, debug=False, exploration=True)
+        feats = torch.cat((obs, actions), dim=-1)
+        qvals = self._qvals(self.qfs, feats)
+        qvals = torch.mean(qvals, dim=0) if self.actorMean else torch.min(qvals, dim=0)[0]
+        actloss = torch.mean((alpha * logprob) - qvals, dim=(-2, -1))
+        return actloss, logprob
+
+    def update_rrd(self, samples):
+        # samples: buffer sampleSubSeqs output
+        samples = to_device(samples, self.device)
+        actions = samples['actions']
+        if len(actions.shape) < len(samples['obs'].shape):
+            actions = actions.unsqueeze(-1)
+        rrdloss = self.rrd_loss(samples['obs'], actions, samples['nextobs'], samples['rewards'])
+        if self.rrdZeroGrad:
+            self.rrd_opt.zero_grad()
+        rrdloss.sum().backward()
+        self.rrd_opt.step()
+        return rrdloss
+
+    def update(self, samples):
+        # one critic, actor (and alpha) update and soft target update, samples: buffer sampleBatch output
+        # returns (critic loss, actor loss), per seed for stacked networks
+        samples = to_device(samples, self.device)
+        obs = samples['obs']
+        actions = samples['actions']
+        if len(actions.shape) < len(obs.shape):
+            actions = actions.unsqueeze(-1)
+        alpha = self._alpha()
+
+        qfloss = self.critic_loss(obs, actions, samples['nextobs'], samples['dones'], alpha)
+        self.q_opt.zero_grad()
+        qfloss.sum().backward()
+        self.q_opt.step()
+
+        # do NOT compute gradient w.r.t. q value networks
+        # however, we NEED the gradient to go THROUGH these networks to update the actor network
+        for p in self.qParams:
+            p.requires_grad = False
+        actloss, logprob = self.actor_loss(obs, alpha)
+        self.act_opt.zero_grad()
+        actloss.sum().backward()
+        self.act_opt.step()
+        for p in self.qParams:
+            p.requires_grad = True
+
+        if self.alpha_opt is not None:
+            self.alpha_opt.zero_grad()
+            with torch.no_grad():
+                multiplier = (logprob - self.actionSize).to(self.logalpha.device)
+            logalpha = self.logalpha.view(-1, 1, 1) if self.logalpha.dim() > 0 else self.logalpha
+            aloss = -1.0*(torch.exp(logalpha) * multiplier).mean(dim=(-2, -1))
+            aloss.sum().backward()
+            self.alpha_opt.step()
+            self.alpha = torch.exp(self.logalpha)
+
+        # smoothly update target networks at each iteration of the training algorithm
+        soft_update(self.targetParams, self.sourceParams, self.tau)
+        return qfloss, actloss
@@ -0,0 +1,52 @@
+import copy
+import torch
+import torch.nn as nn
+
+# K copies of a network (eg one per training seed) evaluated together:
+#    stackModules replaces every nn.Linear of the layout with a StackedLinear holding the K copies'
+#    weights as [K, in, out], so the stacked module takes inputs with a leading K dimension and
+#    each layer runs as one batched matmul over the copies
+# Only networks whose parameters all live in nn.Linear layers can be stacked (not LSTMs)
+
+class StackedLinear(nn.Module):
+    def __init__(self, linears):
+        super().__init__()
+        self.weight = nn.Parameter(torch.stack([linear.weight.detach().t() for linear in linears]).clone())
+        self.bias = nn.Parameter(torch.stack([linear.bias.detach() for linear in linears]).unsqueeze(1).clone())
+
+    # x: [K, ..., in] -> [K, ..., out]
+    def forward(self, x):
+        shape = x.shape
+        out = torch.baddbmm(self.bias, x.reshape(shape[0], -1, shape[-1]), self.weight)
+        return out.reshape(shape[:-1] + (out.shape[-1],))
+
+def _stackChildren(stacked, modules):
+    for name, child in stacked.named_children():
+        members = [getattr(module, name) for module in modules]
+        if isinstance(child, nn.Linear):
+            setattr(stacked, name, StackedLinear(members))
+        else:
+            _stackChildren(child, members)
+
+# one module for the K given modules (same class / layout), initialized with their weights
+def stackModules(modules):
+    stacked = copy.deepcopy(modules[0])
+    _stackChildren(stacked, modules)
+    stackedNames = set([name for name, child in stacked.named_modules() if isinstance(child, StackedLinear)])
+    for name, p in stacked.named_parameters():
+        if name.rsplit(".", 1)[0] not in stackedNames:
+            raise ValueError(f"can only stack nn.Linear parameters, not {name}")
+    return stacked
+
+# copy member i of a stacked module into module (an unstacked module of the same layout), eg for evaluation
+def loadMember(stacked, i, module):
+    with torch.no_grad():
+        for name, child in module.named_modules():
+            if isinstance(child, nn.Linear):
+                layer = stacked.get_submodule(name)
+                child.weight.copy_(layer.weight[i].t())
+                child.bias.copy_(layer.bias[i, 0])
+
+# dict of [K, ...] tensors from K sampled batches (dicts with the same keys and shapes)
+def stackBatches(batches):
+    return dict([(key, torch.stack([batch[key] for batch in batches])) for key in batches[0]])